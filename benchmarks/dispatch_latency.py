@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Measures how long a job appended to an idle DownloadManager waits before a
+worker completes it, and how much CPU the idle workers burn in the meantime.
+Files are served from a local in-memory HTTP server so the numbers reflect the
+dispatch path rather than the network.
+"""
+# Imports ######################################################################
+from __future__ import print_function
+import os
+import sys
+import json
+import logging
+import shutil
+import argparse
+import tempfile
+import threading
+import time
+
+# Globals ######################################################################
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+LIB_DIR = os.path.realpath(os.path.join(THIS_DIR, '..', 'lib'))
+sys.path.insert(0, LIB_DIR)
+
+from libdlm import DownloadManager, Settings  # noqa: E402
+from libdlm.tests.local_server import LocalHTTPServer  # noqa: E402
+
+
+def percentile(values, pct):
+    '''returns the pct percentile of an already sorted list'''
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def measure_latency(dlm, url, dst, jobs):
+    '''appends jobs one at a time and records append -> callback latency'''
+    latencies = []
+    for _ in range(jobs):
+        done = threading.Event()
+        start = time.time()
+        dlm.append(url, dst, lambda url, err=None: done.set())
+        done.wait(30)
+        latencies.append(time.time() - start)
+    return sorted(latencies)
+
+
+def measure_idle_cpu(seconds):
+    '''CPU seconds used by this process while the workers sit idle'''
+    before = sum(os.times()[:2])
+    time.sleep(seconds)
+    return sum(os.times()[:2]) - before
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', help="Number of worker threads", type=int, default=25)
+    parser.add_argument('--jobs', help="Number of sequential jobs to time", type=int, default=50)
+    parser.add_argument('--idle', help="Seconds to sample idle CPU usage", type=float, default=2.0)
+    args = parser.parse_args()
+
+    server = LocalHTTPServer({'/small.bin': b'x' * 1024})
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dlm = DownloadManager(Settings({'thread_count': args.threads}))
+        logging.getLogger(dlm.logger_name).setLevel(logging.WARNING)
+        latencies = measure_latency(dlm, server.url('/small.bin'), tmpdir, args.jobs)
+        idle_cpu = measure_idle_cpu(args.idle)
+        dlm.stop()
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir)
+
+    print(json.dumps({
+        'threads': args.threads,
+        'jobs': args.jobs,
+        'latency_p50_ms': percentile(latencies, 50) * 1000,
+        'latency_p99_ms': percentile(latencies, 99) * 1000,
+        'latency_max_ms': latencies[-1] * 1000,
+        'idle_cpu_seconds': idle_cpu,
+        'idle_sample_seconds': args.idle,
+    }, indent=2, sort_keys=True))
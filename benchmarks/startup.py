@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Measures what a short-lived program pays to use libdlm: the time to import the
+package, to construct a DownloadManager and to queue the first job (which
+starts the workers), along with the threads and modules alive after
+construction.  Each sample runs in a fresh interpreter so nothing is already
+imported; the median of the samples is reported.
+"""
+# Imports ######################################################################
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+# Globals ######################################################################
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+LIB_DIR = os.path.realpath(os.path.join(THIS_DIR, '..', 'lib'))
+
+# modules a manager should only load once it has something to download
+PROTOCOL_MODULES = ('asyncio', 'cgi', 'ftplib', 'furl', 'http.client',
+                    'multiprocessing', 'ssl', 'tarfile', 'urllib.request')
+
+SAMPLE = '''
+import json, sys, threading, time
+start = time.time()
+import libdlm
+imported = time.time()
+dlm = libdlm.DownloadManager(libdlm.Settings({'thread_count': %(threads)d}))
+constructed = time.time()
+threads = threading.active_count()
+modules = [name for name in %(modules)r if name in sys.modules]
+dlm.append('http://127.0.0.1:9/never.bin', %(dst)r)
+appended = time.time()
+dlm.stop()
+print(json.dumps({'import_ms': (imported - start) * 1000,
+                  'construct_ms': (constructed - imported) * 1000,
+                  'first_append_ms': (appended - constructed) * 1000,
+                  'threads_after_construct': threads,
+                  'protocol_modules_after_construct': modules}))
+'''
+
+
+def median(values):
+    '''returns the median of a list of numbers'''
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def sample(threads, dst):
+    '''runs one fresh interpreter and returns its measurements'''
+    code = SAMPLE % {'threads': threads, 'modules': PROTOCOL_MODULES,
+                     'dst': dst}
+    env = dict(os.environ, PYTHONPATH=LIB_DIR)
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', help="Number of worker threads", type=int, default=25)
+    parser.add_argument('--samples', help="Fresh interpreters to time", type=int, default=10)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        samples = [sample(args.threads, tmpdir) for _ in range(args.samples)]
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print(json.dumps({
+        'threads': args.threads,
+        'samples': args.samples,
+        'import_ms': median([s['import_ms'] for s in samples]),
+        'construct_ms': median([s['construct_ms'] for s in samples]),
+        'first_append_ms': median([s['first_append_ms'] for s in samples]),
+        'threads_after_construct': samples[-1]['threads_after_construct'],
+        'protocol_modules_after_construct':
+            samples[-1]['protocol_modules_after_construct'],
+    }, indent=2, sort_keys=True))
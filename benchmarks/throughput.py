@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark suite.  Local in-memory HTTP (with Range support) and FTP
+servers are started, then batches of files are pushed through DownloadManager
+and FileDownloader while varying the protocol, thread_count, file size
+distribution and chunk size, plus resume scenarios where half of every file is
+already on disk.  Each run reports files/sec and MB/s, and the whole suite is
+written as JSON so results can be compared commit over commit.
+"""
+# Imports ######################################################################
+from __future__ import print_function
+import os
+import sys
+import json
+import random
+import logging
+import platform
+import shutil
+import argparse
+import tempfile
+import subprocess
+import time
+
+# Globals ######################################################################
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+LIB_DIR = os.path.realpath(os.path.join(THIS_DIR, '..', 'lib'))
+sys.path.insert(0, LIB_DIR)
+
+from libdlm import DownloadManager, Settings  # noqa: E402
+from libdlm.file_downloader import FileDownloader  # noqa: E402
+from libdlm.tests.local_server import LocalFTPServer, LocalHTTPServer  # noqa: E402
+
+KB = 1024
+MB = 1024 * 1024
+
+# name -> (number of files, size of each file) groups
+DISTRIBUTIONS = {
+    'tiny': [(400, 4 * KB)],
+    'mixed': [(100, 16 * KB), (20, 512 * KB), (2, 8 * MB)],
+    'huge': [(4, 16 * MB)],
+}
+
+
+def make_files(distribution, scale, seed=0):
+    '''returns {path: data} for a distribution, file counts scaled by scale'''
+    rnd = random.Random(seed)
+    files = {}
+    for group, (count, size) in enumerate(DISTRIBUTIONS[distribution]):
+        block = bytes(bytearray(rnd.getrandbits(8) for _ in range(4 * KB)))
+        data = (block * (size // len(block) + 1))[:size]
+        for idx in range(max(1, int(count * scale))):
+            files['/%s/%d/f%05d.bin' % (distribution, group, idx)] = data
+    return files
+
+
+def git_commit():
+    '''current commit of the tree being benchmarked, if it is a git checkout'''
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=THIS_DIR,
+                                      stderr=subprocess.STDOUT)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result(scenario, files, nbytes, seconds, errors, **params):
+    '''one row of the report; rates are None when any download failed'''
+    seconds = max(seconds, 1e-9)
+    row = dict(params, scenario=scenario, files=files, bytes=nbytes,
+               seconds=round(seconds, 4), errors=errors,
+               files_per_sec=None, mb_per_sec=None)
+    if not errors:
+        row['files_per_sec'] = round(files / seconds, 2)
+        row['mb_per_sec'] = round(nbytes / float(MB) / seconds, 2)
+    return row
+
+
+def best(runs):
+    '''the fastest of repeated runs of a scenario'''
+    return max(runs, key=lambda row: row['mb_per_sec'] or 0)
+
+
+def row_key(row):
+    return tuple(row.get(name) for name in
+                 ('scenario', 'protocol', 'distribution', 'threads', 'chunk_size'))
+
+
+def compare(results, baseline_path):
+    '''annotates results with the MB/s change against an earlier report'''
+    with open(baseline_path) as file_hndl:
+        baseline = dict((row_key(row), row) for row in json.load(file_hndl)['results'])
+    for row in results:
+        old = baseline.get(row_key(row), {}).get('mb_per_sec')
+        row['baseline_mb_per_sec'] = old
+        row['change_pct'] = None
+        if old and row['mb_per_sec'] is not None:
+            row['change_pct'] = round((row['mb_per_sec'] - old) * 100.0 / old, 1)
+
+
+def bench_manager(server, files, threads, chunk_size, **params):
+    '''downloads every file through one DownloadManager'''
+    tmpdir = tempfile.mkdtemp()
+    dlm = DownloadManager(Settings({'thread_count': threads,
+                                    'max_chunk_size': chunk_size}))
+    logging.getLogger(dlm.logger_name).setLevel(logging.CRITICAL)
+    try:
+        start = time.time()
+        jobs = []
+        for idx, path in enumerate(sorted(files)):
+            dst = os.path.join(tmpdir, str(idx))
+            os.mkdir(dst)
+            jobs.append(dlm.append(server.url(path), dst))
+        dlm.wait_all()
+        elapsed = time.time() - start
+        errors = [dlf.error for dlf in jobs if dlf.error is not None]
+    finally:
+        dlm.stop()
+        shutil.rmtree(tmpdir)
+    return result('manager', len(files), sum(map(len, files.values())), elapsed,
+                  len(errors), threads=threads, chunk_size=chunk_size, **params)
+
+
+def bench_resume(server, files, chunk_size, **params):
+    '''resumes every file from a local copy of its first half'''
+    tmpdir = tempfile.mkdtemp()
+    errors = 0
+    nbytes = 0
+    elapsed = 0.0
+    try:
+        for idx, (path, data) in enumerate(sorted(files.items())):
+            dst = os.path.join(tmpdir, str(idx))
+            os.mkdir(dst)
+            with open(os.path.join(dst, os.path.basename(path)), 'wb') as file_hndl:
+                file_hndl.write(data[:len(data) // 2])
+            start = time.time()
+            try:
+                downloader = FileDownloader(server.url(path), dst,
+                                            max_chunk_size=chunk_size)
+                downloader.resume()
+            except Exception:
+                errors += 1
+            elapsed += time.time() - start
+            nbytes += len(data) - len(data) // 2
+    finally:
+        shutil.rmtree(tmpdir)
+    return result('resume', len(files), nbytes, elapsed, errors,
+                  chunk_size=chunk_size, **params)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--protocols', help="Protocols to serve", nargs='+', default=['http', 'ftp'])
+    parser.add_argument('--threads', help="thread_count values", type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--distributions', help="File size distributions", nargs='+',
+                        default=sorted(DISTRIBUTIONS), choices=sorted(DISTRIBUTIONS))
+    parser.add_argument('--chunk-sizes', help="max_chunk_size values", type=int, nargs='+',
+                        default=[64 * KB, MB])
+    parser.add_argument('--scale', help="Multiplier for the number of files", type=float, default=1.0)
+    parser.add_argument('--repeat', help="Runs of each scenario, the best is kept", type=int, default=1)
+    parser.add_argument('--output', help="Write the JSON results to this file")
+    parser.add_argument('--baseline', help="Earlier JSON results to compare against")
+    args = parser.parse_args()
+
+    servers = {}
+    results = []
+    try:
+        for distribution in args.distributions:
+            files = make_files(distribution, args.scale)
+            for protocol in args.protocols:
+                if protocol == 'http':
+                    server = LocalHTTPServer(files)
+                else:
+                    server = LocalFTPServer(files)
+                servers[protocol] = server
+                params = {'protocol': protocol, 'distribution': distribution}
+                for chunk_size in args.chunk_sizes:
+                    for threads in args.threads:
+                        runs = [bench_manager(server, files, threads, chunk_size, **params)
+                                for _ in range(args.repeat)]
+                        results.append(best(runs))
+                        print(json.dumps(results[-1], sort_keys=True), file=sys.stderr)
+                    runs = [bench_resume(server, files, chunk_size, **params)
+                            for _ in range(args.repeat)]
+                    results.append(best(runs))
+                    print(json.dumps(results[-1], sort_keys=True), file=sys.stderr)
+                server.shutdown()
+                del servers[protocol]
+    finally:
+        for server in servers.values():
+            server.shutdown()
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+    report = json.dumps({
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'scale': args.scale,
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file_hndl:
+            file_hndl.write(report + '\n')
+    print(report)
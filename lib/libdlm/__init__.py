@@ -28,19 +28,43 @@ Code Example
 __version__ = '0.0.3'  # project version
 
 # Imports #####################################################################
+import collections
+import os
+import sys
 import threading
 import time
 import logging
-from libdlm.file_downloader import FileDownloader
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    from concurrent.futures import CancelledError, TimeoutError
+except ImportError:
+    class TimeoutError(Exception):
+        '''raised when waiting for downloads times out'''
+
+    class CancelledError(Exception):
+        '''the outcome of jobs still queued when the manager stops'''
+from libdlm.autoscale import ScalingPolicy
+from libdlm.checksum import ChecksumError, parse_checksum
+from libdlm.dns_cache import DNSCache
+from libdlm.journal import Journal
+from libdlm.metrics import Metrics, prometheus_text
+from libdlm.pipeline import Pipeline
+from libdlm.progress import ProgressMonitor
+from libdlm.retry import CircuitBreakers, RetryPolicy
+from libdlm.throttle import Throttle, TokenBucket
 
 
 DEBUG = False
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.DEBUG)
-LOG.propagate = False
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
-LOG.addHandler(console_handler)
+# applications choose where log records go
+LOG.addHandler(logging.NullHandler())
 
 
 ###############################################################################
@@ -72,22 +96,396 @@ class States(object):
     INIT = 4
     STOPPING = 5
 
+    @classmethod
+    def name(cls, state):
+        '''returns the name of a state value, e.g. 'DOWNLOADING' '''
+        for key, value in vars(cls).items():
+            if key.isupper() and value == state:
+                return key
+        return str(state)
+
 
 ###############################################################################
 class DownloadFile(object):
     '''
     Represents the file being downloaded and maintains the information for
-    both the user and the library
+    both the user and the library.  Instances use __slots__ so large
+    backlogs stay small in memory.
+
+    A DownloadFile is also a future-like handle on its job: result() blocks
+    until the job is done and returns the DownloadFile or raises the error
+    that ended it, and add_done_callback() callbacks run the moment it
+    lands.  Every job shares one condition instead of carrying an event of
+    its own.
+
+    >>> dlf = dlm.append('http://example.com/file.zip', '.')
+    >>> dlf.add_done_callback(lambda dlf: unpack(dlf.path))
+    >>> dlf.result(timeout=60).path
+    './file.zip'
     '''
+    __slots__ = ('src', 'dst', 'username', 'password', 'cb', 'progress_cb',
+                 'rate_limit', 'checksum', 'bucket', 'complete', 'journal_id',
+                 'ranges', 'validator', 'path', 'followers', 'queued_at',
+                 'resolved', 'error', 'done_callbacks', 'stages', 'decode',
+                 'extract', 'mirrors', 'probed', 'streamed')
+    resolved_cond = threading.Condition()
 
     @debugger
-    def __init__(self, src, dst, username=None, password=None, cb=None):
+    def __init__(self, src, dst, username=None, password=None, cb=None,
+                 progress_cb=None, rate_limit=None, checksum=None, stages=None,
+                 decode=None, extract=False, mirrors=None):
         self.src = src
         self.dst = dst
         self.username = username
         self.password = password
         self.cb = cb
+        self.progress_cb = progress_cb
+        self.rate_limit = rate_limit
+        self.checksum = checksum
+        # post-download steps run on the manager's process pool
+        self.stages = stages
+        # decompress (and untar) the data as it streams in
+        self.decode = decode
+        self.extract = extract
+        # other urls serving the same file
+        self.mirrors = mirrors
+        self.bucket = None
+        # FileDownloader that revalidated a cache entry, reused on a miss
+        self.probed = None
         self.complete = False
+        # resume state, set for jobs recorded in a Journal
+        self.journal_id = None
+        self.ranges = None
+        self.validator = None
+        # the partial file was written by a single stream, up to its size
+        self.streamed = False
+        # local file once known, and jobs sharing this one's transfer
+        self.path = None
+        self.followers = None
+        self.queued_at = None
+        # outcome, once the job has finished either way
+        self.resolved = False
+        self.error = None
+        self.done_callbacks = None
+
+    def done(self):
+        '''True once the job has finished, successfully or not'''
+        return self.resolved
+
+    def _wait(self, timeout):
+        with self.resolved_cond:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.resolved:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TimeoutError('%s still downloading' % self.src)
+                self.resolved_cond.wait(remaining)
+
+    def result(self, timeout=None):
+        '''
+        waits up to timeout seconds for the job and returns the
+        DownloadFile, raising the error that ended it or TimeoutError
+        '''
+        self._wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def exception(self, timeout=None):
+        '''waits like result() and returns the job's error, or None'''
+        self._wait(timeout)
+        return self.error
+
+    def add_done_callback(self, fn):
+        '''calls fn(dlf) when the job is done, straight away if it is'''
+        with self.resolved_cond:
+            if not self.resolved:
+                if self.done_callbacks is None:
+                    self.done_callbacks = []
+                self.done_callbacks.append(fn)
+                return
+        self._call(fn)
+
+    def resolve(self, error=None):
+        '''records the outcome of the job and runs its done callbacks'''
+        with self.resolved_cond:
+            if self.resolved:
+                return
+            self.resolved = True
+            self.error = error
+            callbacks, self.done_callbacks = self.done_callbacks or [], None
+            self.resolved_cond.notify_all()
+        for fn in callbacks:
+            self._call(fn)
+
+    def _call(self, fn):
+        try:
+            fn(self)
+        except Exception as err:
+            LOG.error('done callback for %s failed: %s' % (self.src, err),
+                      exc_info=True)
+
+
+###############################################################################
+def host_of(src):
+    '''returns the lower-cased host name of a url, or None'''
+    try:
+        return urlsplit(str(src)).hostname
+    except ValueError:
+        return None
+
+
+###############################################################################
+class SingleFlight(object):
+    '''
+    Coalesces jobs for the same source.  The first job for a url leads and
+    is queued; jobs joining while it is in flight follow it and are completed
+    from its result instead of being downloaded again.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.leaders = {}
+
+    @staticmethod
+    def key(dlf):
+        return (str(dlf.src), dlf.username, dlf.checksum, dlf.decode)
+
+    def join(self, dlf):
+        '''returns True if dlf now follows an in-flight job'''
+        key = self.key(dlf)
+        with self.lock:
+            leader = self.leaders.get(key)
+            if leader is not None:
+                if leader.followers is None:
+                    leader.followers = []
+                leader.followers.append(dlf)
+                return True
+            self.leaders[key] = dlf
+            return False
+
+    def land(self, dlf):
+        '''ends dlf's flight and returns the jobs that followed it'''
+        with self.lock:
+            if self.leaders.get(self.key(dlf)) is dlf:
+                del self.leaders[self.key(dlf)]
+            followers, dlf.followers = dlf.followers or [], None
+        return followers
+
+    def __len__(self):
+        return len(self.leaders)
+
+
+###############################################################################
+class JobQueue(object):
+    '''
+    Condition signalled queue of DownloadFile jobs shared by the Downloader
+    threads.  Workers block in get() rather than polling, so a newly appended
+    job is picked up as soon as a worker is free.
+
+    Jobs are kept in a FIFO per host.  get() hands out the oldest job whose
+    host is below its limit of in-flight downloads, so a backlog for one
+    host never stalls work queued for others.
+
+    Feeds added with feed() are pulled from one job at a time, and only when
+    none of the queued jobs can run.  Pulling goes on while the jobs pulled
+    are all for capped or parked hosts, so they cannot hide runnable work
+    further down the feed, but stops at twice prefetch queued jobs, so a
+    huge backlog is never held in memory.
+
+    With breakers, a libdlm.retry.CircuitBreakers, the jobs of a host whose
+    circuit is open stay parked in the queue until it half-opens.
+    '''
+
+    def __init__(self, max_per_host=None, host_limits=None, prefetch=16,
+                 breakers=None):
+        self.hosts = collections.OrderedDict()
+        self.in_flight = {}
+        self.max_per_host = max_per_host
+        self.host_limits = dict(host_limits or {})
+        lock = threading.Lock()
+        self.cond = threading.Condition(lock)
+        # waited on by wait_idle(), apart from the workers waiting on cond
+        self.idle_cond = threading.Condition(lock)
+        self.seq = 0
+        self.queued = 0
+        self.active = 0
+        self.prefetch = prefetch
+        self.feeds = collections.deque()
+        self.pulling = False
+        self.breakers = breakers
+
+    def __len__(self):
+        return self.queued
+
+    def _put(self, dlf):
+        dlf.queued_at = time.time()
+        self.seq += 1
+        self.hosts.setdefault(host_of(dlf.src), collections.deque()).append(
+            (self.seq, dlf))
+        self.queued += 1
+
+    def put(self, dlf):
+        '''queues a job and wakes a single waiting worker'''
+        with self.cond:
+            self._put(dlf)
+            self.cond.notify()
+
+    def feed(self, source):
+        '''
+        adds source, a callable returning the next job or None once it is
+        exhausted, to be pulled from as workers free up
+        '''
+        with self.cond:
+            self.feeds.append(source)
+            self.cond.notify_all()
+
+    def _pull(self):
+        '''
+        queues the next job of the first feed.  The lock is released while
+        the feed runs, so a slow iterator never blocks put() or done().
+        '''
+        source = self.feeds[0]
+        self.pulling = True
+        self.cond.release()
+        try:
+            dlf = source()
+        except Exception as err:
+            LOG.error('dropping job feed: %s' % err, exc_info=True)
+            dlf = None
+        finally:
+            self.cond.acquire()
+            self.pulling = False
+        if dlf is None:
+            if self.feeds and self.feeds[0] is source:
+                self.feeds.popleft()
+        else:
+            self._put(dlf)
+        # another idle worker may want to pull too
+        self.cond.notify()
+
+    def limit(self, host):
+        '''the maximum in-flight downloads for host, None if unlimited'''
+        return self.host_limits.get(host, self.max_per_host)
+
+    def set_limit(self, host, limit):
+        '''changes the limit for one host, or the default if host is None'''
+        with self.cond:
+            if host is None:
+                self.max_per_host = limit
+            else:
+                self.host_limits[host] = limit
+            self.cond.notify_all()
+
+    def _pop_runnable(self):
+        best = None
+        for host, jobs in self.hosts.items():
+            limit = self.limit(host)
+            if limit is not None and self.in_flight.get(host, 0) >= limit:
+                continue
+            if self.breakers is not None and \
+               not self.breakers.available(host):
+                continue
+            if best is None or jobs[0][0] < self.hosts[best][0][0]:
+                best = host
+        if best is None:
+            return None
+        jobs = self.hosts[best]
+        _, dlf = jobs.popleft()
+        if not jobs:
+            del self.hosts[best]
+        if self.breakers is not None:
+            self.breakers.started(best)
+        self.in_flight[best] = self.in_flight.get(best, 0) + 1
+        self.queued -= 1
+        return dlf
+
+    def get(self, interrupted):
+        '''
+        Blocks until a runnable job is available and returns it.  Returns None
+        as soon as interrupted() is true; wakeup() must be called after
+        changing the state interrupted() looks at.  Every job returned must
+        be finished with done().
+        '''
+        with self.cond:
+            while not interrupted():
+                dlf = self._pop_runnable()
+                if dlf is not None:
+                    self.active += 1
+                    return dlf
+                # nothing queued can run, look further down the feed
+                if self.feeds and not self.pulling and \
+                   self.queued < 2 * self.prefetch:
+                    self._pull()
+                    continue
+                self.cond.wait(self._parked_wait())
+            return None
+
+    def _parked_wait(self):
+        '''seconds until a parked host may run again, None if none is'''
+        if self.breakers is None or not self.hosts:
+            return None
+        return self.breakers.wait_time(self.hosts)
+
+    def done(self, dlf):
+        '''marks a job returned by get() as finished'''
+        host = host_of(dlf.src)
+        with self.cond:
+            self.active -= 1
+            self.in_flight[host] -= 1
+            if not self.in_flight[host]:
+                del self.in_flight[host]
+            if host in self.hosts:
+                # a job held back by the host limit can run now
+                self.cond.notify()
+            if not self._busy():
+                self.idle_cond.notify_all()
+
+    def drain(self):
+        '''
+        empties the queue, dropping the feeds, and returns the jobs that
+        were queued in the order they were queued
+        '''
+        with self.cond:
+            jobs = sorted((job for jobs in self.hosts.values()
+                           for job in jobs), key=lambda job: job[0])
+            self.hosts.clear()
+            self.queued = 0
+            self.feeds.clear()
+            if not self._busy():
+                self.idle_cond.notify_all()
+        return [dlf for _, dlf in jobs]
+
+    def wakeup(self):
+        '''wakes every waiting worker so it can re-check its state'''
+        with self.cond:
+            self.cond.notify_all()
+
+    def _busy(self):
+        return self.queued > 0 or self.active > 0 or bool(self.feeds)
+
+    def busy(self):
+        '''True while jobs are queued, fed or being downloaded'''
+        with self.cond:
+            return self._busy()
+
+    def wait_idle(self, timeout=None):
+        '''
+        blocks until nothing is queued, fed or being downloaded, returning
+        False if that takes longer than timeout seconds
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self._busy():
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.idle_cond.wait(remaining)
+        return True
 
 
 ###############################################################################
@@ -99,75 +497,341 @@ class Downloader(threading.Thread):
     '''
 
     @debugger
-    def __init__(self, id, queue, logger):
+    def __init__(self, id, queue, logger, pool=None, settings=None,
+                 monitor=None, journal=None, throttle=None, flights=None,
+                 cache=None, metrics=None, retry_policy=None, breakers=None,
+                 ftp_pool=None, pipeline=None):
         threading.Thread.__init__(self, name=id)
         self.state = States.INIT
         self.id = id
         self.queue = queue
+        self.pool = pool
+        self.ftp_pool = ftp_pool
+        self.settings = settings or Settings()
+        self.monitor = monitor
+        self.journal = journal
+        self.throttle = throttle
+        self.flights = flights
+        self.cache = cache
+        self.metrics = metrics or Metrics()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breakers = breakers
+        self.pipeline = pipeline
         self.running = True
+        self.resumed = threading.Event()
+        self.resumed.set()
         self.count = 0
         self.logger_name = "%s.%s" % (logger, 'downloader')
         self.log = logging.getLogger(self.logger_name)
-        self.transition_to = States.RUNNING
+
+    def interrupted(self):
+        '''True when the thread should stop waiting for new work'''
+        return not self.running or not self.resumed.is_set()
 
     @debugger
     def run(self):
         while self.running:
-            if self.transition_to == States.PAUSED:
+            if not self.resumed.is_set():
                 self.state = States.PAUSED
-                while self.transition_to == States.PAUSED:
-                    time.sleep(1)
+                self.resumed.wait()
+                continue
 
             self.state = States.RUNNING
-            # gets the url from the queue
-            try:
-                dlf = self.queue.pop(0)
-            except Exception as err:
-                time.sleep(1)
-                continue
-            if not dlf:
+            # blocks until a job is queued or we are paused/stopped
+            dlf = self.queue.get(self.interrupted)
+            if dlf is None:
                 continue
 
-            # download the file
-            self.log.debug('* Thread %d - processing URL: %s to %s' %
-                           (threading.current_thread().ident, dlf.src, dlf.dst))
+            self.metrics.observe('queue_wait_seconds',
+                                 time.time() - dlf.queued_at)
             try:
-                self.state = States.DOWNLOADING
-                downloader = FileDownloader(dlf.src, dlf.dst,
-                                            username=dlf.username,
-                                            password=dlf.password,
-                                            logger=self.logger_name)
-                downloader.download()
-                dlf.complete = True
-                if dlf.cb:
-                    dlf.cb(dlf.src)
-                self.log.debug('* Thread %d - download complete' %
-                               threading.current_thread().ident)
-            except Exception as err:
-                self.log.error(str(err))
-                if callable(dlf.cb):
-                    try:
-                        dlf.cb(dlf.src, err)
-                    except Exception as err2:
-                        self.log.error(str(err2), exc_info=True)
-                        raise
+                self.process(dlf)
+            finally:
+                self.queue.done(dlf)
 
         self.state = States.STOPPED
 
+    def process(self, dlf):
+        '''downloads a single job and reports the result to its callback'''
+        self.log.debug('* Thread %d - processing URL: %s to %s' %
+                       (threading.current_thread().ident, dlf.src, dlf.dst))
+        error = None
+        deferred = False
+        self.metrics.inc('downloads_started')
+        try:
+            self.state = States.DOWNLOADING
+            rate_limit = dlf.rate_limit or self.settings.download_rate_limit
+            dlf.bucket = TokenBucket(rate_limit)
+            if not self._from_cache(dlf):
+                attempts = 0
+                while True:
+                    try:
+                        downloader = self._download(dlf)
+                        break
+                    except ChecksumError as err:
+                        if attempts >= self.settings.checksum_retries:
+                            raise
+                        attempts += 1
+                        self.log.error('%s, fetching it again' % err)
+                        self.metrics.inc('retries')
+                        self.metrics.inc('bytes_redownloaded',
+                                         os.path.getsize(dlf.path))
+                        self._restart(dlf)
+                self._to_cache(dlf, downloader)
+            dlf.complete = True
+            self.metrics.inc('downloads_completed')
+            self._finished(dlf)
+            if dlf.stages and self.pipeline is not None:
+                # cb and the handle wait for the stages
+                self._post_process(dlf)
+                deferred = True
+            elif dlf.cb:
+                dlf.cb(dlf.src)
+            self.log.debug('* Thread %d - download complete' %
+                           threading.current_thread().ident)
+        except Exception as err:
+            error = err
+            self.metrics.inc('downloads_failed')
+            self.log.error(str(err))
+            self._finished(dlf)
+            if callable(dlf.cb):
+                try:
+                    dlf.cb(dlf.src, err)
+                except Exception as err2:
+                    self.log.error(str(err2), exc_info=True)
+                    raise
+        finally:
+            self._report(dlf, error)
+            if not deferred:
+                dlf.resolve(error)
+            self._land(dlf, error)
+
+    def _post_process(self, dlf):
+        '''
+        hands dlf's file to the pipeline, blocking while it is backlogged;
+        cb and the handle are completed once its stages have run
+        '''
+        def landed(path, err):
+            if err is None:
+                dlf.path = path
+            else:
+                self.log.error('processing %s failed: %s' % (dlf.src, err))
+            self._notify(dlf, err)
+        self.pipeline.submit(dlf.stages, dlf.path, landed)
+
+    def _notify(self, dlf, error):
+        '''reports the outcome of dlf to its callback and handle'''
+        try:
+            if not callable(dlf.cb):
+                pass
+            elif error is None:
+                dlf.cb(dlf.src)
+            else:
+                dlf.cb(dlf.src, error)
+        except Exception as cb_err:
+            self.log.error(str(cb_err), exc_info=True)
+        dlf.resolve(error)
+
+    def _report(self, dlf, error):
+        '''feeds the outcome of dlf to the circuit breaker of its host'''
+        if self.breakers is None:
+            return
+        if error is not None and self.retry_policy.retryable(error):
+            self.breakers.failure(host_of(dlf.src))
+        else:
+            self.breakers.success(host_of(dlf.src))
+
+    def _from_cache(self, dlf):
+        '''serves dlf from the content cache, True on a hit'''
+        if self.cache is None or dlf.decode:
+            # the cache holds downloads as they came off the wire
+            return False
+        digest = None
+        if dlf.checksum is not None:
+            algo, value = parse_checksum(dlf.checksum)
+            if algo == 'size':
+                return False
+            if value is not None:
+                digest = '%s:%s' % (algo, value)
+        validator = None
+        if digest is None:
+            if self.cache.lookup(dlf.src) is None:
+                return False
+            # only serve the url's last download if it is still current
+            try:
+                dlf.probed = self._downloader(dlf)
+                validator = dlf.probed.validator()
+            except Exception as err:
+                self.log.debug('unable to revalidate %s: %s' % (dlf.src, err))
+                return False
+        dlf.path = self.cache.fetch(dlf.src, dlf.dst, digest,
+                                    validator=validator)
+        if dlf.path is not None:
+            dlf.probed = None
+            self.log.debug('* served %s from the cache' % dlf.src)
+        return dlf.path is not None
+
+    def _to_cache(self, dlf, downloader):
+        if self.cache is None or dlf.decode:
+            return
+        try:
+            self.cache.add(dlf.src, dlf.path, downloader.digest,
+                           downloader.validator())
+        except (IOError, OSError) as err:
+            self.log.error('unable to cache %s: %s' % (dlf.src, err))
+
+    def _land(self, dlf, error):
+        '''completes the jobs that shared dlf's transfer'''
+        if self.flights is None:
+            return
+        for follower in self.flights.land(dlf):
+            err = error
+            if err is None:
+                try:
+                    follower.path = os.path.join(follower.dst,
+                                                 os.path.basename(dlf.path))
+                    if os.path.abspath(follower.path) != \
+                       os.path.abspath(dlf.path):
+                        from libdlm.cache import link_or_copy
+                        link_or_copy(dlf.path, follower.path,
+                                     self.settings.cache_link)
+                    follower.complete = True
+                except (IOError, OSError) as place_err:
+                    err = place_err
+            self._finished(follower)
+            if err is None and follower.stages and self.pipeline is not None:
+                self._post_process(follower)
+            else:
+                self._notify(follower, err)
+
+    def _download(self, dlf):
+        # the source was already probed when a cache entry was revalidated
+        downloader, dlf.probed = dlf.probed or self._downloader(dlf), None
+        dlf.path = downloader.local_file_name
+        if self._resumable(dlf, downloader):
+            self.log.debug('resuming %s from %d bytes' %
+                           (dlf.src, os.path.getsize(dlf.path)))
+            downloader.resume(callback=dlf.progress_cb)
+            return downloader
+        if self.journal is not None and dlf.journal_id is not None and \
+           downloader.single_stream():
+            self.journal.streaming(dlf.journal_id, downloader.validator())
+        downloader.download(callback=dlf.progress_cb)
+        return downloader
+
+    def _resumable(self, dlf, downloader):
+        '''
+        True when dlf was recovered with the partial file of a single stream
+        that is still current
+        '''
+        streamed, dlf.streamed = dlf.streamed, False
+        return (streamed and not dlf.decode and dlf.validator is not None and
+                dlf.validator == downloader.validator() and
+                os.path.exists(dlf.path))
+
+    def _downloader(self, dlf):
+        '''returns the FileDownloader (which probes the source) for dlf'''
+        # imported with the protocol modules by the first download
+        from libdlm.file_downloader import FileDownloader
+        checksum = dlf.checksum
+        if checksum is None and self.cache is not None and not dlf.decode:
+            # the digest cached objects are stored under
+            checksum = 'sha256'
+        downloader = FileDownloader(
+            dlf.src, dlf.dst, username=dlf.username,
+            password=dlf.password, logger=self.logger_name,
+            pool=self.pool, ftp_pool=self.ftp_pool,
+            ftp_max_segments=self.settings.ftp_max_segments,
+            min_chunk_size=self.settings.min_chunk_size,
+            max_chunk_size=self.settings.max_chunk_size,
+            progress_interval=self.settings.progress_interval,
+            progress_bytes=self.settings.progress_bytes,
+            monitor=self.monitor, done_ranges=dlf.ranges,
+            validator=dlf.validator, on_range=self._range_recorder(dlf),
+            throttle=self.throttle, bucket=dlf.bucket,
+            checksum=checksum, metrics=self.metrics,
+            retry_policy=self.retry_policy, decode=dlf.decode,
+            extract=dlf.extract, mirrors=dlf.mirrors,
+            stall_timeout=self.settings.mirror_stall_timeout)
+        return downloader
+
+    def _restart(self, dlf):
+        '''forgets the ranges already written so dlf is fetched whole'''
+        dlf.ranges = None
+        dlf.validator = None
+        if self.journal is not None and dlf.journal_id is not None:
+            self.journal.reset(dlf.journal_id)
+
+    def _range_recorder(self, dlf):
+        '''returns the on_range hook journalling dlf's completed ranges'''
+        if self.journal is None or dlf.journal_id is None:
+            return None
+
+        def on_range(start, end, validator):
+            self.journal.range_done(dlf.journal_id, start, end, validator)
+        return on_range
+
+    def _finished(self, dlf):
+        if self.journal is not None and dlf.journal_id is not None:
+            self.journal.finished(dlf.journal_id)
+
     @debugger
     def stop(self):
         self.running = False
         self.state = States.STOPPING
+        self.resumed.set()
+        self.queue.wakeup()
 
     @debugger
     def pause(self):
-        self.transition_to = States.PAUSED
+        self.resumed.clear()
+        self.queue.wakeup()
+
+    @debugger
+    def resume(self):
+        self.resumed.set()
 
 
 ###############################################################################
 class Settings(object):
     thread_count = 5
     short_name = 'dlm'
+    pool_size = 10  # idle keep-alive connections kept per host
+    pool_idle_timeout = 60.0  # seconds before an idle connection is dropped
+    ftp_pool_size = 4  # idle logged in FTP sessions kept per host and user
+    dns_ttl = 60.0  # seconds a host lookup is reused, None = no cache
+    dns_negative_ttl = 5.0  # seconds a failed lookup is reused
+    ftp_max_segments = 4  # parallel REST segments (sessions) per FTP file
+    mirror_stall_timeout = 10.0  # seconds a mirror may send nothing
+    min_chunk_size = 8192  # bounds of the adaptive read size, in bytes
+    max_chunk_size = 1024 * 1024
+    async_concurrency = 1000  # downloads in flight per AsyncDownloadManager
+    progress_interval = 0.5  # min seconds between progress events
+    progress_bytes = None  # or emit once this many bytes have arrived
+    journal_path = None  # file recording queued work so it survives restarts
+    journal_sync_interval = 1.0  # max seconds between journal fsyncs
+    rate_limit = None  # total bytes/s across all downloads, None = unlimited
+    host_rate_limits = {}  # host -> bytes/s
+    download_rate_limit = None  # default bytes/s for each download
+    max_host_downloads = None  # in-flight downloads per host, None = no cap
+    host_max_downloads = {}  # host -> in-flight downloads, overrides the cap
+    checksum_retries = 1  # fresh re-fetches after a checksum mismatch
+    retries = 5  # resumes after a transient error, per download and segment
+    retry_base_delay = 0.5  # seconds before the first retry, then doubled
+    retry_max_delay = 30.0  # cap on the (jittered) delay between retries
+    breaker_threshold = 5  # failed downloads that park a host, None = off
+    breaker_reset = 30.0  # seconds a host stays parked before a trial job
+    coalesce = True  # share one transfer between jobs for the same url
+    cache_path = None  # directory of a content-addressed download cache
+    cache_max_size = 1024 ** 3  # bytes kept in the cache, LRU evicted
+    cache_link = True  # serve shared/cached files by hard link, else copy
+    min_threads = None  # lower bound of the autoscaled pool, default 1
+    max_threads = None  # autoscale between min and max, None = fixed size
+    autoscale_interval = 1.0  # seconds between pool sizing decisions
+    feed_prefetch = 16  # jobs pulled ahead from extend() iterables
+    process_workers = None  # processes running job stages, None = per CPU
+    process_backlog = None  # stages in flight before downloads wait, 2/proc
+    process_start_method = None  # multiprocessing start method, or default
 
     @debugger
     def __init__(self, kwargs=None):
@@ -180,6 +844,10 @@ class Settings(object):
 class DownloadManager(object):
     '''
     Spawns downloader threads and manages the URL download queue
+
+    Nothing is started by the constructor: the connection pools, the
+    protocol modules and thread_count workers are brought up by the first
+    append(), extend(), resize() or start().
     '''
     __shared_state = {}
 
@@ -209,45 +877,353 @@ class DownloadManager(object):
         else:
             LOG = logging.getLogger(self.settings.short_name)
             self.logger_name = self.settings.short_name
-            LOG.setLevel(logging.DEBUG)
-            LOG.propagate = False
-            console_handler = logging.StreamHandler()
-            console_handler.setLevel(logging.DEBUG)
-            LOG.addHandler(console_handler)
-
-        self.ids = range(self.settings.thread_count)
-        self.thread_count = self.settings.thread_count
-        self.queue = []
+            if not LOG.handlers:
+                LOG.setLevel(logging.DEBUG)
+                LOG.propagate = False
+                console_handler = logging.StreamHandler()
+                console_handler.setLevel(logging.DEBUG)
+                LOG.addHandler(console_handler)
+
+        self.policy = None
+        thread_count = self.settings.thread_count
+        if self.settings.max_threads:
+            self.policy = ScalingPolicy(self.settings.min_threads or 1,
+                                        self.settings.max_threads)
+            thread_count = self.policy.clamp(thread_count)
+        self.ids = range(thread_count)
+        self.thread_count = thread_count
+        self.next_id = thread_count
+        self.paused = False
+        self.retired = []
+        self.resize_lock = threading.Lock()
+        self.scaler = None
+        self.scaler_stop = threading.Event()
+        self.retry_policy = RetryPolicy(self.settings.retries,
+                                        self.settings.retry_base_delay,
+                                        self.settings.retry_max_delay)
+        self.breakers = None
+        if self.settings.breaker_threshold:
+            self.breakers = CircuitBreakers(self.settings.breaker_threshold,
+                                            self.settings.breaker_reset)
+        self.queue = JobQueue(self.settings.max_host_downloads,
+                              self.settings.host_max_downloads,
+                              self.settings.feed_prefetch, self.breakers)
+        self.resolver = None
+        if self.settings.dns_ttl:
+            self.resolver = DNSCache(self.settings.dns_ttl,
+                                     self.settings.dns_negative_ttl)
+        # opened with the workers by _start()
+        self.pool = None
+        self.ftp_pool = None
+        self.started = False
         self.threads = []
-        for id in self.ids:
-            self.threads.append(Downloader(id, self.queue,
-                                logger=self.logger_name))
-            self.threads[-1].daemon = True
-            self.threads[-1].start()
+        self.monitor = ProgressMonitor()
+        self.throttle = Throttle(self.settings.rate_limit,
+                                 self.settings.host_rate_limits)
+        self.flights = None
+        if self.settings.coalesce:
+            self.flights = SingleFlight()
+        self.cache = None
+        if self.settings.cache_path:
+            from libdlm.cache import ContentCache
+            self.cache = ContentCache(self.settings.cache_path,
+                                      self.settings.cache_max_size,
+                                      self.settings.cache_link)
+        self.metrics = Metrics()
+        self.pipeline = Pipeline(self.settings.process_workers,
+                                 self.settings.process_backlog,
+                                 self.settings.process_start_method)
+        self.journal = None
+        self.recovered = []
+        if self.settings.journal_path:
+            self.journal = Journal(self.settings.journal_path,
+                                   self.settings.journal_sync_interval)
+            self._recover()
+
+    def _start(self):
+        '''
+        opens the connection pools and starts the workers, once, when the
+        first job arrives, so a manager that is never given work costs no
+        threads and no protocol imports
+        '''
+        if self.started:
+            return
+        with self.resize_lock:
+            if self.started:
+                return
+            from libdlm.connection_pool import ConnectionPool
+            from libdlm.ftp_pool import FTPPool
+            self.pool = ConnectionPool(self.settings.pool_size,
+                                       self.settings.pool_idle_timeout,
+                                       self.resolver)
+            self.ftp_pool = FTPPool(self.settings.ftp_pool_size,
+                                    self.settings.pool_idle_timeout,
+                                    self.resolver)
+            for id in self.ids:
+                self.threads.append(self._spawn(id, self.paused))
+            self.started = True
+        self._start_scaler()
+
+    def _recover(self):
+        '''requeues the unfinished jobs of a previous run from the journal'''
+        for job in self.journal.pending():
+            dlf = DownloadFile(job['src'], job['dst'], job['username'],
+                               job['password'], checksum=job.get('checksum'),
+                               decode=job.get('decode'),
+                               extract=job.get('extract', False),
+                               mirrors=job.get('mirrors'))
+            dlf.journal_id = job['id']
+            dlf.ranges = job['ranges']
+            dlf.validator = job['validator']
+            dlf.streamed = job.get('stream', False)
+            self.recovered.append(dlf)
+            self._enqueue(dlf)
+        if self.recovered:
+            LOG.debug('recovered %d jobs from %s' %
+                      (len(self.recovered), self.settings.journal_path))
+
+    def _spawn(self, id, paused=False):
+        thread = Downloader(id, self.queue, logger=self.logger_name,
+                            pool=self.pool, ftp_pool=self.ftp_pool,
+                            settings=self.settings,
+                            monitor=self.monitor, journal=self.journal,
+                            throttle=self.throttle, flights=self.flights,
+                            cache=self.cache, metrics=self.metrics,
+                            retry_policy=self.retry_policy,
+                            breakers=self.breakers, pipeline=self.pipeline)
+        thread.daemon = True
+        if paused:
+            thread.resumed.clear()
+        thread.start()
+        return thread
+
+    def _start_scaler(self):
+        if self.policy is None or \
+           (self.scaler is not None and self.scaler.is_alive()):
+            return
+        self.scaler_stop.clear()
+        self.scaler = threading.Thread(target=self._autoscale,
+                                       name='%s.autoscale' % self.logger_name)
+        self.scaler.daemon = True
+        self.scaler.start()
+
+    def _autoscale(self):
+        '''sizes the pool from the queue and throughput every interval'''
+        last_done = self.monitor.snapshot().done
+        last_time = time.time()
+        while not self.scaler_stop.wait(self.settings.autoscale_interval):
+            done = self.monitor.snapshot().done
+            now = time.time()
+            rate = (done - last_done) / max(now - last_time, 1e-6)
+            last_done, last_time = done, now
+            if self.paused:
+                continue
+            with self.resize_lock:
+                target = self.policy.decide(len(self.threads),
+                                            len(self.queue),
+                                            self.queue.active, rate)
+                if target != len(self.threads):
+                    LOG.debug('autoscaling from %d to %d workers at %.0f B/s'
+                              % (len(self.threads), target, rate))
+                    self._resize(target)
+
+    def _resize(self, count):
+        '''spawns or retires workers until count are running'''
+        self.retired = [thread for thread in self.retired
+                        if thread.is_alive()]
+        while len(self.threads) < count:
+            self.threads.append(self._spawn(self.next_id, self.paused))
+            self.next_id += 1
+        if len(self.threads) > count:
+            # retire idle workers before ones that are mid download
+            ranked = sorted(self.threads,
+                            key=lambda thread: thread.state ==
+                            States.DOWNLOADING)
+            for thread in ranked[:len(self.threads) - count]:
+                thread.stop()
+                self.threads.remove(thread)
+                self.retired.append(thread)
+        self.thread_count = len(self.threads)
 
     @debugger
-    def append(self, src, dst, cb=None, username=None, password=None):
-        dlf = DownloadFile(src, dst, username, password, cb)
-        self.queue.append(dlf)
+    def append(self, src, dst, cb=None, username=None, password=None,
+               progress_cb=None, rate_limit=None, checksum=None, stages=None,
+               decode=None, extract=False, mirrors=None):
+        '''
+        queues src for download into dst and returns its DownloadFile, a
+        future-like handle on the job.  checksum, 'sha256:<hex>',
+        'sha1:<hex>', 'md5:<hex>' or an expected size, is verified as the
+        data streams in; a mismatch re-fetches the file up to
+        checksum_retries times before cb gets a ChecksumError.  stages are
+        picklable callables run on the downloaded file in the process pool
+        (see libdlm.pipeline) before cb is called and the handle resolves.
+        decode (True or 'gz', 'bz2', 'xz') decompresses the data as it
+        arrives and extract unpacks a tar archive into dst, see
+        FileDownloader.  mirrors lists other urls serving the same file,
+        which the download is spread over.
+        '''
+        if stages:
+            Pipeline.check(stages)
+        dlf = DownloadFile(src, dst, username, password, cb, progress_cb,
+                           rate_limit, checksum, stages, decode, extract,
+                           mirrors)
+        self._enqueue(dlf)
         return dlf
 
+    @debugger
+    def extend(self, jobs, dst=None, cb=None, username=None, password=None,
+               progress_cb=None, rate_limit=None, checksum=None, stages=None,
+               decode=None, extract=False, mirrors=None):
+        '''
+        Queues every job of an iterable, which may be a generator streaming
+        a manifest.  Items are urls, (url, dst) pairs or dicts of append()
+        arguments; the other arguments are defaults for every item.  Items
+        are only taken from the iterable as workers free up, and journalled
+        when they are taken.
+        '''
+        defaults = {'dst': dst, 'cb': cb, 'username': username,
+                    'password': password, 'progress_cb': progress_cb,
+                    'rate_limit': rate_limit, 'checksum': checksum,
+                    'stages': stages, 'decode': decode, 'extract': extract,
+                    'mirrors': mirrors}
+        iterator = iter(jobs)
+
+        def source():
+            for item in iterator:
+                try:
+                    dlf = self._job(item, defaults)
+                except (TypeError, ValueError) as err:
+                    LOG.error('skipping job %r: %s' % (item, err))
+                    continue
+                if self._admit(dlf):
+                    return dlf
+            return None
+        self._start()
+        self.queue.feed(source)
+
+    @staticmethod
+    def _job(item, defaults):
+        '''builds the DownloadFile for one item given to extend()'''
+        if isinstance(item, dict):
+            kwargs = dict(defaults, **item)
+        elif isinstance(item, (tuple, list)):
+            kwargs = dict(defaults, src=item[0], dst=item[1])
+        else:
+            kwargs = dict(defaults, src=item)
+        if kwargs.get('dst') is None:
+            raise ValueError('no destination given')
+        if kwargs.get('stages'):
+            Pipeline.check(kwargs['stages'])
+        return DownloadFile(**kwargs)
+
+    def _admit(self, dlf):
+        '''
+        journals a new job, returns False if it joined a transfer of the
+        same url already in flight instead of needing a queue slot
+        '''
+        if self.journal is not None and dlf.journal_id is None:
+            dlf.journal_id = self.journal.queued(dlf.src, dlf.dst,
+                                                 dlf.username, dlf.password,
+                                                 dlf.checksum, dlf.decode,
+                                                 dlf.extract, dlf.mirrors)
+        if dlf.extract:
+            # an unpacked archive cannot be linked into another dst
+            return True
+        return self.flights is None or not self.flights.join(dlf)
+
+    def _enqueue(self, dlf):
+        '''queues dlf unless a transfer of the same url is in flight'''
+        if self._admit(dlf):
+            self._start()
+            self.queue.put(dlf)
+
     @debugger
     def pause(self):
+        self.paused = True
         for thread in self.threads:
             thread.pause()
 
     @debugger
-    def stop(self):
-        for thread in self.threads:
-            thread.running = False
+    def resume(self):
+        self.paused = False
         for thread in self.threads:
+            thread.resume()
+
+    @debugger
+    def stop(self):
+        '''
+        stops the workers once their current jobs are done.  Jobs still
+        queued, and the jobs following them, are resolved with a
+        CancelledError (and reported to their cb) like the pending futures
+        of an executor shut down with cancel_futures; they stay journalled.
+        Items of extend() iterables not taken yet are dropped.
+        '''
+        self.scaler_stop.set()
+        if self.scaler is not None:
+            self.scaler.join()
+        with self.resize_lock:
+            threads = self.threads + self.retired
+        for thread in threads:
+            thread.stop()
+        for thread in threads:
             thread.join()
+        for dlf in self.queue.drain():
+            self._cancel(dlf)
+        if self.started:
+            self.pool.clear()
+            self.ftp_pool.clear()
+        self.pipeline.close()
+        if self.journal is not None:
+            self.journal.sync()
+
+    def _cancel(self, dlf):
+        '''resolves a job that will not run, and its followers, as cancelled'''
+        jobs = [dlf]
+        if self.flights is not None:
+            jobs.extend(self.flights.land(dlf))
+        for job in jobs:
+            err = CancelledError('%s cancelled, the manager stopped' %
+                                 job.src)
+            if callable(job.cb):
+                try:
+                    job.cb(job.src, err)
+                except Exception as cb_err:
+                    LOG.error(str(cb_err), exc_info=True)
+            job.resolve(err)
 
     @debugger
     def start(self):
-        for thread in self.threads:
-            thread.running = True
-            thread.start()
+        '''starts the workers now rather than when the first job arrives'''
+        if not self.started:
+            return self._start()
+        for idx, thread in enumerate(self.threads):
+            if thread.is_alive():
+                thread.resume()
+            else:
+                self.threads[idx] = self._spawn(thread.id)
+        self._start_scaler()
+
+    @debugger
+    def resize(self, count=None, min_threads=None, max_threads=None):
+        '''
+        Changes the number of worker threads while downloads run.  count
+        sets the size now; min_threads and max_threads change the bounds
+        the pool autoscales between, and turn autoscaling on if it was off.
+        Workers retired by a shrink finish their current download first.
+        '''
+        self._start()
+        with self.resize_lock:
+            if self.policy is None and (min_threads or max_threads):
+                self.policy = ScalingPolicy(min_threads or 1,
+                                            max_threads or min_threads)
+            elif self.policy is not None:
+                self.policy.set_bounds(min_threads, max_threads)
+            if count is None:
+                count = len(self.threads)
+            if self.policy is not None:
+                count = self.policy.clamp(count)
+            self._resize(max(1, count))
+        self._start_scaler()
 
     @debugger
     def marco(self):
@@ -256,12 +1232,127 @@ class DownloadManager(object):
                 raise Exception
         return "polo"
 
+    def progress(self):
+        '''returns a Progress event aggregated over every download'''
+        return self.monitor.snapshot()
+
+    def set_rate_limit(self, rate, host=None, dlf=None):
+        '''
+        Changes a bandwidth limit in bytes/s while downloads run: the limit
+        for one download if dlf is given, for one host if host is given,
+        otherwise the global limit.  None removes the limit.
+        '''
+        if dlf is not None:
+            dlf.rate_limit = rate
+            if dlf.bucket is not None:
+                dlf.bucket.set_rate(rate)
+        elif host is not None:
+            self.throttle.set_host_rate(host, rate)
+        else:
+            self.throttle.set_rate(rate)
+
+    def set_host_limit(self, limit, host=None):
+        '''
+        Changes the maximum number of simultaneous downloads from host, or
+        the default for every host when host is None.  None removes the cap.
+        '''
+        self.queue.set_limit(host, limit)
+
+    def stats(self):
+        '''
+        returns a snapshot of the manager's metrics: counters, timing
+        summaries, queue depth, in-flight jobs, current aggregate throughput,
+        the number of workers in each state and the hosts parked by an open
+        circuit breaker
+        '''
+        stats = self.metrics.snapshot()
+        stats['queue_depth'] = len(self.queue)
+        stats['in_flight'] = self.queue.active
+        stats['throughput_bytes'] = self.monitor.snapshot().rate
+        workers = collections.Counter(States.name(thread.state)
+                                      for thread in self.threads)
+        stats['workers'] = dict(workers)
+        if self.breakers is not None:
+            stats['open_circuits'] = self.breakers.open_hosts()
+            stats['circuit_trips'] = self.breakers.trips
+        return stats
+
+    def prometheus(self):
+        '''returns stats() in the Prometheus text exposition format'''
+        return prometheus_text(self.stats())
+
+    def pool_stats(self):
+        '''
+        returns the connection pool reuse counters, None until the workers
+        have started
+        '''
+        if self.pool is None:
+            return None
+        return self.pool.stats()
+
+    def ftp_pool_stats(self):
+        '''
+        returns the FTP session pool reuse counters, None until the workers
+        have started
+        '''
+        if self.ftp_pool is None:
+            return None
+        return self.ftp_pool.stats()
+
+    def dns_stats(self):
+        '''returns the DNS cache counters, None when caching is off'''
+        if self.resolver is None:
+            return None
+        return self.resolver.stats()
+
     def is_busy(self):
-        if len(self.queue) != 0:
-            return True
+        return self.queue.busy() or self.pipeline.busy()
+
+    def wait_all(self, timeout=None):
+        '''
+        blocks until every queued, fed and running job is done, stages
+        included, returning False if that takes longer than timeout seconds
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        if not self.queue.wait_idle(timeout):
+            return False
+        if deadline is not None:
+            timeout = max(0, deadline - time.time())
+        return self.pipeline.wait_idle(timeout)
+
+    @staticmethod
+    def as_completed(jobs, timeout=None):
+        '''
+        yields the DownloadFiles returned by append() as they finish, raising
+        TimeoutError if they are not all done within timeout seconds
+        '''
+        jobs = list(jobs)
+        finished = queue.Queue()
+        for dlf in jobs:
+            dlf.add_done_callback(finished.put)
+        deadline = None if timeout is None else time.time() + timeout
+        for _ in jobs:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            try:
+                yield finished.get(timeout=remaining)
+            except queue.Empty:
+                raise TimeoutError('downloads still running')
+
+
+def __getattr__(name):
+    '''imports AsyncDownloadManager, and asyncio with it, on first use'''
+    if name == 'AsyncDownloadManager':
+        from libdlm.async_manager import AsyncDownloadManager
+        return AsyncDownloadManager
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-        for thread in self.threads:
-            if thread.state == States.DOWNLOADING:
-                return True
 
-        return False
+if sys.version_info < (3, 7):
+    # no module level __getattr__ before python 3.7
+    try:
+        AsyncDownloadManager = __getattr__('AsyncDownloadManager')
+    except (ImportError, SyntaxError):
+        # asyncio needs python 3
+        pass
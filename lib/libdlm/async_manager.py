@@ -0,0 +1,331 @@
+'''
+asyncio based download engine.
+
+AsyncDownloadManager runs each download as a task on a single event loop, so
+thousands of transfers can be in flight without an OS thread apiece.  HTTP is
+spoken directly over non-blocking asyncio streams; other schemes (ftp) are
+handed to FileDownloader on the loop's default executor, as are the opens,
+writes and closes of the local files, so a slow disk never stalls the loop.
+
+HTTP goes through the same proxies as libdlm.connection_pool: those from the
+environment unless proxies is given, plain http sent to the proxy as an
+absolute url and https tunnelled with CONNECT.
+'''
+
+import asyncio
+import http.client as httplib
+import logging
+import os
+import urllib.request as urllib2
+from urllib.parse import urlsplit, urljoin
+from furl import furl
+from libdlm import DownloadFile, Settings
+from libdlm.connection_pool import (DEFAULT_PORTS, MAX_REDIRECTS,
+                                    REDIRECT_CODES, basic_auth, origin,
+                                    proxy_for, proxy_headers)
+from libdlm.file_downloader import (FileDownloader, disposition_file_name,
+                                    url_file_name)
+from libdlm.progress import ProgressMonitor, ProgressTracker
+from libdlm.throttle import Throttle, TokenBucket
+
+
+class AsyncDownloadManager(object):
+    '''
+    Event loop counterpart of DownloadManager.  append() must be called with
+    a running loop and returns an awaitable that resolves to the completed
+    DownloadFile, or raises the error that ended the download.
+
+    >>> async def main():
+    ...     dlm = AsyncDownloadManager()
+    ...     dlf = await dlm.append('http://example.com/file.zip', '.')
+    ...     dlm.append('http://example.com/other.zip', '.')
+    ...     await dlm.join()
+    >>> asyncio.run(main())
+    '''
+    timeout = 120.0
+
+    def __init__(self, settings=None, logger=None, proxies=None):
+        if settings is None:
+            settings = Settings()
+        self.settings = settings
+        if proxies is None:
+            proxies = urllib2.getproxies()
+        # scheme -> proxy url, and 'no' -> hosts reached directly
+        self.proxies = proxies
+        if logger is not None:
+            self.logger_name = "%s.%s" % (logger, settings.short_name)
+        else:
+            self.logger_name = settings.short_name
+        self.log = logging.getLogger("%s.async" % self.logger_name)
+        self.tasks = set()
+        self.monitor = ProgressMonitor()
+        self.throttle = Throttle(settings.rate_limit,
+                                 settings.host_rate_limits)
+        self.slots = None
+        self.resumed = None
+
+    def _setup(self):
+        # created on first use so they belong to the running loop
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.settings.async_concurrency)
+            self.resumed = asyncio.Event()
+            self.resumed.set()
+
+    def append(self, src, dst, cb=None, username=None, password=None,
+               progress_cb=None, rate_limit=None):
+        dlf = DownloadFile(src, dst, username, password, cb, progress_cb,
+                           rate_limit)
+        self._setup()
+        task = asyncio.ensure_future(self._run(dlf))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def pause(self):
+        '''holds queued downloads and stalls running ones at their next read'''
+        self._setup()
+        self.resumed.clear()
+
+    def resume(self):
+        self._setup()
+        self.resumed.set()
+
+    def stop(self):
+        '''cancels every queued and running download'''
+        for task in list(self.tasks):
+            task.cancel()
+
+    def is_busy(self):
+        return bool(self.tasks)
+
+    def progress(self):
+        '''returns a Progress event aggregated over every download'''
+        return self.monitor.snapshot()
+
+    def set_rate_limit(self, rate, host=None, dlf=None):
+        '''see DownloadManager.set_rate_limit'''
+        if dlf is not None:
+            dlf.rate_limit = rate
+            if dlf.bucket is not None:
+                dlf.bucket.set_rate(rate)
+        elif host is not None:
+            self.throttle.set_host_rate(host, rate)
+        else:
+            self.throttle.set_rate(rate)
+
+    async def join(self):
+        '''waits until every appended download has finished'''
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def _run(self, dlf):
+        async with self.slots:
+            await self.resumed.wait()
+            self.log.debug('* processing URL: %s to %s' % (dlf.src, dlf.dst))
+            dlf.bucket = TokenBucket(dlf.rate_limit or
+                                     self.settings.download_rate_limit)
+            try:
+                if urlsplit(dlf.src).scheme in DEFAULT_PORTS:
+                    await self._download_http(dlf)
+                else:
+                    loop = asyncio.get_event_loop()
+                    await loop.run_in_executor(None, self._download_blocking,
+                                               dlf)
+            except asyncio.CancelledError as err:
+                dlf.resolve(err)
+                raise
+            except Exception as err:
+                self.log.error(str(err))
+                try:
+                    if callable(dlf.cb):
+                        dlf.cb(dlf.src, err)
+                finally:
+                    dlf.resolve(err)
+                raise
+
+        dlf.complete = True
+        try:
+            if dlf.cb:
+                dlf.cb(dlf.src)
+        finally:
+            dlf.resolve()
+        self.log.debug('* download complete: %s' % dlf.src)
+        return dlf
+
+    def _download_blocking(self, dlf):
+        downloader = FileDownloader(
+            dlf.src, dlf.dst, username=dlf.username, password=dlf.password,
+            logger=self.logger_name,
+            min_chunk_size=self.settings.min_chunk_size,
+            max_chunk_size=self.settings.max_chunk_size,
+            progress_interval=self.settings.progress_interval,
+            progress_bytes=self.settings.progress_bytes,
+            monitor=self.monitor, throttle=self.throttle, bucket=dlf.bucket)
+        dlf.path = downloader.local_file_name
+        downloader.download(callback=dlf.progress_cb)
+
+    async def _download_http(self, dlf):
+        headers = {}
+        if dlf.username:
+            headers['Authorization'] = basic_auth(dlf.username, dlf.password)
+        reader, writer, resp_headers = await self._request(dlf.src, headers)
+        try:
+            name = disposition_file_name(
+                resp_headers.get('content-disposition'))
+            if not name:
+                name = url_file_name(furl(dlf.src))
+            total = resp_headers.get('content-length')
+            tracker = ProgressTracker(
+                dlf.src, int(total) if total else None, dlf.progress_cb,
+                self.settings.progress_interval, self.settings.progress_bytes)
+            self.monitor.add(tracker)
+            dlf.path = os.path.join(dlf.dst, name)
+            loop = asyncio.get_event_loop()
+            try:
+                file_hndl = await loop.run_in_executor(None, open, dlf.path,
+                                                       'wb')
+                try:
+                    await self._copy_body(reader, file_hndl, resp_headers,
+                                          tracker, dlf)
+                finally:
+                    await loop.run_in_executor(None, file_hndl.close)
+            finally:
+                tracker.finish()
+                self.monitor.remove(tracker)
+        finally:
+            writer.close()
+
+    async def _request(self, url, headers):
+        '''
+        sends a GET, following redirects, and returns the stream pair and
+        lower-cased response headers positioned at the start of the body
+        '''
+        headers = dict(headers)
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path = '%s?%s' % (path, parts.query)
+            host = parts.hostname
+            port = parts.port or DEFAULT_PORTS[parts.scheme]
+            proxy = proxy_for(self.proxies, parts.scheme, host)
+            sent = headers
+            if proxy is None:
+                connecting = asyncio.open_connection(
+                    host, port, ssl=True if parts.scheme == 'https' else None)
+            elif parts.scheme == 'http':
+                # a plain http proxy takes the whole url
+                _, proxy_host, proxy_port = origin(proxy)
+                connecting = asyncio.open_connection(proxy_host, proxy_port)
+                path = '%s://%s%s' % (parts.scheme, parts.netloc, path)
+                sent = dict(headers, **proxy_headers(proxy))
+            else:
+                connecting = self._tunnel(proxy, host, port)
+            reader, writer = await asyncio.wait_for(connecting, self.timeout)
+
+            try:
+                status, reason, resp_headers = await self._exchange(
+                    reader, writer, path, parts.netloc, sent)
+            except BaseException:
+                writer.close()
+                raise
+
+            if status in REDIRECT_CODES and 'location' in resp_headers:
+                writer.close()
+                target = urljoin(url, resp_headers['location'])
+                if origin(target) != origin(url):
+                    # credentials are not handed to another origin
+                    headers.pop('Authorization', None)
+                url = target
+                continue
+            if status >= 400:
+                writer.close()
+                raise urllib2.HTTPError(url, status, reason, resp_headers,
+                                        None)
+            return reader, writer, resp_headers
+
+        raise urllib2.HTTPError(url, status, 'Too many redirects',
+                                resp_headers, None)
+
+    async def _tunnel(self, proxy, host, port):
+        '''opens a TLS stream to host:port through a CONNECT to proxy'''
+        _, proxy_host, proxy_port = origin(proxy)
+        conn = httplib.HTTPConnection(proxy_host, proxy_port,
+                                      timeout=self.timeout)
+        conn.set_tunnel(host, port, proxy_headers(proxy))
+        # the CONNECT exchange blocks, it runs on the default executor
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, conn.connect)
+        sock, conn.sock = conn.sock, None
+        try:
+            return await asyncio.open_connection(sock=sock, ssl=True,
+                                                 server_hostname=host)
+        except BaseException:
+            sock.close()
+            raise
+
+    async def _exchange(self, reader, writer, path, host, headers):
+        '''writes the request and parses the status line and headers'''
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % host,
+                 'User-Agent: libdlm', 'Connection: close']
+        lines.extend('%s: %s' % item for item in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        status_line = await self._wait(reader.readline())
+        _, status, reason = (status_line.decode('latin-1').rstrip('\r\n')
+                             .split(' ', 2) + [''])[:3]
+        resp_headers = {}
+        while True:
+            line = (await self._wait(reader.readline())).decode('latin-1')
+            if line in ('\r\n', '\n', ''):
+                break
+            key, _, value = line.partition(':')
+            resp_headers[key.strip().lower()] = value.strip()
+        return int(status), reason, resp_headers
+
+    async def _copy_body(self, reader, file_hndl, headers, tracker, dlf):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                line = await self._wait(reader.readline())
+                size = int(line.split(b';')[0], 16)
+                if size == 0:
+                    break
+                await self._copy(reader, file_hndl, size, tracker, dlf)
+                await self._wait(reader.readexactly(2))
+        elif 'content-length' in headers:
+            await self._copy(reader, file_hndl, int(headers['content-length']),
+                             tracker, dlf)
+        else:
+            await self._copy(reader, file_hndl, None, tracker, dlf)
+
+    async def _copy(self, reader, file_hndl, length, tracker, dlf):
+        '''copies length bytes, or everything up to EOF when length is None'''
+        host = urlsplit(dlf.src).hostname
+        loop = asyncio.get_event_loop()
+        remaining = length
+        while remaining is None or remaining > 0:
+            if not self.resumed.is_set():
+                await self.resumed.wait()
+            size = self.settings.max_chunk_size
+            if remaining is not None:
+                size = min(size, remaining)
+            cap = self.throttle.max_chunk(host, dlf.bucket)
+            if cap is not None:
+                size = min(size, cap)
+            data = await self._wait(reader.read(size))
+            if not data:
+                if remaining is None:
+                    return
+                raise ConnectionError("connection closed with %d bytes "
+                                      "outstanding" % remaining)
+            await loop.run_in_executor(None, file_hndl.write, data)
+            tracker.update(len(data))
+            wait = self.throttle.reserve(host, len(data), dlf.bucket)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if remaining is not None:
+                remaining -= len(data)
+
+    def _wait(self, coro):
+        return asyncio.wait_for(coro, self.timeout)
@@ -0,0 +1,84 @@
+'''
+Sizing policy for an autoscaling pool of download workers.
+
+A DownloadManager with max_threads set samples its queue and throughput every
+autoscale_interval seconds and asks a ScalingPolicy how many workers it
+should have.  The pool grows while jobs are waiting and every worker is busy,
+but each growth step is checked against the throughput measured before it:
+when extra workers stop adding at least gain (a fraction) to the bytes/s, the
+current size becomes a ceiling for plateau_ticks samples.  Workers left idle
+with nothing queued for idle_ticks samples are retired, never going below
+min_workers.
+'''
+
+
+class ScalingPolicy(object):
+    '''
+    >>> policy = ScalingPolicy(2, 32)
+    >>> policy.decide(workers=4, queued=100, active=4, rate=10e6)
+    8
+    >>> policy.decide(workers=8, queued=90, active=8, rate=10.1e6)
+    8
+    '''
+
+    def __init__(self, min_workers=1, max_workers=None, gain=0.05,
+                 idle_ticks=5, plateau_ticks=30):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers,
+                               max_workers or self.min_workers)
+        self.gain = gain
+        self.idle_ticks = idle_ticks
+        self.plateau_ticks = plateau_ticks
+        # (workers, rate) measured just before the last growth step
+        self.baseline = None
+        self.ceiling = None
+        self.ceiling_ticks = 0
+        self.idle = 0
+
+    def set_bounds(self, min_workers=None, max_workers=None):
+        if min_workers is not None:
+            self.min_workers = max(1, min_workers)
+        if max_workers is not None:
+            self.max_workers = max_workers
+        self.max_workers = max(self.min_workers, self.max_workers)
+
+    def clamp(self, workers):
+        return min(max(workers, self.min_workers), self.max_workers)
+
+    def decide(self, workers, queued, active, rate):
+        '''
+        returns the number of workers wanted given the current pool size,
+        queued and active jobs and the bytes/s over the last sample
+        '''
+        target = self.clamp(workers)
+        if self.ceiling is not None:
+            self.ceiling_ticks -= 1
+            if self.ceiling_ticks <= 0 or not queued:
+                self.ceiling = None
+
+        if queued and active >= workers:
+            self.idle = 0
+            if self.baseline is not None:
+                base_workers, base_rate = self.baseline
+                self.baseline = None
+                if workers > base_workers and \
+                   rate < base_rate * (1 + self.gain):
+                    # the extra workers bought no throughput
+                    self.ceiling = workers
+                    self.ceiling_ticks = self.plateau_ticks
+            limit = self.max_workers
+            if self.ceiling is not None:
+                limit = min(limit, self.ceiling)
+            if workers < limit:
+                self.baseline = (workers, rate)
+                target = min(limit, workers + max(1, min(queued, workers)))
+        elif not queued and active < workers:
+            self.baseline = None
+            self.idle += 1
+            if self.idle >= self.idle_ticks:
+                self.idle = 0
+                spare = workers - active
+                target = self.clamp(max(active, workers - max(1, spare // 2)))
+        else:
+            self.idle = 0
+        return target
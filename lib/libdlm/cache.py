@@ -0,0 +1,258 @@
+'''
+Content-addressed cache of finished downloads.
+
+Objects are stored under their digest ('<algorithm>:<hex>') in
+<path>/objects, and an index maps each source url to the digest, file name
+and validator (ETag or Last-Modified) of its last download, so a repeated
+request can be served locally.  A request by url alone is only served while
+the server still reports the same validator.
+
+Downloads are copied into the cache, so nothing written to a download
+destination later can reach a cached object.  Objects are served by hard
+link where the filesystem allows, falling back to copies; libdlm never
+writes through such a link (see libdlm.file_sink.unshare).  An object's
+digest is verified once, as it is copied in; before it is served only its
+size and modification time are checked against the index, so a hit costs a
+stat rather than a pass over the file.
+
+The cache is bounded to max_size bytes; the least recently used objects are
+evicted first.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+replace = getattr(os, 'replace', os.rename)
+READ_SIZE = 1024 * 1024
+
+
+def file_digest(path, algo='sha256'):
+    '''returns '<algo>:<hex>' of a file, for objects not hashed in flight'''
+    hasher = hashlib.new(algo)
+    with open(path, 'rb') as file_hndl:
+        for block in iter(lambda: file_hndl.read(READ_SIZE), b''):
+            hasher.update(block)
+    return '%s:%s' % (algo, hasher.hexdigest())
+
+
+def link_or_copy(src, dst, link=True):
+    '''hard links src to dst, copying when a link is not possible'''
+    if os.path.exists(dst):
+        os.remove(dst)
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except (OSError, AttributeError):
+            # other filesystem, or no hard links on this platform
+            pass
+    shutil.copy2(src, dst)
+
+
+class ContentCache(object):
+    '''
+    >>> cache = ContentCache('/var/cache/dlm', max_size=1024 ** 3)
+    >>> cache.add('http://example.com/file.zip', '/tmp/file.zip')
+    >>> cache.fetch('http://example.com/file.zip', '/srv/downloads')
+    '/srv/downloads/file.zip'
+    '''
+
+    def __init__(self, path, max_size=1024 ** 3, link=True):
+        self.path = path
+        self.max_size = max_size
+        self.link = link
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(path, 'index.json')
+        self.urls = {}
+        self.objects = {}
+        if not os.path.isdir(os.path.join(path, 'objects')):
+            os.makedirs(os.path.join(path, 'objects'))
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path) as file_hndl:
+                index = json.load(file_hndl)
+        except (IOError, OSError, ValueError):
+            return
+        self.objects = dict((digest, obj) for digest, obj in
+                            index.get('objects', {}).items()
+                            if os.path.exists(self._object_path(digest)))
+        self.urls = dict((url, entry) for url, entry in
+                         index.get('urls', {}).items()
+                         if entry['digest'] in self.objects)
+
+    def _save(self):
+        tmp_path = '%s.tmp' % self.index_path
+        with open(tmp_path, 'w') as file_hndl:
+            json.dump({'urls': self.urls, 'objects': self.objects},
+                      file_hndl)
+        replace(tmp_path, self.index_path)
+
+    def _object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest.replace(':', '-'))
+
+    def size(self):
+        '''total bytes held by the cache'''
+        with self.lock:
+            return sum(obj['size'] for obj in self.objects.values())
+
+    def lookup(self, src=None, digest=None):
+        '''
+        returns the index entry ({'digest', 'name'}, and 'validator' for a
+        url) for a digest, or for the url when no digest is given, None on
+        a miss
+        '''
+        with self.lock:
+            if digest is None:
+                return self.urls.get(src)
+            if digest in self.objects:
+                return {'digest': digest,
+                        'name': self.objects[digest]['name']}
+            return None
+
+    def fetch(self, src, dst_dir, digest=None, name=None, validator=None):
+        '''
+        places the cached copy of digest, or of src when its validator
+        matches the one recorded, in dst_dir and returns its path, or None
+        on a miss
+        '''
+        entry = self.lookup(src, digest)
+        if entry is None:
+            return None
+        if digest is None and (validator is None or
+                               entry.get('validator') != validator):
+            # the server's copy may have changed since
+            return None
+        if not self._intact(entry['digest']):
+            LOG.error("cache object %s is corrupt, dropping it" %
+                      entry['digest'])
+            with self.lock:
+                self._drop(entry['digest'])
+                self._save()
+            return None
+        dst = os.path.join(dst_dir, name or entry['name'])
+        try:
+            link_or_copy(self._object_path(entry['digest']), dst, self.link)
+        except (IOError, OSError) as err:
+            LOG.debug("cache object for %s unusable: %s" % (src, err))
+            return None
+        with self.lock:
+            if entry['digest'] in self.objects:
+                self.objects[entry['digest']]['used'] = time.time()
+                self._save()
+        return dst
+
+    def _intact(self, digest):
+        '''
+        True when the object of digest still has the size and modification
+        time it was stored with
+        '''
+        obj_path = self._object_path(digest)
+        with self.lock:
+            obj = self.objects.get(digest)
+        try:
+            stat = os.stat(obj_path)
+            if obj is None or stat.st_size != obj['size']:
+                return False
+            if 'mtime' in obj:
+                return stat.st_mtime == obj['mtime']
+            # indexed before mtimes were kept, verify it once
+            if file_digest(obj_path, digest.split(':', 1)[0]) != digest:
+                return False
+        except (IOError, OSError, ValueError):
+            return False
+        with self.lock:
+            obj['mtime'] = stat.st_mtime
+        return True
+
+    def _copy_in(self, path, digest=None):
+        '''
+        copies path to a temporary file among the objects, hashing it on the
+        way, and returns (digest, temporary path).  Raises ValueError if the
+        copy does not match digest.
+        '''
+        algo = digest.split(':', 1)[0] if digest else 'sha256'
+        hasher = hashlib.new(algo)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.path,
+                                                         'objects'))
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                with open(path, 'rb') as file_hndl:
+                    for block in iter(lambda: file_hndl.read(READ_SIZE),
+                                      b''):
+                        hasher.update(block)
+                        tmp_file.write(block)
+            copied = '%s:%s' % (algo, hasher.hexdigest())
+            if digest is not None and copied != digest:
+                raise ValueError('%s does not match %s' % (path, digest))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return copied, tmp_path
+
+    def add(self, src, path, digest=None, validator=None):
+        '''
+        stores a copy of the downloaded file at path as the content of src,
+        as of validator
+        '''
+        if digest is not None and digest.startswith('size:'):
+            digest = None
+        size = os.path.getsize(path)
+        if size > self.max_size:
+            return
+        name = os.path.basename(path)
+        with self.lock:
+            stored = digest is not None and digest in self.objects
+        tmp_path = None
+        if not stored:
+            # the copy runs outside the lock so hits are never held up
+            try:
+                digest, tmp_path = self._copy_in(path, digest)
+            except ValueError as err:
+                LOG.error('not caching %s: %s' % (src, err))
+                return
+        with self.lock:
+            if digest not in self.objects and tmp_path is not None:
+                obj_path = self._object_path(digest)
+                replace(tmp_path, obj_path)
+                tmp_path = None
+                self.objects[digest] = {'size': size, 'name': name,
+                                        'mtime': os.stat(obj_path).st_mtime}
+            if digest in self.objects:
+                self.objects[digest]['used'] = time.time()
+                self.urls[src] = {'digest': digest, 'name': name,
+                                  'validator': validator}
+                self._evict()
+                self._save()
+        if tmp_path is not None:
+            # another thread stored the same object meanwhile
+            os.remove(tmp_path)
+
+    def _drop(self, digest):
+        '''forgets an object and the urls served by it'''
+        self.objects.pop(digest, None)
+        try:
+            os.remove(self._object_path(digest))
+        except OSError:
+            pass
+        for url in [url for url, entry in self.urls.items()
+                    if entry['digest'] == digest]:
+            del self.urls[url]
+
+    def _evict(self):
+        '''drops least recently used objects until the cache fits'''
+        total = sum(obj['size'] for obj in self.objects.values())
+        by_age = sorted(self.objects.items(), key=lambda item: item[1]['used'])
+        for digest, obj in by_age:
+            if total <= self.max_size:
+                break
+            total -= obj['size']
+            self._drop(digest)
@@ -0,0 +1,170 @@
+'''
+Integrity checks computed while a download streams.
+
+A StreamHasher is fed every chunk as it is written to the local file.  Bytes
+that extend the hashed prefix are hashed straight from memory.  Segmented
+downloads write out of order, so a chunk beyond the prefix is only noted;
+whichever writer next finds the hasher idle reads the noted bytes back from
+the (still cached) file, a block at a time, until the prefix catches up.  No
+writer ever waits for another to finish hashing.
+
+Checksums are given as 'sha256:<hex>', 'sha1:<hex>', 'md5:<hex>' or
+'size:<bytes>'; a bare integer is taken as the expected size.  A bare
+algorithm name ('sha256') computes the digest without checking it.
+'''
+
+import hashlib
+import numbers
+import os
+import threading
+
+ALGORITHMS = ('sha256', 'sha1', 'md5')
+READ_SIZE = 1024 * 1024  # bytes read back from disk per catch up step
+
+
+class ChecksumError(ValueError):
+    '''raised when a finished download does not match its checksum'''
+
+
+def parse_checksum(checksum):
+    '''splits a checksum into (algorithm, expected value)'''
+    if isinstance(checksum, numbers.Integral):
+        return 'size', int(checksum)
+    algo, _, value = str(checksum).partition(':')
+    algo = algo.strip().lower()
+    value = value.strip().lower()
+    if algo == 'size' and value.isdigit():
+        return algo, int(value)
+    if algo in ALGORITHMS and not value:
+        return algo, None
+    if algo not in ALGORITHMS or not value:
+        raise ValueError("unsupported checksum %r, expected sha256:, sha1:, "
+                         "md5: or size:" % (checksum,))
+    return algo, value
+
+
+class StreamHasher(object):
+    '''
+    >>> hasher = StreamHasher('sha256:9f86d081...')
+    >>> hasher.update(0, b'te', 'file.txt')
+    >>> hasher.update(2, b'st', 'file.txt')
+    >>> hasher.verify('file.txt')
+    '''
+
+    def __init__(self, checksum):
+        self.algo, self.expected = parse_checksum(checksum)
+        self.lock = threading.Lock()
+        self.busy = False
+        self._reset()
+
+    def _reset(self):
+        self.hash = None
+        if self.algo != 'size':
+            self.hash = hashlib.new(self.algo)
+        self.pos = 0
+        # end -> start of written ranges beyond the hashed prefix
+        self.written = {}
+
+    def rewind(self, offset):
+        '''
+        declares the first offset bytes of the local file already written,
+        starting the hash over if it had got further than that
+        '''
+        with self.lock:
+            if offset < self.pos:
+                self._reset()
+            if offset > self.pos:
+                self._mark(self.pos, offset)
+
+    def mark(self, start, stop):
+        '''notes that bytes start to stop (exclusive) are on disk'''
+        with self.lock:
+            self._mark(start, stop)
+
+    def _mark(self, start, stop):
+        start = self.written.pop(start, start)
+        self.written[stop] = start
+
+    def _covered(self):
+        '''end of the written bytes contiguous with the hashed prefix'''
+        end = self.pos
+        for stop, start in sorted(self.written.items(),
+                                  key=lambda item: item[1]):
+            if start > end:
+                break
+            end = max(end, stop)
+        return end
+
+    def _advance(self, pos):
+        self.pos = pos
+        for stop in [stop for stop in self.written if stop <= pos]:
+            del self.written[stop]
+
+    def update(self, offset, data, path):
+        '''hashes a chunk just written at offset of path'''
+        if self.hash is None:
+            return
+        with self.lock:
+            inline = offset == self.pos and not self.busy
+            if inline:
+                self.busy = True
+            else:
+                self._mark(offset, offset + len(data))
+        if inline:
+            try:
+                self.hash.update(data)
+            finally:
+                with self.lock:
+                    self._advance(offset + len(data))
+                    self.busy = False
+        self.catch_up(path)
+
+    def catch_up(self, path):
+        '''
+        hashes one block of written bytes that the prefix has reached,
+        returning False when there was nothing to do or another thread is
+        already hashing
+        '''
+        with self.lock:
+            if self.busy or self.hash is None:
+                return False
+            start = self.pos
+            stop = min(self._covered(), start + READ_SIZE)
+            if stop <= start:
+                return False
+            self.busy = True
+        data = b''
+        try:
+            with open(path, 'rb') as file_hndl:
+                file_hndl.seek(start)
+                data = file_hndl.read(stop - start)
+            self.hash.update(data)
+        finally:
+            with self.lock:
+                self._advance(start + len(data))
+                self.busy = False
+        return bool(data)
+
+    def verify(self, path, size=None):
+        '''
+        hashes what is left of path and returns the digest (or size),
+        raising ChecksumError if it is not the expected one.  Passing size
+        declares that all size bytes were hashed in flight and path holds
+        something else, as for a decoded download.
+        '''
+        in_flight = size is not None
+        if not in_flight:
+            size = os.path.getsize(path)
+        if self.hash is None:
+            actual = size
+        else:
+            if not in_flight:
+                self.mark(self.pos, size)
+                while self.pos < size and self.catch_up(path):
+                    pass
+            actual = self.hash.hexdigest()
+        if self.expected is not None and actual != self.expected:
+            raise ChecksumError("%s failed verification: expected %s %s, "
+                                "got %s" % (path, self.algo, self.expected,
+                                            actual))
+        return actual
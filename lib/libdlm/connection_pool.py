@@ -0,0 +1,303 @@
+'''
+Keep-alive HTTP connection pool shared by the Downloader threads.
+
+Connections are keyed by (scheme, host, port, proxy).  A connection is
+handed back to the pool once its response body has been read to the end, and
+is reused by the next request to the same origin until it has sat idle for
+longer than idle_timeout.  At most size idle connections are kept per
+origin (see libdlm.idle_pool).  When resolver, a libdlm.dns_cache.DNSCache,
+is given new connections are CachedHTTPConnection / CachedHTTPSConnection,
+which look their host up through it.
+
+Requests go through the proxies urllib would use (http_proxy, https_proxy
+and no_proxy from the environment, unless proxies is given): plain http is
+sent to the proxy as an absolute url, https is tunnelled with CONNECT.
+Redirects are followed, and the Authorization header is only sent on
+to the same scheme, host and port.
+'''
+
+import base64
+import logging
+import socket
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+try:
+    import urllib2
+except ImportError:
+    import urllib.request as urllib2
+try:
+    from urlparse import urlsplit, urljoin
+except ImportError:
+    from urllib.parse import urlsplit, urljoin
+try:
+    from urllib import getproxies, proxy_bypass_environment
+except ImportError:
+    from urllib.request import getproxies, proxy_bypass_environment
+from libdlm.idle_pool import IdlePool
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+# raised when the server closed a kept-alive connection we tried to reuse
+STALE_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest,
+                socket.error)
+
+
+def basic_auth(username, password):
+    '''returns the value of a basic Authorization header'''
+    token = ('%s:%s' % (username, password)).encode('utf-8')
+    return 'Basic %s' % base64.b64encode(token).decode('ascii')
+
+
+def origin(url):
+    '''(scheme, host, port) of url, what credentials are scoped to'''
+    parts = urlsplit(url)
+    return (parts.scheme, parts.hostname,
+            parts.port or DEFAULT_PORTS.get(parts.scheme))
+
+
+def proxy_for(proxies, scheme, host):
+    '''
+    the proxy url requests to host go through, or None, from proxies as
+    getproxies() returns them
+    '''
+    proxy = proxies.get(scheme)
+    if not proxy:
+        return None
+    try:
+        bypass = proxy_bypass_environment(host, proxies)
+    except TypeError:
+        # python 2 only reads no_proxy from the environment
+        bypass = proxy_bypass_environment(host)
+    if bypass:
+        return None
+    if '://' not in proxy:
+        proxy = 'http://%s' % proxy
+    return proxy
+
+
+def proxy_headers(proxy):
+    '''the Proxy-Authorization for the credentials in a proxy url'''
+    parts = urlsplit(proxy)
+    if parts.username is None:
+        return {}
+    return {'Proxy-Authorization':
+            basic_auth(parts.username, parts.password or '')}
+
+
+def _connect(conn):
+    '''opens conn's socket through its resolver, tunnelling when proxied'''
+    conn.sock = conn.resolver.create_connection(
+        (conn.host, conn.port), conn.timeout, conn.source_address)
+    try:
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except socket.error:
+        # not every socket type takes TCP options
+        pass
+    if conn._tunnel_host:
+        conn._tunnel()
+
+
+class CachedHTTPConnection(httplib.HTTPConnection):
+    '''HTTPConnection looking its host up through a DNSCache'''
+
+    def __init__(self, host, port=None, resolver=None, **kwargs):
+        httplib.HTTPConnection.__init__(self, host, port, **kwargs)
+        self.resolver = resolver
+
+    def connect(self):
+        _connect(self)
+
+
+class CachedHTTPSConnection(httplib.HTTPSConnection):
+    '''HTTPSConnection looking its host up through a DNSCache'''
+
+    def __init__(self, host, port=None, resolver=None, **kwargs):
+        httplib.HTTPSConnection.__init__(self, host, port, **kwargs)
+        self.resolver = resolver
+
+    def connect(self):
+        _connect(self)
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=self._tunnel_host or self.host)
+
+
+class PooledResponse(object):
+    '''
+    Wraps an httplib response with the parts of the urllib2 response API used
+    by FileDownloader, returning the connection to the pool once the body has
+    been consumed.
+    '''
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amt)
+        if not data or self.response.isclosed():
+            self._release()
+        return data
+
+    def readinto(self, buf):
+        if not hasattr(self.response, 'readinto'):
+            data = self.read(len(buf))
+            buf[:len(data)] = data
+            return len(data)
+        count = self.response.readinto(buf)
+        if not count or self.response.isclosed():
+            self._release()
+        return count
+
+    def close(self):
+        '''releases the connection, dropping it if the body is unread'''
+        if self.conn is None:
+            return
+        if self.response.length == 0:
+            self.response.read()
+        if self.response.isclosed():
+            self._release()
+        else:
+            self.pool.discard(self.conn)
+            self.conn = None
+
+    def _release(self):
+        if self.conn is not None:
+            self.pool.put(self.key, self.conn,
+                          reusable=not self.response.will_close)
+            self.conn = None
+
+
+class ConnectionPool(IdlePool):
+    '''
+    Thread safe, per-host pool of keep-alive HTTP(S) connections
+
+    >>> pool = ConnectionPool(size=4, idle_timeout=30)
+    >>> response = pool.request('http://example.com/file.zip')
+    >>> data = response.read()
+    >>> pool.stats()
+    {'hits': 0, 'misses': 1, 'discarded': 0, 'idle': 1}
+    '''
+
+    def __init__(self, size=10, idle_timeout=60.0, resolver=None,
+                 proxies=None):
+        IdlePool.__init__(self, size, idle_timeout, resolver)
+        if proxies is None:
+            proxies = getproxies()
+        # scheme -> proxy url, and 'no' -> hosts reached directly
+        self.proxies = proxies
+
+    def _connect(self, key, timeout):
+        scheme, host, port, proxy = key
+        conn_host, conn_port = host, port
+        if proxy is not None:
+            _, conn_host, conn_port = origin(proxy)
+        if self.resolver is not None:
+            conn_class = CachedHTTPConnection
+            if scheme == 'https':
+                conn_class = CachedHTTPSConnection
+            conn = conn_class(conn_host, conn_port, self.resolver,
+                              timeout=timeout)
+        elif scheme == 'https':
+            conn = httplib.HTTPSConnection(conn_host, conn_port,
+                                           timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(conn_host, conn_port,
+                                          timeout=timeout)
+        if proxy is not None and scheme == 'https':
+            conn.set_tunnel(host, port, proxy_headers(proxy))
+        return conn
+
+    def _reuse(self, conn, timeout):
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+
+    def _alive(self, conn):
+        return conn.sock is not None
+
+    def _send(self, key, method, path, headers, timeout):
+        conn, reused = self.get(key, timeout)
+        try:
+            conn.request(method, path, headers=headers)
+            return conn, conn.getresponse()
+        except STALE_ERRORS:
+            self.discard(conn)
+            if not reused:
+                raise
+        # the server dropped an idle connection, try once on a new one
+        conn, _ = self.get(key, timeout, fresh=True)
+        try:
+            conn.request(method, path, headers=headers)
+            return conn, conn.getresponse()
+        except Exception:
+            self.discard(conn)
+            raise
+
+    def request(self, url, method='GET', headers=None, timeout=120.0,
+                auth=None):
+        '''
+        Issues a request, following redirects, and returns a PooledResponse.
+        Error statuses raise urllib2.HTTPError like urllib2.urlopen does.
+        '''
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', 'libdlm')
+        if auth:
+            headers['Authorization'] = basic_auth(*auth)
+
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            proxy = proxy_for(self.proxies, parts.scheme, parts.hostname)
+            key = origin(url) + (proxy,)
+            path = parts.path or '/'
+            if parts.query:
+                path = '%s?%s' % (path, parts.query)
+            sent = headers
+            if proxy is not None and parts.scheme == 'http':
+                # a plain http proxy takes the whole url
+                path = '%s://%s%s' % (parts.scheme, parts.netloc, path)
+                sent = dict(headers, **proxy_headers(proxy))
+
+            conn, response = self._send(key, method, path, sent, timeout)
+            wrapped = PooledResponse(self, key, conn, response, url)
+            location = response.getheader('Location')
+            if response.status in REDIRECT_CODES and location:
+                wrapped.read()
+                target = urljoin(url, location)
+                if origin(target) != origin(url):
+                    # credentials are not handed to another origin
+                    headers.pop('Authorization', None)
+                url = target
+                if response.status == 303:
+                    method = 'GET'
+                continue
+            if response.status >= 400:
+                wrapped.read()
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, None)
+            return wrapped
+
+        raise urllib2.HTTPError(url, response.status, 'Too many redirects',
+                                response.msg, None)
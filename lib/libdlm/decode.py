@@ -0,0 +1,337 @@
+'''
+Streaming decompression and tar extraction of downloads.
+
+A StreamDecoder stands in for the FileSink of a download: the compressed
+bytes coming off the socket are decompressed as they arrive and only the
+decoded data reaches the disk, written to a file or, for tar archives,
+extracted member by member into a directory on a helper thread.  gzip,
+bzip2 and xz (where the lzma module is available) are supported, including
+files made of several concatenated streams.  Each decompress call is
+capped at OUT_SIZE bytes of output so a small chunk that inflates hugely is
+never held in memory at once.
+
+Nothing but the decoder's state records how far decoding got, so a
+transfer can only pick up where it stopped (from consumed, the compressed
+byte offset) while the decoder is still alive, as it is across the retries
+of one download.  A download started again from scratch decodes from the
+first byte.
+'''
+
+import bz2
+import logging
+import os
+import posixpath
+import tarfile
+import threading
+import zlib
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import lzma
+except ImportError:
+    # python 2 without backports.lzma
+    lzma = None
+from libdlm.file_sink import unshare
+
+
+def as_bytes(data):
+    '''copies a chunk to bytes, bytes(view) being its repr on python 2'''
+    return data.tobytes() if isinstance(data, memoryview) else data
+
+LOG = logging.getLogger(__name__)
+OUT_SIZE = 1024 * 1024
+# suffix -> (codec, suffix of the decoded file); '' is an uncompressed tar
+SUFFIXES = (
+    ('.tar.gz', 'gz', '.tar'), ('.tgz', 'gz', '.tar'),
+    ('.tar.bz2', 'bz2', '.tar'), ('.tbz2', 'bz2', '.tar'),
+    ('.tbz', 'bz2', '.tar'), ('.tar.xz', 'xz', '.tar'),
+    ('.txz', 'xz', '.tar'), ('.gz', 'gz', ''), ('.bz2', 'bz2', ''),
+    ('.xz', 'xz', ''), ('.tar', '', '.tar'),
+)
+
+
+def detect(name):
+    '''
+    returns (codec, decoded name) for a file name; codec is None when the
+    name has no known suffix and '' for an uncompressed tar
+    '''
+    lower = name.lower()
+    for suffix, codec, decoded in SUFFIXES:
+        if lower.endswith(suffix):
+            return codec, name[:-len(suffix)] + decoded
+    return None, name
+
+
+def decompressor(codec):
+    '''a new decompressor object for one stream of codec'''
+    if codec == 'gz':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if codec == 'bz2':
+        return bz2.BZ2Decompressor()
+    if codec == 'xz':
+        if lzma is None:
+            raise ValueError('xz decoding needs the lzma module')
+        return lzma.LZMADecompressor()
+    raise ValueError('unknown codec %r' % codec)
+
+
+def inflate(dec, data):
+    '''yields the output of dec for data in blocks of at most OUT_SIZE'''
+    if hasattr(dec, 'unconsumed_tail'):
+        # zlib
+        while data:
+            out = dec.decompress(data, OUT_SIZE)
+            data = dec.unconsumed_tail
+            if out:
+                yield out
+    elif hasattr(dec, 'needs_input'):
+        # bz2 and lzma on python 3.5+
+        out = dec.decompress(data, OUT_SIZE)
+        while True:
+            if out:
+                yield out
+            if dec.eof or dec.needs_input:
+                break
+            out = dec.decompress(b'', OUT_SIZE)
+    else:
+        out = dec.decompress(data)
+        if out:
+            yield out
+
+
+def ended(dec):
+    '''True once dec has reached the end of its stream'''
+    eof = getattr(dec, 'eof', None)
+    if eof is not None:
+        return eof
+    # python 2 only sets unused_data aside once data follows the end
+    if dec.unused_data:
+        return True
+    if hasattr(dec, 'unconsumed_tail'):
+        # zlib: a byte fed to a copy past the end is left unused
+        probe = dec.copy()
+        try:
+            probe.decompress(b'\0')
+        except zlib.error:
+            return False
+        return probe.unused_data == b'\0'
+    # bz2 refuses more input once its stream has ended
+    try:
+        dec.decompress(b'')
+    except EOFError:
+        return True
+    return False
+
+
+def safe_member(member):
+    '''True for tar members that stay inside the extraction directory'''
+    name = posixpath.normpath(member.name)
+    if name.startswith('/') or name == '..' or name.startswith('../'):
+        return False
+    if member.issym() or member.islnk():
+        target = member.linkname
+        if member.issym():
+            target = posixpath.join(posixpath.dirname(name), target)
+        target = posixpath.normpath(target)
+        if target.startswith('/') or target == '..' or \
+           target.startswith('../'):
+            return False
+    return True
+
+
+class Pipe(object):
+    '''
+    bounded stream of bytes written by the download thread and read by
+    tarfile on the extraction thread
+    '''
+
+    def __init__(self, depth=16):
+        self.chunks = queue.Queue(depth)
+        self.buf = b''
+        self.eof = False
+        self.error = None
+
+    def write(self, data):
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.chunks.put(as_bytes(data), timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        self.write(b'')
+
+    def fail(self, err):
+        '''
+        stops the writer with err once the reader has given up, or the
+        reader once the writer has
+        '''
+        self.error = err
+        self.drain()
+        try:
+            self.chunks.put_nowait(b'')
+        except queue.Full:
+            pass
+
+    def drain(self):
+        try:
+            while True:
+                self.chunks.get_nowait()
+        except queue.Empty:
+            pass
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            chunk = self.chunks.get()
+            if not chunk:
+                self.eof = True
+            self.buf += chunk
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+
+class StreamDecoder(object):
+    '''
+    >>> decoder = StreamDecoder('gz', '/srv/data.csv')
+    >>> decoder.write_at(0, compressed_chunk)
+    >>> decoder.finish()
+    >>> decoder.consumed
+    1048576
+    '''
+
+    def __init__(self, codec, path, extract=False):
+        self.codec = codec
+        self.path = path
+        self.extract = extract
+        self.consumed = 0
+        self.dec = None
+        self.started = False
+        self.file = None
+        self.pipe = None
+        self.thread = None
+        self.members = []
+        self.error = None
+        self._open()
+
+    def _open(self):
+        if not self.extract:
+            unshare(self.path)
+            self.file = open(self.path, 'wb')
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.pipe = Pipe()
+        self.thread = threading.Thread(target=self._untar, args=(self.pipe,),
+                                       name='untar %s' % self.path)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _untar(self, pipe):
+        try:
+            with tarfile.open(fileobj=pipe, mode='r|') as tar:
+                for member in tar:
+                    if not safe_member(member):
+                        raise ValueError('refusing to extract %s' %
+                                         member.name)
+                    if not (member.isfile() or member.isdir() or
+                            member.issym() or member.islnk()):
+                        LOG.debug('skipping special file %s' % member.name)
+                        continue
+                    if hasattr(tarfile, 'data_filter'):
+                        tar.extract(member, self.path, filter='data')
+                    else:
+                        tar.extract(member, self.path)
+                    self.members.append(member.name)
+            # the zero padding after the end of the archive
+            while pipe.read(OUT_SIZE):
+                pass
+        except Exception as err:
+            self.error = err
+            pipe.fail(err)
+
+    def _emit(self, data):
+        if self.pipe is not None:
+            self.pipe.write(data)
+        else:
+            self.file.write(data)
+
+    def write_at(self, offset, data):
+        '''decodes a chunk of the compressed stream, which must be next'''
+        if offset != self.consumed:
+            raise ValueError('decoding needs data in order: got offset %d, '
+                             'expected %d' % (offset, self.consumed))
+        self.consumed += len(data)
+        data = as_bytes(data)
+        while data:
+            if not self.codec:
+                self._emit(data)
+                return
+            if self.dec is None:
+                if self.started and not data.strip(b'\0'):
+                    # zero padding after the last stream
+                    return
+                self.dec = decompressor(self.codec)
+                self.started = True
+            for out in inflate(self.dec, data):
+                self._emit(out)
+            data = b''
+            if ended(self.dec):
+                # more streams may follow, concatenated
+                data = self.dec.unused_data
+                self.dec = None
+
+    def truncate(self, size=0):
+        '''throws away everything decoded so far to start over'''
+        self.abort()
+        self.consumed = 0
+        self.dec = None
+        self.started = False
+        self.members = []
+        self.error = None
+        self._open()
+
+    def close(self):
+        '''a transfer ended; the decoder stays open for a resume'''
+        if self.file is not None:
+            self.file.flush()
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def finish(self):
+        '''
+        completes the output, raising ValueError if the compressed stream
+        or archive was cut short or could not be decoded
+        '''
+        if self.codec and (self.dec is not None or not self.started):
+            self.abort()
+            raise ValueError('%s: compressed stream ended early' % self.path)
+        if self.pipe is not None:
+            try:
+                self.pipe.close()
+            except Exception:
+                pass
+            self.thread.join()
+            if self.error is not None:
+                raise ValueError('%s: %s' % (self.path, self.error))
+        if self.file is not None:
+            self.file.close()
+
+    def abort(self):
+        '''stops decoding, leaving whatever was written'''
+        if self.pipe is not None:
+            self.pipe.fail(ValueError('decoding aborted'))
+            self.thread.join()
+            self.pipe = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
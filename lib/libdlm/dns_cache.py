@@ -0,0 +1,146 @@
+'''
+DNS resolution cache shared by the connection pools of a manager.
+
+Lookups are cached by (host, port, family, socket type) for ttl seconds and
+failed lookups, raised as socket.gaierror, for negative_ttl seconds, so a
+burst of workers hitting a handful of hosts costs one getaddrinfo per host
+rather than one per connection.  getaddrinfo does not report the TTL of
+the records it returns, so the cache applies its own.  When several threads
+miss on the same name at once only one of them asks the resolver; the
+others wait for its answer.  A name whose cached addresses all refuse a
+connection is forgotten so the next connection looks it up again.  At most
+max_entries names are kept, the oldest lookups being evicted first.
+'''
+
+import collections
+import logging
+import socket
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# what socket.create_connection takes as "no timeout given"
+DEFAULT_TIMEOUT = getattr(socket, '_GLOBAL_DEFAULT_TIMEOUT', object())
+
+
+class DNSCache(object):
+    '''
+    Thread safe getaddrinfo cache with positive and negative TTLs
+
+    >>> resolver = DNSCache(ttl=60, negative_ttl=5)
+    >>> sock = resolver.create_connection(('example.com', 80), timeout=30)
+    >>> resolver.stats()
+    {'hits': 0, 'misses': 1, 'negative_hits': 0, 'entries': 1}
+    '''
+
+    def __init__(self, ttl=60.0, negative_ttl=5.0, max_entries=1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> (expiry, addrinfo list or the gaierror args)
+        self.entries = collections.OrderedDict()
+        # key -> Event set once the lookup in progress has finished
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def _cached(self, key, now):
+        '''returns the live entry for key, counting the hit, or None'''
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self.entries[key]
+            return None
+        if isinstance(entry[1], list):
+            self.hits += 1
+        else:
+            self.negative_hits += 1
+        return entry
+
+    def resolve(self, host, port, family=0, type=socket.SOCK_STREAM):
+        '''
+        returns the getaddrinfo() list for host and port, raising
+        socket.gaierror (from the cache too) when the name does not resolve
+        '''
+        key = (host, port, family, type)
+        while True:
+            with self.lock:
+                entry = self._cached(key, time.time())
+                if entry is None:
+                    waiting = self.pending.get(key)
+                    if waiting is None:
+                        self.misses += 1
+                        self.pending[key] = threading.Event()
+                        break
+            if entry is not None:
+                if isinstance(entry[1], list):
+                    return entry[1]
+                raise socket.gaierror(*entry[1])
+            # another thread is looking the name up, use its answer
+            waiting.wait()
+
+        try:
+            infos = socket.getaddrinfo(host, port, family, type)
+            entry = (time.time() + self.ttl, list(infos))
+        except socket.gaierror as err:
+            entry = (time.time() + self.negative_ttl, err.args)
+        finally:
+            with self.lock:
+                if entry is not None and entry[0] > time.time():
+                    self.entries.pop(key, None)
+                    self.entries[key] = entry
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+                self.pending.pop(key).set()
+        if isinstance(entry[1], list):
+            return entry[1]
+        LOG.debug('unable to resolve %s: %s' % (host, entry[1]))
+        raise socket.gaierror(*entry[1])
+
+    def forget(self, host, port=None):
+        '''drops the cached lookups of host (for port only, if given)'''
+        with self.lock:
+            for key in list(self.entries):
+                if key[0] == host and port in (None, key[1]):
+                    del self.entries[key]
+
+    def create_connection(self, address, timeout=DEFAULT_TIMEOUT,
+                          source_address=None):
+        '''socket.create_connection resolving the host through the cache'''
+        host, port = address[:2]
+        err = None
+        for family, socktype, proto, _, sockaddr in self.resolve(host, port):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if timeout is not DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except socket.error as conn_err:
+                err = conn_err
+                if sock is not None:
+                    sock.close()
+        # the host may have moved, look it up again next time
+        self.forget(host, port)
+        if err is None:
+            err = socket.error('getaddrinfo returned no addresses')
+        raise err
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        '''returns the lookup counters and current number of cached names'''
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'negative_hits': self.negative_hits,
+                    'entries': len(self.entries)}
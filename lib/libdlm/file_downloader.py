@@ -6,23 +6,119 @@ Original GitHub: https://github.com/bantonj/fileDownloader
 '''
 
 import cgi
+import collections
 import ftplib
 import logging
 import os
 import re
-import urllib
 try:
     import urllib2
 except ImportError:
     import urllib.request as urllib2
-try:
-    import urlparse
-except ImportError:
-    from urllib.parse import urlparse
 import socket
+import threading
+import time
 from furl import furl
+from libdlm.checksum import StreamHasher
+from libdlm.decode import StreamDecoder, detect
+from libdlm.connection_pool import ConnectionPool
+from libdlm.file_sink import FileSink
+from libdlm.ftp_pool import FTPPool
+from libdlm.mirrors import Mirror, MirrorSet
+from libdlm.progress import ProgressTracker
+from libdlm.retry import RetryPolicy
+from libdlm.throttle import Throttle
+
+LOG = logging.getLogger(__name__)
+
+# schemes spoken through the ConnectionPool
+HTTP_SCHEMES = ('http', 'https')
+# statuses of a server that does not do HEAD, rather than lack the file
+HEAD_UNSUPPORTED = (405, 501)
+
+
+def disposition_file_name(disposition):
+    '''returns the filename parameter of a Content-Disposition header'''
+    _, params = cgi.parse_header(disposition or '')
+    return params.get('filename')
+
+
+def url_file_name(url):
+    '''derives a local filename from the path of a furl url'''
+    LOG.debug("Server didn't provide filename, resorting to url")
+    try:
+        return url.path.segments[-1]
+    except Exception as err:
+        LOG.error("Unable to determine filename from url")
 
-LOG = None
+    return re.sub('/', '_', str(url.url))
+
+
+class Segment(object):
+    '''inclusive byte range of the remote file fetched over one connection'''
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.pos = start
+        self.retries = 0
+        self.error = None
+
+    @property
+    def remaining(self):
+        '''number of bytes of the range not yet written'''
+        return self.end - self.pos + 1
+
+
+class ChunkReader(object):
+    '''
+    Reads a response into a reusable buffer with readinto instead of
+    allocating a new bytes object per read.  The chunk size doubles while
+    full reads complete in well under target seconds and halves when a read
+    takes much longer, staying within [min_size, max_size].
+
+    Chunks are memoryviews over that buffer, valid until the next read.
+    Consumers write them out or hash them as they are; one that needs to
+    keep or parse the data must copy it with .tobytes(), since bytes(view)
+    is the view's repr on python 2.
+    '''
+    target = 0.1
+
+    def __init__(self, min_size=8192, max_size=1024 * 1024):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.size = min_size
+        self.buf = bytearray(min_size)
+        self.view = memoryview(self.buf)
+
+    def read(self, url_obj, limit=None):
+        '''
+        returns a memoryview over the next chunk, empty at end of stream,
+        which the following read overwrites
+        '''
+        size = self.size
+        if limit is not None:
+            size = min(size, limit)
+        start = time.time()
+        readinto = getattr(url_obj, 'readinto', None)
+        if readinto is not None:
+            count = readinto(self.view[:size]) or 0
+        else:
+            data = url_obj.read(size)
+            count = len(data)
+            self.view[:count] = data
+        chunk = self.view[:count]
+        self._adapt(count == self.size, time.time() - start)
+        return chunk
+
+    def _adapt(self, filled, elapsed):
+        if filled and elapsed < self.target / 2 and self.size < self.max_size:
+            self.size = min(self.size * 2, self.max_size)
+            if self.size > len(self.buf):
+                self.buf = bytearray(self.size)
+                self.view = memoryview(self.buf)
+        elif elapsed > self.target * 2 and self.size > self.min_size:
+            self.size = max(self.size // 2, self.min_size)
 
 
 class FileDownloader(object):
@@ -54,11 +150,93 @@ class FileDownloader(object):
     Resume
     >>> downloader = FileDownloader('http://example.com/file.zip')
     >>> downloader.resume()
+
+    HTTP files of at least two min_segment_size chunks are split into up to
+    max_segments byte ranges which are fetched concurrently.  Servers that do
+    not honour Range requests are downloaded over a single stream instead.
+
+    HTTP(S) requests go through pool, a ConnectionPool, so connections to the
+    same host are kept alive and reused.  A private pool is created when
+    none is given.
+
+    FTP transfers go through ftp_pool, a libdlm.ftp_pool.FTPPool of logged
+    in sessions, in the same way.  Large FTP files are split into at most
+    ftp_max_segments REST offsets, each read on its own session, since
+    servers often cap the connections per client.
+
+    The remote size, filename, range support, ETag and Last-Modified are
+    resolved once by probe() and cached, so a download costs one HEAD and
+    the GET(s) for the data.  Over FTP, SIZE and MDTM stand in for the HEAD.
+
+    download() and resume() call callback with a libdlm.progress.Progress
+    event at most every progress_interval seconds (or progress_bytes bytes)
+    and once more when the transfer ends.  If a ProgressMonitor is given the
+    download's tracker is registered with it while running.
+
+    Segmented downloads call on_range(start, end, validator) as each byte
+    range reaches the local file.  Passing those ranges back as done_ranges,
+    with the validator (ETag or Last-Modified) they were written under,
+    skips them on a later download as long as the remote file is unchanged.
+
+    Reads are rate limited by throttle, a libdlm.throttle.Throttle holding the
+    global and per-host limits, and by bucket, an optional TokenBucket for
+    this download alone.
+
+    Data is written through a libdlm.file_sink.FileSink with positional
+    writes.  Segmented downloads preallocate the local file to its full size
+    and every segment writes into its own offset of the one open file.
+    Single stream downloads are not preallocated, so the size of a partial
+    file still tells resume() where to carry on.
+
+    If checksum is given ('sha256:<hex>', 'sha1:<hex>', 'md5:<hex>' or an
+    expected size) the data is hashed as it is written and download() or
+    resume() raise libdlm.checksum.ChecksumError when the finished file does
+    not match.  The digest of the finished file is left in digest as
+    '<algorithm>:<hex>'; pass a bare algorithm name to compute one without
+    checking it.
+
+    If metrics, a libdlm.metrics.Metrics registry, is given the download
+    records its time to first byte, duration, rate, bytes received, retries
+    and the bytes it had to fetch again.
+
+    Failed transfers are retried as retry_policy, a libdlm.retry.RetryPolicy,
+    allows: only errors it deems transient, up to its retries, after a
+    jittered exponential backoff.  Each retry picks up where the transfer
+    stopped, resuming a single stream from the local file size and a
+    segmented download from the byte ranges already written.  By default
+    the policy allows retries attempts.
+
+    With decode, True/'auto' to go by the file name or a codec name ('gz',
+    'bz2', 'xz'), the file is decompressed by a libdlm.decode.StreamDecoder
+    as it streams in and only the decoded file, named without the
+    compression suffix, is written.  With extract as well a tar archive is
+    unpacked into the local directory instead, which local_file_name then
+    names.  Decoded downloads use a single stream; retries resume it from
+    the compressed offset reached, and checksums apply to the compressed
+    data.
+
+    mirrors lists other urls serving the same file.  If url cannot be
+    reached the first mirror that can takes its place.  A segmentable file
+    is then cut into smaller pieces which max_segments connections take in
+    turn, each from the mirror a libdlm.mirrors.MirrorSet expects to serve
+    it soonest, so the faster mirrors end up serving more of the file.
+    Mirrors are probed in parallel first and skipped if they report another
+    size or no range support.  A mirror whose response stalls for
+    stall_timeout seconds or that keeps failing is dropped and its pieces
+    go to the others.  A single stream moves to the next mirror when it is
+    retried.  username and password are used for every mirror.
     '''
 
     def __init__(self, url, local_file_dir=None, local_file_name=None,
                  username=None, password=None, timeout=120.0, retries=5,
-                 logger=None, max_segments=10):
+                 logger=None, max_segments=10, min_segment_size=1024 * 1024,
+                 pool=None, min_chunk_size=8192, max_chunk_size=1024 * 1024,
+                 progress_interval=0.5, progress_bytes=None, monitor=None,
+                 done_ranges=None, validator=None, on_range=None,
+                 throttle=None, bucket=None, checksum=None, metrics=None,
+                 retry_policy=None, ftp_pool=None, ftp_max_segments=4,
+                 decode=None, extract=False, mirrors=None,
+                 stall_timeout=10.0):
         '''Note that auth argument expects a tuple, ('username','password')'''
         global LOG
         if logger:
@@ -76,12 +254,63 @@ class FileDownloader(object):
         self.password = password
         self.timeout = timeout
         self.retries = retries
+        if retry_policy is None:
+            retry_policy = RetryPolicy(retries)
+        self.retry_policy = retry_policy
         self.curretry = 0
         self.cur = 0
-        try:
-            self.url_file_size = self.get_url_file_size()
-        except urllib2.HTTPError:
-            self.url_file_size = None
+        # ranges written by segments so far, and whether they are in use
+        self.written = []
+        self.segmented = False
+        self.max_segments = max_segments
+        self.ftp_max_segments = ftp_max_segments
+        self.min_segment_size = min_segment_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.progress_interval = progress_interval
+        self.progress_bytes = progress_bytes
+        self.monitor = monitor
+        self.tracker = None
+        self.on_range = on_range
+        if throttle is None:
+            throttle = Throttle()
+        self.throttle = throttle
+        self.bucket = bucket
+        self.metrics = metrics
+        self.started = None
+        self.first_byte = None
+        self.received = 0
+        self.hasher = None
+        self.digest = None
+        if checksum is not None:
+            self.hasher = StreamHasher(checksum)
+        self.lock = threading.Lock()
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+        if ftp_pool is None:
+            ftp_pool = FTPPool()
+        self.ftp_pool = ftp_pool
+        self.url_file_size = None
+        self.accepts_ranges = False
+        self.etag = None
+        self.last_modified = None
+        self.probed = False
+        self.stall_timeout = stall_timeout
+        # MirrorSet of url and mirrors, probed on first use
+        self.sources = None
+        self.probe_rtt = None
+        self.mirror_urls = [furl(mirror) for mirror in mirrors or []
+                            if str(furl(mirror)) != str(self.url)]
+        self._probe_sources()
+        self.done_ranges = []
+        if done_ranges and validator == self.validator():
+            self.done_ranges = sorted(tuple(rng) for rng in done_ranges)
+        elif done_ranges:
+            LOG.debug("%s changed since it was journalled, starting over" %
+                      self.url)
+            self._inc('bytes_redownloaded',
+                      sum(end - start + 1 for start, end in done_ranges))
 
         if not local_file_dir:
             self.local_file_dir = os.getcwd()
@@ -97,130 +326,699 @@ class FileDownloader(object):
             self.local_file_name = os.path.join(self.local_file_dir,
                                                 local_file_name)
 
-    def _download_file(self, url_obj, file_obj, callback=None):
-        '''starts the download loop'''
-        self.file_size = self.get_url_file_size()
-        while 1:
+        # compression codec the data is decoded with, None to store it as is
+        self.codec = None
+        self.extract = False
+        self.decoder = None
+        if decode:
+            codec, decoded = detect(os.path.basename(self.local_file_name))
+            if decode not in (True, 'auto'):
+                codec = decode
+            if codec or (codec == '' and extract):
+                self.codec = codec
+                self.extract = extract
+                self.local_file_name = os.path.join(self.local_file_dir,
+                                                    decoded)
+                if extract:
+                    self.local_file_name = self.local_file_dir
+
+    def _download_file(self, url_obj, sink, callback=None):
+        '''starts the download loop, writing each chunk at offset self.cur'''
+        self.file_size = self.url_file_size
+        reader = ChunkReader(self.min_chunk_size, self.max_chunk_size)
+        try:
+            while 1:
+                chunk = self._read(reader, url_obj)
+                if not chunk:
+                    break
+                sink.write_at(self.cur, chunk)
+                self._hash(self.cur, chunk)
+                self._count(len(chunk))
+        finally:
+            url_obj.close()
+            sink.close()
+        if self.url_file_size is not None and self.cur < self.url_file_size:
+            raise socket.error("connection closed with %d bytes outstanding"
+                               % (self.url_file_size - self.cur))
+
+    def _read(self, reader, url_obj, remaining=None, host=None):
+        '''reads the next chunk, kept small enough to throttle smoothly'''
+        limit = self.throttle.max_chunk(host or self.url.host, self.bucket)
+        if remaining is not None:
+            limit = remaining if limit is None else min(limit, remaining)
+        return reader.read(url_obj, limit)
+
+    def _hash(self, offset, chunk):
+        '''feeds a chunk just written at offset to the checksum'''
+        if self.hasher is not None:
+            self.hasher.update(offset, chunk, self.local_file_name)
+
+    def _rewind(self, offset):
+        '''restarts the progress and checksum accounting at offset'''
+        self.tracker.rewind(offset)
+        if self.hasher is not None:
+            self.hasher.rewind(offset)
+
+    def _verify(self):
+        '''raises ChecksumError unless the local file matches the checksum'''
+        if self.hasher is not None:
+            size = None
+            if self.decoder is not None:
+                # the compressed data was all hashed in flight
+                size = self.decoder.consumed
+            actual = self.hasher.verify(self.local_file_name, size)
+            if self.hasher.algo != 'size':
+                self.digest = '%s:%s' % (self.hasher.algo, actual)
+
+    def _inc(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.inc(name, value)
+
+    def _begin(self):
+        '''starts the timing of a download or resume'''
+        self.started = time.time()
+        self.first_byte = None
+        self.received = 0
+
+    def _end(self, success):
+        '''records the timing and volume of the transfer that just ended'''
+        if self.metrics is None:
+            return
+        elapsed = time.time() - self.started
+        self.metrics.inc('bytes_downloaded', self.received)
+        self.metrics.observe('download_seconds', elapsed)
+        if success and elapsed > 0:
+            self.metrics.observe('download_rate_bytes',
+                                 self.received / elapsed)
+
+    def _count(self, nbytes, host=None):
+        '''records nbytes written to the local file, then rate limits'''
+        with self.lock:
+            self.cur += nbytes
+            self.received += nbytes
+            first = self.first_byte is None
+            if first:
+                self.first_byte = time.time()
+        if first and self.metrics is not None:
+            self.metrics.observe('ttfb_seconds',
+                                 self.first_byte - self.started)
+        self.tracker.update(nbytes)
+        self.throttle.consume(host or self.url.host, nbytes, self.bucket)
+
+    def _track(self, callback):
+        '''starts progress reporting for a download or resume'''
+        self.tracker = ProgressTracker(str(self.url), self.url_file_size,
+                                       callback, self.progress_interval,
+                                       self.progress_bytes, self.cur)
+        if self.monitor is not None:
+            self.monitor.add(self.tracker)
+
+    def _untrack(self):
+        '''emits the final progress event'''
+        self.tracker.finish()
+        if self.monitor is not None:
+            self.monitor.remove(self.tracker)
+        self.tracker = None
+
+    def _missing_ranges(self):
+        '''returns the inclusive byte ranges not covered by done_ranges'''
+        missing = []
+        pos = 0
+        for start, end in self.done_ranges:
+            if start > pos:
+                missing.append((pos, start - 1))
+            pos = max(pos, end + 1)
+        if pos < self.url_file_size:
+            missing.append((pos, self.url_file_size - 1))
+        return missing
+
+    def _plan_segments(self, pieces=1):
+        '''
+        splits the missing parts of the file into similar byte ranges,
+        pieces per connection
+        '''
+        missing = self._missing_ranges()
+        total = sum(end - start + 1 for start, end in missing)
+        step = max(self.min_segment_size,
+                   -(-total // (self._max_segments() * pieces)))
+        segments = []
+        for start, end in missing:
+            while start <= end:
+                segments.append(Segment(start, min(start + step, end + 1) - 1))
+                start += step
+        return segments
+
+    def validator(self):
+        '''the value that identifies this version of the remote file'''
+        return self.etag or self.last_modified
+
+    def single_stream(self):
+        '''True when download() fetches the file over one stream'''
+        return not self._segmentable()
+
+    def _range_done(self, start, end):
+        if end < start:
+            return
+        with self.lock:
+            self.written.append((start, end))
+        if self.on_range is not None:
+            self.on_range(start, end, self.validator())
+
+    def _max_segments(self):
+        if self.url.scheme == 'ftp':
+            return min(self.max_segments, self.ftp_max_segments)
+        return self.max_segments
+
+    def _segmentable(self):
+        '''True when the file is large enough to be fetched in parallel'''
+        return (self.url.scheme in HTTP_SCHEMES + ('ftp',) and
+                self.codec is None and self._max_segments() > 1 and
+                self.accepts_ranges and bool(self.url_file_size) and
+                self.url_file_size >= 2 * self.min_segment_size)
+
+    def _auth(self):
+        if self.username:
+            return (self.username, self.password)
+        return None
+
+    def _open(self, headers=None, method='GET'):
+        '''opens self.url, going through the connection pools'''
+        if self.url.scheme in HTTP_SCHEMES:
+            return self.pool.request(str(self.url), method, headers,
+                                     self.timeout, self._auth())
+        if self.url.scheme == 'ftp':
+            return self._open_ftp()
+        req = urllib2.Request(str(self.url), headers=headers or {})
+        return urllib2.urlopen(req, timeout=self.timeout)
+
+    def _ftp_target(self):
+        '''(host, port, username, password, path) of self.url'''
+        return (self.url.host, self.url.port, self.username, self.password,
+                str(self.url.path))
+
+    def _open_ftp(self, offset=0):
+        '''starts a RETR of self.url from offset on a pooled session'''
+        host, port, username, password, path = self._ftp_target()
+        return self.ftp_pool.retrieve(host, port, username, password, path,
+                                      offset, self.timeout)
+
+    def _partial(self, url_obj):
+        '''True when url_obj carries the range that was asked for'''
+        return self.url.scheme == 'ftp' or url_obj.getcode() == 206
+
+    def _range_headers(self, start, end=''):
+        '''
+        Range headers for bytes start-end, guarded by If-Range so a file that
+        changed on the server comes back whole instead of as a stale range
+        '''
+        headers = {'Range': 'bytes=%s-%s' % (start, end)}
+        if self.etag or self.last_modified:
+            headers['If-Range'] = self.etag or self.last_modified
+        return headers
+
+    def _open_range(self, segment):
+        '''requests the unwritten part of a segment'''
+        if self.url.scheme == 'ftp':
+            return self._open_ftp(segment.pos)
+        return self._open(self._range_headers(segment.pos, segment.end))
+
+    def _download_segments(self, callback=None):
+        '''fetches the file as concurrent Range requests'''
+        if self.mirror_urls:
+            return self._download_mirrored(callback)
+        self.segmented = False
+        segments = self._plan_segments()
+        if not segments:
+            return True
+        urllib2_obj = self._open_range(segments[0])
+        if not self._partial(urllib2_obj):
+            LOG.debug("%s ignored the Range header, using a single stream" %
+                      self.url.host)
+            self._download_file(urllib2_obj, FileSink(self.local_file_name),
+                                callback=callback)
+            return True
+
+        sink = self._segment_sink(segments)
+        threads = []
+        for segment in segments:
+            url_obj = urllib2_obj if segment is segments[0] else None
+            threads.append(threading.Thread(target=self._fetch_segment,
+                                            args=(segment, sink, url_obj)))
+            threads[-1].daemon = True
+            threads[-1].start()
+        for thread in threads:
+            thread.join()
+        sink.close()
+
+        for segment in segments:
+            if segment.error is not None:
+                raise segment.error
+        return True
+
+    def _segment_sink(self, segments):
+        '''
+        opens the preallocated local file for segments and points the
+        progress and checksum accounting at the bytes they leave out
+        '''
+        self.segmented = True
+        sink = FileSink(self.local_file_name, self.url_file_size,
+                        keep=bool(self.done_ranges))
+        self.cur = self.url_file_size - sum(seg.remaining for seg in segments)
+        self.tracker.rewind(self.cur)
+        if self.hasher is not None:
+            self.hasher.rewind(0)
+            for start, end in self.done_ranges:
+                self.hasher.mark(start, end + 1)
+        return sink
+
+    def _download_mirrored(self, callback=None):
+        '''
+        fetches the file in pieces spread over the mirrors, max_segments
+        at a time
+        '''
+        sources = self._mirror_set()
+        segments = collections.deque(self._plan_segments(pieces=4))
+        if not segments:
+            return True
+        sink = self._segment_sink(segments)
+        errors = []
+        threads = []
+        for _ in range(min(self._max_segments(), len(segments))):
+            threads.append(threading.Thread(
+                target=self._mirror_worker,
+                args=(sources, segments, sink, errors)))
+            threads[-1].daemon = True
+            threads[-1].start()
+        for thread in threads:
+            thread.join()
+        sink.close()
+
+        for segment in segments:
+            if segment.error is not None:
+                raise segment.error
+        if segments:
+            if errors:
+                raise errors[-1]
+            raise socket.error("no mirror left to fetch %s from" % self.url)
+        return True
+
+    def _mirror_worker(self, sources, segments, sink, errors):
+        '''
+        takes pieces off segments until none are left, fetching each from
+        the mirror sources picks and handing the unwritten rest of a failed
+        piece back for another mirror
+        '''
+        reader = ChunkReader(self.min_chunk_size, self.max_chunk_size)
+        while True:
+            with self.lock:
+                if not segments or any(seg.error for seg in segments):
+                    return
+                segment = segments.popleft()
+            mirror = sources.pick()
+            if mirror is None:
+                with self.lock:
+                    segments.appendleft(segment)
+                return
+            host = mirror.url.host
+            started = time.time()
+            pos = segment.pos
+            url_obj = None
             try:
-                data = url_obj.read(8192)
-            except (socket.timeout, socket.error) as err:
-                LOG.error("caught %s" % err)
-                file_obj.flush()
-                self._retry()
-                break
-            if not data:
-                file_obj.flush()
-                file_obj.close()
-                break
-            file_obj.write(data)
-            self.cur += 8192
-            # LOG.debug("read/wrote total of %d bytes" % self.cur)
-            # if callback:
-            #    callback(cur_size=self.cur)
-
-    def _retry(self):
-        '''auto-resumes up to self.retries'''
-        if self.retries > self.curretry:
-            self.curretry += 1
-            if self.get_local_file_size() != self.url_file_size:
-                self.resume()
+                url_obj = self._open_mirror(mirror, segment)
+                while segment.remaining > 0:
+                    chunk = self._read(reader, url_obj, segment.remaining,
+                                       host)
+                    if not chunk:
+                        raise socket.error("connection closed with %d bytes "
+                                           "outstanding" % segment.remaining)
+                    sink.write_at(segment.pos, chunk)
+                    self._hash(segment.pos, chunk)
+                    segment.pos += len(chunk)
+                    self._count(len(chunk), host)
+                url_obj.close()
+                sources.done(mirror, segment.pos - pos, time.time() - started)
+                self._range_done(segment.start, segment.end)
+            except Exception as err:
+                if url_obj is not None:
+                    self._discard(url_obj)
+                retryable = self.retry_policy.retryable(err)
+                sources.failed(mirror, err, fatal=not retryable)
+                self._range_done(segment.start, segment.pos - 1)
+                segment.start = segment.pos
+                segment.retries += 1
+                if segment.retries > self.retry_policy.retries or \
+                   (not retryable and not sources.live()):
+                    segment.error = err
+                with self.lock:
+                    errors.append(err)
+                    segments.appendleft(segment)
+                if segment.error is not None:
+                    return
+                self._inc('retries')
+                LOG.error("caught %s from %s, refetching bytes %d-%d" %
+                          (err, host, segment.pos, segment.end))
+                if len(sources.live()) < 2:
+                    # nowhere else to go, back off before asking again
+                    time.sleep(self.retry_policy.delay(segment.retries, err))
+
+    def _open_mirror(self, mirror, segment):
+        '''requests the unwritten part of a segment from mirror'''
+        url = mirror.url
+        if url.scheme == 'ftp':
+            return self.ftp_pool.retrieve(url.host, url.port, self.username,
+                                          self.password, str(url.path),
+                                          segment.pos, self.stall_timeout)
+        headers = {'Range': 'bytes=%d-%d' % (segment.pos, segment.end)}
+        if mirror.validator:
+            headers['If-Range'] = mirror.validator
+        response = self.pool.request(str(url), 'GET', headers,
+                                     self.stall_timeout, self._auth())
+        if response.getcode() != 206:
+            response.close()
+            raise ValueError("%s changed on the server during download" % url)
+        return response
+
+    def _mirror_set(self):
+        '''the MirrorSet of self.url and its mirrors, probed in parallel'''
+        if self.sources is not None:
+            return self.sources
+        primary = Mirror(self.url, self.probe_rtt, self.validator())
+        mirrors = [Mirror(url) for url in self.mirror_urls]
+        threads = []
+        for mirror in mirrors:
+            threads.append(threading.Thread(target=self._probe_mirror,
+                                            args=(mirror,)))
+            threads[-1].daemon = True
+            threads[-1].start()
+        for thread in threads:
+            thread.join()
+        self.sources = MirrorSet([primary] + mirrors)
+        return self.sources
+
+    def _probe_mirror(self, mirror):
+        '''
+        measures the round trip to a mirror, dropping it unless it serves
+        ranges of a file of the same size
+        '''
+        url = mirror.url
+        started = time.time()
+        try:
+            if url.scheme == 'ftp':
+                size, _ = self.ftp_pool.stat(url.host, url.port,
+                                             self.username, self.password,
+                                             str(url.path), self.stall_timeout)
+                ranges = size is not None
+            elif url.scheme in HTTP_SCHEMES:
+                response = self.pool.request(str(url), 'HEAD', None,
+                                             self.stall_timeout, self._auth())
+                response.close()
+                size = response.headers.get('content-length')
+                if size is not None:
+                    size = int(size)
+                ranges = (response.headers.get('accept-ranges') or
+                          '').lower() == 'bytes'
+                mirror.validator = (response.headers.get('etag') or
+                                    response.headers.get('last-modified'))
+            else:
+                raise ValueError("unsupported scheme %s" % url.scheme)
+        except Exception as err:
+            LOG.error("dropping mirror %s: %s" % (url, err))
+            mirror.dead = True
+            return
+        mirror.rtt = time.time() - started
+        if size != self.url_file_size or not ranges:
+            LOG.error("dropping mirror %s: size %s, ranges %s" %
+                      (url, size, ranges))
+            mirror.dead = True
+
+    def _probe_sources(self):
+        '''
+        probes self.url, or when it cannot be reached or answers with an
+        error status each mirror in turn until one answers and takes its
+        place.  When none answers the round is retried after a backoff as
+        the retry policy allows.
+        '''
+        candidates = [self.url] + self.mirror_urls
+        attempt = 0
+        while True:
+            for url in candidates:
+                self.url = url
+                started = time.time()
+                try:
+                    self.probe()
+                except Exception as err:
+                    retryable = self.retry_policy.retryable(err)
+                    if url is not candidates[-1] and (
+                            retryable or isinstance(err, urllib2.HTTPError)):
+                        LOG.error("%s unusable, trying its next mirror: %s" %
+                                  (url, err))
+                        continue
+                    if not retryable:
+                        raise
+                    if attempt >= self.retry_policy.retries:
+                        LOG.error('retries all used up')
+                        raise
+                    attempt += 1
+                    self._inc('retries')
+                    delay = self.retry_policy.delay(attempt, err)
+                    LOG.error("caught %s probing %s, retrying in %.1fs" %
+                              (err, url, delay))
+                    time.sleep(delay)
+                    break
+                self.probe_rtt = time.time() - started
+                self.mirror_urls = [other for other in candidates
+                                    if other is not url]
+                return
+
+    def _next_mirror(self):
+        '''moves a single stream on to the next mirror'''
+        if self.mirror_urls:
+            self.mirror_urls.append(self.url)
+            self.url = self.mirror_urls.pop(0)
+            LOG.debug("continuing from mirror %s" % self.url)
+
+    def _fetch_segment(self, segment, sink, url_obj=None):
+        '''
+        writes one segment into its offset of the local file, reconnecting
+        from the last written byte as the retry policy allows
+        '''
+        reader = ChunkReader(self.min_chunk_size, self.max_chunk_size)
+        try:
+            while segment.remaining > 0:
+                try:
+                    if url_obj is None:
+                        url_obj = self._open_range(segment)
+                        if not self._partial(url_obj):
+                            url_obj.close()
+                            raise ValueError("%s changed on the server "
+                                             "during download" % self.url)
+                    while segment.remaining > 0:
+                        chunk = self._read(reader, url_obj,
+                                           segment.remaining)
+                        if not chunk:
+                            raise socket.error("connection closed with %d "
+                                               "bytes outstanding" %
+                                               segment.remaining)
+                        sink.write_at(segment.pos, chunk)
+                        self._hash(segment.pos, chunk)
+                        segment.pos += len(chunk)
+                        self._count(len(chunk))
+                    # an ftp segment stops short of the end of the file
+                    url_obj.close()
+                except Exception as err:
+                    if url_obj is not None:
+                        self._discard(url_obj)
+                    if not self.retry_policy.retryable(err) or \
+                       segment.retries >= self.retry_policy.retries:
+                        segment.error = err
+                        return
+                    segment.retries += 1
+                    self._inc('retries')
+                    delay = self.retry_policy.delay(segment.retries, err)
+                    LOG.error("caught %s, retrying bytes %d-%d in %.1fs" %
+                              (err, segment.pos, segment.end, delay))
+                    time.sleep(delay)
+                    url_obj = None
+        finally:
+            # positional writes go straight to the OS, so the written bytes
+            # survive a crash
+            self._range_done(segment.start, segment.pos - 1)
+
+    def _discard(self, url_obj):
+        '''closes a response left behind by a failed read'''
+        try:
+            url_obj.close()
+        except Exception as err:
+            LOG.debug("closing %s: %s" % (self.url, err))
+
+    def _with_retries(self, transfer, callback=None):
+        '''
+        runs transfer, then resumes it after every retryable error until it
+        succeeds or the retry policy gives up
+        '''
+        self.curretry = 0
+        while True:
+            received = self.received
+            try:
+                return transfer(callback)
+            except Exception as err:
+                if not self.retry_policy.retryable(err):
+                    raise
+                if self.curretry >= self.retry_policy.retries:
+                    LOG.error('retries all used up')
+                    raise
+                if self.segmented and self.received == received:
+                    # the segments spent their own retries getting nowhere
+                    raise
+                self.curretry += 1
+                self._inc('retries')
+                delay = self.retry_policy.delay(self.curretry, err)
+                LOG.error("caught %s, retrying %s in %.1fs" %
+                          (err, self.url, delay))
+                time.sleep(delay)
+                transfer = self._resume_transfer
+
+    def _resume_transfer(self, callback=None):
+        '''picks a failed transfer up where it stopped'''
+        if self.segmented:
+            with self.lock:
+                written = list(self.written)
+            self.done_ranges = sorted(set(self.done_ranges) | set(written))
+            return self._download_segments(callback=callback)
+        self._next_mirror()
+        if self.codec is not None:
+            started = self.decoder is not None
+        else:
+            started = os.path.exists(self.local_file_name)
+        if not started:
+            return self._download(callback)
+        return self._resume_stream(callback)
+
+    def _resume_stream(self, callback=None):
+        '''resumes a single stream from the size of the local file'''
+        if self.url.scheme in HTTP_SCHEMES:
+            self._start_http_resume(callback=callback)
+        elif self.url.scheme == 'ftp':
+            self._start_ftp_resume(callback=callback)
+        return True
+
+    def _sink(self, keep=False):
+        '''
+        the FileSink data is written through or, when decoding, the
+        StreamDecoder, which is kept across resumes
+        '''
+        if self.codec is None:
+            return FileSink(self.local_file_name, keep=keep)
+        if self.decoder is not None and not keep:
+            self.decoder.abort()
+            self.decoder = None
+        if self.decoder is None:
+            self.decoder = StreamDecoder(self.codec, self.local_file_name,
+                                         self.extract)
+        return self.decoder
+
+    def _resume_offset(self):
+        '''the offset of the remote file the local data goes up to'''
+        if self.codec is not None:
+            return self.decoder.consumed if self.decoder is not None else 0
+        if os.path.exists(self.local_file_name):
+            return self.get_local_file_size()
+        return 0
+
+    def _finish_decode(self, success):
+        '''completes or abandons the decoded output'''
+        decoder, self.decoder = self.decoder, None
+        if decoder is None:
+            return
+        if success:
+            decoder.finish()
         else:
-            LOG.error('retries all used up')
-            return False, "Retries Exhausted"
-
-    def _auth_http(self):
-        '''handles http basic authentication'''
-        passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
-        # this creates a password manager
-        passman.add_password(None, str(self.url), self.username, self.password)
-        # because we have put None at the start it will always
-        # use this username/password combination for  urls
-        authhandler = urllib2.HTTPBasicAuthHandler(passman)
-        # create the AuthHandler
-        opener = urllib2.build_opener(authhandler)
-        urllib2.install_opener(opener)
-
-    def _auth_ftp(self):
-        '''handles ftp authentication'''
-        self.url.username = self.username
-        self.url.password = self.password
-
-        req = urllib2.Request(str(self.url))
-        req.timeout = self.timeout
-
-        ftped = urllib2.FTPHandler()
-        ftp_obj = ftped.ftp_open(req)
-
-        return ftp_obj
+            decoder.abort()
 
     def _start_http_resume(self, restart=None, callback=None):
         '''starts to resume HTTP'''
-        cur_size = self.get_local_file_size()
-        if cur_size >= self.url_file_size:
+        cur_size = self._resume_offset()
+        if self.url_file_size is not None and cur_size >= self.url_file_size:
             return False
         self.cur = cur_size
-        if restart:
-            file_hndl = open(self.local_file_name, "wb")
-        else:
-            file_hndl = open(self.local_file_name, "ab")
-        if self.username:
-            self._auth_http()
-        req = urllib2.Request(str(self.url))
-        req.headers['Range'] = 'bytes=%s-%s' % (cur_size,
-                                                self.get_url_file_size())
-        urllib2_obj = urllib2.urlopen(req, timeout=self.timeout)
-        self._download_file(urllib2_obj, file_hndl, callback=callback)
-
-    def _start_ftp_resume(self, restart=None):
-        '''starts to resume FTP'''
-        cur_size = self.get_local_file_size()
-        if cur_size >= self.url_file_size:
+        urllib2_obj = self._open(self._range_headers(cur_size))
+        sink = self._sink(keep=not restart)
+        if urllib2_obj.getcode() != 206:
+            # range ignored or the file changed, start over from byte 0
+            sink.truncate()
+            self._inc('bytes_redownloaded', self.cur)
+            self.cur = 0
+        self._rewind(self.cur)
+        self._download_file(urllib2_obj, sink, callback=callback)
+
+    def _start_ftp_resume(self, restart=None, callback=None):
+        '''starts to resume FTP with a REST offset'''
+        cur_size = self._resume_offset()
+        if self.url_file_size is not None and cur_size >= self.url_file_size:
             return False
-        if restart:
-            file_hndl = open(self.local_file_name, "wb")
-        else:
-            file_hndl = open(self.local_file_name, "ab")
-        ftper = ftplib.FTP(timeout=60)
-        parse_obj = urlparse.urlparse(str(self.url))
-        base_url = parse_obj.hostname
-        url_port = parse_obj.port
-        b_ath = os.path.basename(parse_obj.path)
-        g_path = parse_obj.path.replace(b_ath, "")
-        un_encg_path = urllib.unquote(g_path)
-        file_name = urllib.unquote(os.path.basename(str(self.url)))
-        ftper.connect(base_url, url_port)
-        ftper.login(self.username, self.password)
-        if len(g_path) > 1:
-            ftper.cwd(un_encg_path)
-        ftper.sendcmd("TYPE I")
-        ftper.sendcmd("REST " + str(cur_size))
-        down_cmd = "RETR " + file_name
-        ftper.retrbinary(down_cmd, file_hndl.write)
-        file_hndl.flush()
+        self.cur = cur_size
+        url_obj = self._open_ftp(cur_size)
+        sink = self._sink(keep=not restart)
+        self._rewind(self.cur)
+        self._download_file(url_obj, sink, callback=callback)
 
-    def get_url_file_name(self, url):
-        '''returns filename from url'''
+    def probe(self):
+        '''
+        Resolves the remote file metadata with a single HEAD request and
+        caches it.  If the server does not support HEAD (405 or 501) the
+        metadata is taken from the download response instead; other error
+        statuses are raised.  FTP files are probed with SIZE and MDTM.
+        '''
+        if self.url.scheme == 'ftp':
+            return self._probe_ftp()
+        if self.url.scheme not in HTTP_SCHEMES:
+            return
         try:
-            response = urllib2.urlopen(url)
-            _, params = cgi.parse_header(response.headers.get('Content-Disposition', ''))
-            return params['filename']
-        except Exception as err:
-            print("Server didn't provide filename, resorting to url")
+            response = self._open(method='HEAD')
+        except urllib2.HTTPError as err:
+            if err.code not in HEAD_UNSUPPORTED:
+                raise
+            LOG.debug("HEAD %s failed: %s" % (self.url, err))
+            return
+        response.close()
+        self._parse_headers(response.headers)
+
+    def _probe_ftp(self):
         try:
-            return url.path.segments[-1]
-        except Exception as err:
-            LOG.error("Unable to determine filename from url")
+            self.url_file_size, self.last_modified = \
+                self.ftp_pool.stat(*self._ftp_target(), timeout=self.timeout)
+        except ftplib.Error as err:
+            LOG.debug("SIZE %s failed: %s" % (self.url, err))
+            return
+        # REST (RFC 3659) is taken for granted wherever SIZE works
+        self.accepts_ranges = self.url_file_size is not None
+        self.probed = True
+
+    def _parse_headers(self, headers):
+        '''caches the metadata carried by a response's headers'''
+        size = headers.get('content-length')
+        if size is not None:
+            size = int(size)
+        self.url_file_size = size
+        self.accepts_ranges = \
+            (headers.get('accept-ranges') or '').lower() == 'bytes'
+        self.etag = headers.get('etag')
+        self.last_modified = headers.get('last-modified')
+        self.url_file_name = disposition_file_name(
+            headers.get('content-disposition'))
+        self.probed = True
+
+    def get_url_file_name(self, url):
+        '''returns filename from url'''
+        if self.url_file_name:
+            return self.url_file_name
+        return url_file_name(url)
 
-        return re.sub('/', '_', str(url.url))
-            
     def get_url_file_size(self):
         '''gets filesize of remote file from ftp or http server'''
-        if self.url.scheme == 'http':
-            if self.username:
-                self._auth_http()
-            urllib2_obj = urllib2.urlopen(str(self.url), timeout=self.timeout)
-            size = urllib2_obj.headers.get('content-length')
-            return size
+        if not self.probed:
+            self.probe()
+        return self.url_file_size
 
     def get_local_file_size(self):
         '''gets filesize of local file'''
@@ -230,45 +1028,61 @@ class FileDownloader(object):
     def check_exists(self):
         '''Checks to see if the file in the url in self.url exists'''
         if self.username:
-            if self.url.scheme == 'http':
-                self._auth_http()
+            if self.url.scheme in HTTP_SCHEMES:
                 try:
-                    urllib2.urlopen(str(self.url), timeout=self.timeout)
+                    self._open(method='HEAD').close()
                 except urllib2.HTTPError:
                     return False
                 return True
             elif self.url.scheme == 'ftp':
                 return "not yet supported"
         else:
-            urllib2.urlopen(str(self.url), timeout=self.timeout)
             try:
-                urllib2.urlopen(str(self.url), timeout=self.timeout)
+                self._open(method='HEAD').close()
             except urllib2.HTTPError:
                 return False
             return True
 
     def download(self, callback=None):
         '''starts the file download'''
-        self.curretry = 0
         self.cur = 0
-        file_hndl = open(self.local_file_name, "wb")
-        if self.username:
-            if self.url.scheme == 'http':
-                self._auth_http()
-                urllib2_obj = urllib2.urlopen(str(self.url),
-                                              timeout=self.timeout)
-                self._download_file(urllib2_obj, file_hndl, callback=callback)
-            elif self.url.scheme == 'ftp':
-                auth_obj = self._auth_ftp()
-                self._download_file(auth_obj, file_hndl, callback=callback)
-        else:
-            urllib2_obj = urllib2.urlopen(str(self.url), timeout=self.timeout)
-            self._download_file(urllib2_obj, file_hndl, callback=callback)
+        self._track(callback)
+        self._begin()
+        success = False
+        try:
+            if self.hasher is not None:
+                self.hasher.rewind(0)
+            result = self._with_retries(self._download, callback)
+            self._verify()
+            self._finish_decode(True)
+            success = True
+            return result
+        finally:
+            self._finish_decode(False)
+            self._end(success)
+            self._untrack()
+
+    def _download(self, callback=None):
+        if self._segmentable():
+            return self._download_segments(callback=callback)
+
+        url_obj = self._open()
+        if not self.probed and self.url.scheme in HTTP_SCHEMES:
+            self._parse_headers(url_obj.headers)
+        self._download_file(url_obj, self._sink(), callback=callback)
         return True
 
     def resume(self, callback=None):
         '''attempts to resume file download'''
-        if self.url.scheme == 'http':
-            self._start_http_resume(callback=callback)
-        elif self.url.scheme == 'ftp':
-            self._start_ftp_resume()
+        self._track(callback)
+        self._begin()
+        success = False
+        try:
+            self._with_retries(self._resume_stream, callback)
+            self._verify()
+            self._finish_decode(True)
+            success = True
+        finally:
+            self._finish_decode(False)
+            self._end(success)
+            self._untrack()
@@ -0,0 +1,102 @@
+'''
+Output files written with positional writes.
+
+A FileSink wraps a raw file descriptor.  Chunks are written at explicit
+offsets with os.pwrite, so the segments of a download can share one sink and
+fill any range in place without seeking or locking a shared file position.
+The file can be preallocated to its final size with posix_fallocate; where
+that is unavailable it is extended as a sparse file instead.
+
+A file hard linked elsewhere, such as one served from the download cache or
+placed for a coalesced job, is never written through: unshare() gives the
+path an inode of its own first, so the other links keep their data.
+'''
+
+import os
+import threading
+
+SEEK_SET = 0
+
+
+def unshare(path, keep=False):
+    '''
+    makes path a file of its own before it is written: a file with other
+    hard links is replaced by a private copy when its data is kept, and
+    unlinked when it would be truncated anyway
+    '''
+    try:
+        if os.stat(path).st_nlink < 2:
+            return
+    except OSError:
+        return
+    if not keep:
+        os.remove(path)
+        return
+    import shutil
+    tmp_path = '%s.unshare' % path
+    shutil.copyfile(path, tmp_path)
+    getattr(os, 'replace', os.rename)(tmp_path, path)
+
+
+class FileSink(object):
+    '''
+    >>> sink = FileSink('file.zip', size=1048576)
+    >>> sink.write_at(524288, b'second half starts here')
+    >>> sink.close()
+    '''
+
+    def __init__(self, path, size=None, keep=False):
+        '''
+        Opens path for writing, truncating it unless keep is set, and
+        preallocates it to size bytes when size is given.
+        '''
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if not keep:
+            flags |= os.O_TRUNC
+        self.path = path
+        unshare(path, keep)
+        self.fd = os.open(path, flags, 0o666)
+        # only used where os.pwrite is missing and writes must seek
+        self.lock = threading.Lock()
+        if size is not None:
+            self.allocate(size)
+
+    def allocate(self, size):
+        '''reserves size bytes on disk, or makes a sparse file of that size'''
+        if os.fstat(self.fd).st_size > size:
+            os.ftruncate(self.fd, size)
+            return
+        fallocate = getattr(os, 'posix_fallocate', None)
+        if fallocate is not None:
+            try:
+                fallocate(self.fd, 0, size)
+                return
+            except OSError:
+                # filesystem without fallocate support
+                pass
+        os.ftruncate(self.fd, size)
+
+    def truncate(self, size=0):
+        os.ftruncate(self.fd, size)
+
+    def write_at(self, offset, data):
+        '''writes all of data starting at byte offset of the file'''
+        view = memoryview(data)
+        pwrite = getattr(os, 'pwrite', None)
+        while len(view):
+            if pwrite is not None:
+                written = pwrite(self.fd, view, offset)
+            else:
+                with self.lock:
+                    os.lseek(self.fd, offset, SEEK_SET)
+                    written = os.write(self.fd, view)
+            view = view[written:]
+            offset += written
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,217 @@
+'''
+Pool of logged in FTP control connections shared by the Downloader threads.
+
+Sessions are keyed by (host, port, username, password), so the connect,
+login and TYPE I handshake is paid once per session rather than once per
+file.  A session remembers its working directory and only sends CWD when a
+file lives somewhere else.  Each RETR opens a data connection on its
+session; once the data has been read (or the transfer given up on) the
+server's final reply is collected and the session goes back to the pool,
+where it is reused until it has sat idle for longer than idle_timeout.  At
+most size idle sessions are kept per key (see libdlm.idle_pool).  New
+sessions look their host up through resolver, a libdlm.dns_cache.DNSCache,
+when one is given.
+
+FTP allows one transfer per control connection, so parallel REST segments
+of one file each take their own session.
+'''
+
+import ftplib
+import logging
+import posixpath
+import socket
+try:
+    from urllib import unquote
+except ImportError:
+    from urllib.parse import unquote
+from libdlm.idle_pool import IdlePool
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PORT = 21
+# raised when the server dropped a session we tried to reuse
+STALE_ERRORS = (EOFError, socket.error, ftplib.error_temp)
+
+
+class FTPSession(object):
+    '''a logged in, binary mode control connection'''
+
+    def __init__(self, host, port, username, password, timeout,
+                 resolver=None):
+        self.ftp = ftplib.FTP(timeout=timeout)
+        if resolver is None:
+            self.ftp.connect(host, port)
+        else:
+            self._connect(resolver, host, port)
+        self.ftp.login(username or '', password or '')
+        self.ftp.voidcmd('TYPE I')
+        self.cwd = None
+
+    def _connect(self, resolver, host, port):
+        '''connects to the first address of host that answers'''
+        err = None
+        for info in resolver.resolve(host, port):
+            try:
+                self.ftp.connect(info[4][0], port)
+                return
+            except socket.error as conn_err:
+                err = conn_err
+                self.ftp.close()
+        resolver.forget(host, port)
+        raise err or socket.error('getaddrinfo returned no addresses')
+
+    def chdir(self, path):
+        if path != self.cwd:
+            self.cwd = None
+            self.ftp.cwd(path)
+            self.cwd = path
+
+    def settimeout(self, timeout):
+        self.ftp.timeout = timeout
+        if self.ftp.sock is not None:
+            self.ftp.sock.settimeout(timeout)
+
+    def close(self):
+        try:
+            self.ftp.close()
+        except (socket.error, EOFError):
+            pass
+
+
+class FTPResponse(object):
+    '''
+    Wraps the data connection of a RETR with the parts of the response API
+    used by FileDownloader, returning the session to the pool once the data
+    has been read or the response is closed.
+    '''
+
+    def __init__(self, pool, key, session, conn):
+        self.pool = pool
+        self.key = key
+        self.session = session
+        self.conn = conn
+        self.file = conn.makefile('rb')
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self.file.read()
+        else:
+            data = self.file.read(amt)
+        if not data:
+            self.close()
+        return data
+
+    def readinto(self, buf):
+        if not hasattr(self.file, 'readinto'):
+            data = self.read(len(buf))
+            buf[:len(data)] = data
+            return len(data)
+        count = self.file.readinto(buf)
+        if not count:
+            self.close()
+        return count
+
+    def close(self):
+        '''
+        closes the data connection and collects the transfer's final reply,
+        226 when it completed or 426 when it was cut short
+        '''
+        if self.session is None:
+            return
+        session, self.session = self.session, None
+        self.file.close()
+        self.conn.close()
+        try:
+            session.ftp.voidresp()
+            reusable = True
+        except ftplib.error_temp:
+            reusable = True
+        except (ftplib.Error, EOFError, socket.error):
+            reusable = False
+        self.pool.put(self.key, session, reusable)
+
+
+class FTPPool(IdlePool):
+    '''
+    Thread safe, per-host pool of logged in FTP sessions
+
+    >>> pool = FTPPool(size=4, idle_timeout=30)
+    >>> response = pool.retrieve('ftp.example.com', 21, None, None,
+    ...                          '/pub/file.zip', offset=1024)
+    >>> data = response.read()
+    >>> pool.stats()
+    {'hits': 0, 'misses': 1, 'discarded': 0, 'idle': 1}
+    '''
+
+    def _connect(self, key, timeout):
+        host, port, username, password = key
+        return FTPSession(host, port, username, password, timeout,
+                          self.resolver)
+
+    def _reuse(self, session, timeout):
+        session.settimeout(timeout)
+
+    def _alive(self, session):
+        return session.ftp.sock is not None
+
+    def _run(self, key, path, timeout, command):
+        '''
+        runs command(session, name) in the directory of path on a pooled
+        session, retrying once on a new session if a reused one went stale.
+        The session is handed back unless command returns a response that
+        now owns it.
+        '''
+        dirname, name = posixpath.split(unquote(path))
+        for fresh in (False, True):
+            session, reused = self.get(key, timeout, fresh)
+            try:
+                if len(dirname) > 1:
+                    session.chdir(dirname)
+                result = command(session, name)
+            except STALE_ERRORS:
+                self.discard(session)
+                if not reused or fresh:
+                    raise
+                continue
+            except ftplib.Error:
+                # the server refused the command, the session is fine
+                self.put(key, session)
+                raise
+            except Exception:
+                self.discard(session)
+                raise
+            if not isinstance(result, FTPResponse):
+                self.put(key, session)
+            return result
+
+    def retrieve(self, host, port, username, password, path, offset=0,
+                 timeout=120.0):
+        '''
+        starts a binary RETR of path from offset and returns an FTPResponse
+        to read the data from
+        '''
+        key = (host, port or DEFAULT_PORT, username, password)
+
+        def command(session, name):
+            conn = session.ftp.transfercmd('RETR ' + name, offset or None)
+            return FTPResponse(self, key, session, conn)
+        return self._run(key, path, timeout, command)
+
+    def stat(self, host, port, username, password, path, timeout=120.0):
+        '''
+        returns (size, modification time) of path, either None when the
+        server does not support SIZE or MDTM
+        '''
+        key = (host, port or DEFAULT_PORT, username, password)
+
+        def command(session, name):
+            try:
+                size = session.ftp.size(name)
+            except ftplib.error_perm:
+                size = None
+            try:
+                modified = session.ftp.sendcmd('MDTM ' + name).split()[-1]
+            except ftplib.error_perm:
+                modified = None
+            return size, modified
+        return self._run(key, path, timeout, command)
@@ -0,0 +1,105 @@
+'''
+Keyed pool of idle connections, the base of the HTTP and FTP pools.
+
+A connection is handed back with put() once it has nothing in progress and
+is reused by the next get() for the same key, the most recently used first,
+until it has sat idle for longer than idle_timeout.  At most size idle
+connections are kept per key; the rest, and any that cannot be reused, are
+closed.  Subclasses open new connections in _connect() and may refresh a
+reused one in _reuse() and veto keeping one in _alive().
+'''
+
+import threading
+import time
+
+
+class IdlePool(object):
+    '''
+    Thread safe, keyed pool of idle connections with reuse counters
+
+    >>> conn, reused = pool.get(key, timeout=30)
+    >>> pool.put(key, conn)
+    '''
+
+    def __init__(self, size=10, idle_timeout=60.0, resolver=None):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        # libdlm.dns_cache.DNSCache new connections resolve through
+        self.resolver = resolver
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def _connect(self, key, timeout):
+        '''opens a new connection for key'''
+        raise NotImplementedError
+
+    def _reuse(self, conn, timeout):
+        '''readies an idle connection to be used with timeout'''
+
+    def _alive(self, conn):
+        '''False when conn has been closed and cannot go back in the pool'''
+        return True
+
+    def get(self, key, timeout, fresh=False):
+        '''
+        returns (connection, reused) for key, preferring the most recently
+        used idle connection unless fresh is set
+        '''
+        now = time.time()
+        expired = []
+        conn = None
+        with self.lock:
+            conns = self.idle.get(key, [])
+            while conns and not fresh:
+                candidate, last_used = conns.pop()
+                if now - last_used > self.idle_timeout:
+                    expired.append(candidate)
+                    continue
+                conn = candidate
+                break
+            self.discarded += len(expired)
+            if conn is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        for candidate in expired:
+            candidate.close()
+
+        if conn is not None:
+            self._reuse(conn, timeout)
+            return conn, True
+        return self._connect(key, timeout), False
+
+    def put(self, key, conn, reusable=True):
+        '''returns a connection that has nothing in progress'''
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if reusable and self._alive(conn) and len(conns) < self.size:
+                conns.append((conn, time.time()))
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        '''closes a connection that cannot be reused'''
+        with self.lock:
+            self.discarded += 1
+        conn.close()
+
+    def clear(self):
+        '''closes every idle connection'''
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def stats(self):
+        '''returns the reuse counters and current number of idle connections'''
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'discarded': self.discarded,
+                    'idle': sum(len(conns) for conns in self.idle.values())}
@@ -0,0 +1,164 @@
+'''
+Crash-safe journal of a DownloadManager's work.
+
+The journal is an append-only file of JSON lines recording each queued job,
+each byte range written for it, or the start of a single stream whose
+partial file resumes from its size, and when it finished.  Every record is flushed
+to the OS as it is written, so nothing is lost if the process dies, while
+fsync is batched to once per sync_interval seconds.  Opening a journal
+replays it, then compacts it down to the jobs that are still pending.
+
+Credentials given to append() are stored so recovered jobs can authenticate;
+the journal file is created readable by its owner only.
+'''
+
+import collections
+import json
+import os
+import threading
+import time
+
+replace = getattr(os, 'replace', os.rename)
+
+
+class Journal(object):
+    '''
+    >>> journal = Journal('/tmp/dlm.journal')
+    >>> job_id = journal.queued('http://example.com/file.zip', '.')
+    >>> journal.range_done(job_id, 0, 1048575, '"etag"')
+    >>> journal.pending()
+    [{'id': 1, 'src': ..., 'ranges': [[0, 1048575]], 'validator': '"etag"'}]
+    >>> journal.finished(job_id)
+    '''
+
+    def __init__(self, path, sync_interval=1.0):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.next_id = 1
+        self.file = None
+        self._replay()
+        self._compact()
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as file_hndl:
+            for line in file_hndl:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn final write from a crash
+                    continue
+                self._apply(record)
+
+    def _apply(self, record):
+        op = record.pop('op')
+        job_id = record['id']
+        self.next_id = max(self.next_id, job_id + 1)
+        if op == 'queue':
+            record.setdefault('ranges', [])
+            record.setdefault('validator', None)
+            record.setdefault('stream', False)
+            self.jobs[job_id] = record
+        elif op == 'range' and job_id in self.jobs:
+            job = self.jobs[job_id]
+            if job['validator'] != record['validator']:
+                # the remote file changed, earlier ranges are stale
+                job['ranges'] = []
+                job['validator'] = record['validator']
+            job['ranges'].append([record['start'], record['end']])
+            job['stream'] = False
+        elif op == 'stream' and job_id in self.jobs:
+            self.jobs[job_id].update(ranges=[], stream=True,
+                                     validator=record['validator'])
+        elif op == 'reset' and job_id in self.jobs:
+            self.jobs[job_id].update(ranges=[], stream=False, validator=None)
+        elif op == 'done':
+            self.jobs.pop(job_id, None)
+
+    def _compact(self):
+        '''rewrites the journal with only the pending jobs'''
+        tmp_path = '%s.tmp' % self.path
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as file_hndl:
+            for job in self.jobs.values():
+                record = dict(job, op='queue')
+                file_hndl.write(json.dumps(record) + '\n')
+            file_hndl.flush()
+            os.fsync(file_hndl.fileno())
+        replace(tmp_path, self.path)
+        self.file = open(self.path, 'a')
+        self.last_sync = time.time()
+
+    def _write(self, record, sync=False):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            if sync or time.time() - self.last_sync >= self.sync_interval:
+                os.fsync(self.file.fileno())
+                self.last_sync = time.time()
+
+    def pending(self):
+        '''returns the jobs recovered from the journal that never finished'''
+        with self.lock:
+            return [dict(job, ranges=[list(rng) for rng in job['ranges']])
+                    for job in self.jobs.values()]
+
+    def queued(self, src, dst, username=None, password=None, checksum=None,
+               decode=None, extract=False, mirrors=None):
+        '''records a new job and returns its journal id'''
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            self.jobs[job_id] = {'id': job_id, 'src': src, 'dst': dst,
+                                 'username': username, 'password': password,
+                                 'checksum': checksum, 'decode': decode,
+                                 'extract': extract, 'mirrors': mirrors,
+                                 'ranges': [],
+                                 'validator': None, 'stream': False}
+            record = dict(self.jobs[job_id], op='queue')
+        self._write(record)
+        return job_id
+
+    def range_done(self, job_id, start, end, validator=None):
+        '''records that bytes start-end (inclusive) are on disk'''
+        record = {'op': 'range', 'id': job_id, 'start': start, 'end': end,
+                  'validator': validator}
+        self._write(record)
+        with self.lock:
+            self._apply(record)
+
+    def streaming(self, job_id, validator=None):
+        '''
+        records that a job is written by a single stream, so its partial
+        file holds the data up to its size as of validator
+        '''
+        record = {'op': 'stream', 'id': job_id, 'validator': validator}
+        self._write(record, sync=True)
+        with self.lock:
+            self._apply(record)
+
+    def reset(self, job_id):
+        '''records that a job's written ranges must be fetched again'''
+        record = {'op': 'reset', 'id': job_id}
+        self._write(record)
+        with self.lock:
+            self._apply(record)
+
+    def finished(self, job_id):
+        '''records that a job completed or failed for good'''
+        with self.lock:
+            self.jobs.pop(job_id, None)
+        self._write({'op': 'done', 'id': job_id})
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.last_sync = time.time()
+
+    def close(self):
+        self.sync()
+        self.file.close()
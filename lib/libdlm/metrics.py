@@ -0,0 +1,113 @@
+'''
+Counters and timing summaries for a DownloadManager.
+
+A Metrics registry holds named counters (monotonic totals) and summaries
+(count, sum and max of observed values, e.g. seconds or bytes/s).  Updates
+take one short lock, and the hot read loop only touches the registry once
+per download, so keeping metrics costs nothing per chunk.  snapshot()
+returns plain dicts and prometheus_text() renders a snapshot in the
+Prometheus text exposition format.
+'''
+
+import threading
+
+PREFIX = 'libdlm_'
+
+COUNTERS = {
+    'downloads_started': 'Downloads taken off the queue',
+    'downloads_completed': 'Downloads that finished successfully',
+    'downloads_failed': 'Downloads that ended in an error',
+    'bytes_downloaded': 'Bytes received from the network',
+    'bytes_redownloaded': 'Bytes fetched again after a restart or '
+                          'a failed checksum',
+    'retries': 'Reconnects and re-fetches after an error',
+}
+
+SUMMARIES = {
+    'queue_wait_seconds': 'Time jobs spent queued before a worker took them',
+    'ttfb_seconds': 'Time from starting a download to its first byte',
+    'download_seconds': 'Wall time of each download',
+    'download_rate_bytes': 'Average bytes/s of each download',
+}
+
+
+class Metrics(object):
+    '''
+    >>> metrics = Metrics()
+    >>> metrics.inc('retries')
+    >>> metrics.observe('ttfb_seconds', 0.05)
+    >>> metrics.snapshot()['summaries']['ttfb_seconds']
+    {'count': 1, 'sum': 0.05, 'max': 0.05}
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict((name, 0) for name in COUNTERS)
+        self.summaries = dict((name, [0, 0.0, 0.0]) for name in SUMMARIES)
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        '''adds one observation to a summary'''
+        with self.lock:
+            summary = self.summaries.setdefault(name, [0, 0.0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'summaries': dict((name, {'count': count, 'sum': total,
+                                          'max': peak})
+                                  for name, (count, total, peak)
+                                  in self.summaries.items()),
+            }
+
+
+def prometheus_text(stats):
+    '''
+    renders DownloadManager.stats() (or Metrics.snapshot()) in the
+    Prometheus text exposition format
+    '''
+    lines = []
+
+    def metric(name, kind, doc, samples):
+        name = PREFIX + name
+        lines.append('# HELP %s %s' % (name, doc))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            label_text = ''
+            if labels:
+                label_text = '{%s}' % ','.join(
+                    '%s="%s"' % item for item in sorted(labels.items()))
+            lines.append('%s%s%s %s' % (name, suffix, label_text,
+                                        repr(float(value))))
+
+    for name, value in sorted(stats.get('counters', {}).items()):
+        metric(name + '_total', 'counter', COUNTERS.get(name, name),
+               [('', None, value)])
+    for name, summary in sorted(stats.get('summaries', {}).items()):
+        metric(name, 'summary', SUMMARIES.get(name, name),
+               [('_count', None, summary['count']),
+                ('_sum', None, summary['sum'])])
+        metric(name + '_max', 'gauge', 'Largest of %s' % name,
+               [('', None, summary['max'])])
+    for name, doc in (('queue_depth', 'Jobs waiting in the queue'),
+                      ('in_flight', 'Jobs being downloaded'),
+                      ('throughput_bytes', 'Aggregate bytes/s right now')):
+        if name in stats:
+            metric(name, 'gauge', doc, [('', None, stats[name])])
+    if 'open_circuits' in stats:
+        metric('open_circuits', 'gauge', 'Hosts parked by a circuit breaker',
+               [('', None, len(stats['open_circuits']))])
+        metric('circuit_trips_total', 'counter', 'Circuit breakers opened',
+               [('', None, stats['circuit_trips'])])
+    if 'workers' in stats:
+        metric('workers', 'gauge', 'Worker threads by state',
+               [('', {'state': state}, count)
+                for state, count in sorted(stats['workers'].items())])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,101 @@
+'''
+Source selection for files published on several mirrors.
+
+A MirrorSet tracks each mirror's probe round trip time, its throughput (an
+exponentially weighted average of the bytes/s of the pieces it served), the
+pieces it is serving right now and its consecutive errors.  pick() hands the
+next piece of a file to the live mirror expected to finish it soonest, its
+rate divided by the pieces it already has in flight, so fast mirrors are
+given more of the file as their speed is measured.  Mirrors not measured
+yet are assumed to be as fast as the best one so they get tried, the closest
+(by round trip time) first.  A mirror is dropped after max_errors errors in
+a row, or at once for an error retrying cannot fix; the last live mirror
+is only dropped for the latter, its transient errors being left to the
+download's retry policy.
+'''
+
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+class Mirror(object):
+    '''one source of a file and what has been measured about it'''
+
+    def __init__(self, url, rtt=None, validator=None):
+        self.url = url
+        self.rtt = rtt
+        self.validator = validator
+        self.rate = None
+        self.active = 0
+        self.errors = 0
+        self.fetched = 0
+        self.dead = False
+
+    def __repr__(self):
+        return '<Mirror %s rate=%s rtt=%s%s>' % (
+            self.url, self.rate, self.rtt, ' dead' if self.dead else '')
+
+
+class MirrorSet(object):
+    '''
+    >>> mirrors = MirrorSet([Mirror(url_a, rtt=0.02), Mirror(url_b, rtt=0.2)])
+    >>> mirror = mirrors.pick()
+    >>> mirrors.done(mirror, 1048576, 0.5)
+    '''
+
+    def __init__(self, mirrors, max_errors=2, smoothing=0.3):
+        self.mirrors = list(mirrors)
+        self.max_errors = max_errors
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+
+    def live(self):
+        with self.lock:
+            return [mirror for mirror in self.mirrors if not mirror.dead]
+
+    def pick(self):
+        '''
+        returns the live mirror to fetch the next piece from and counts the
+        piece against it, or None once every mirror has been dropped
+        '''
+        with self.lock:
+            live = [mirror for mirror in self.mirrors if not mirror.dead]
+            if not live:
+                return None
+            rates = [mirror.rate for mirror in live if mirror.rate]
+            optimistic = max(rates) if rates else 1.0
+
+            def score(mirror):
+                rate = mirror.rate or optimistic
+                rtt = mirror.rtt if mirror.rtt is not None else float('inf')
+                return (rate / (mirror.active + 1), mirror.rate is None, -rtt)
+            best = max(live, key=score)
+            best.active += 1
+            return best
+
+    def done(self, mirror, nbytes, seconds):
+        '''records a piece of nbytes served by mirror in seconds'''
+        with self.lock:
+            mirror.active -= 1
+            mirror.errors = 0
+            mirror.fetched += nbytes
+            if nbytes and seconds > 0:
+                sample = nbytes / float(seconds)
+                if mirror.rate is None:
+                    mirror.rate = sample
+                else:
+                    mirror.rate += self.smoothing * (sample - mirror.rate)
+
+    def failed(self, mirror, err, fatal=False):
+        '''records a piece that mirror failed to serve'''
+        with self.lock:
+            mirror.active -= 1
+            mirror.errors += 1
+            others = [other for other in self.mirrors
+                      if other is not mirror and not other.dead]
+            if not mirror.dead and (fatal or (
+                    others and mirror.errors >= self.max_errors)):
+                mirror.dead = True
+                LOG.error('dropping mirror %s: %s' % (mirror.url, err))
@@ -0,0 +1,163 @@
+'''
+Post-download processing on a pool of processes.
+
+A job appended with stages, a list of picklable callables (module level
+functions or instances of module level classes), has them run one after
+the other on the finished file once its download lands: each stage is
+called with the path the previous one returned, starting from the
+downloaded file, and returns the path of its output.  Stages run in
+separate processes, so hashing, unpacking or converting a file uses
+another core instead of holding a download thread and the GIL.
+
+At most backlog jobs are submitted to the pool at once.  A worker that
+finishes a download while the pool is that far behind blocks until a slot
+frees up, so downloads slow down to the pace of processing instead of
+piling finished files up on disk.
+
+multiprocessing is imported, and the pool started, by the first submit().
+'''
+
+import logging
+import os
+import pickle
+import sys
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+def cpu_count():
+    '''the number of cores, found without importing multiprocessing'''
+    count = getattr(os, 'cpu_count', lambda: None)()
+    if count is None:
+        # python 2
+        try:
+            count = os.sysconf('SC_NPROCESSORS_ONLN')
+        except (AttributeError, ValueError, OSError):
+            pass
+    if count is None or count < 1:
+        import multiprocessing
+        count = multiprocessing.cpu_count()
+    return count
+
+
+def run_stages(stages, path):
+    '''
+    runs in a pool process: returns (final path, None), or (None, error)
+    when a stage raises
+    '''
+    try:
+        for stage in stages:
+            path = stage(path)
+        return path, None
+    except Exception as err:
+        try:
+            pickle.dumps(err)
+        except Exception:
+            err = RuntimeError('%s: %s' % (type(err).__name__, err))
+        return None, err
+
+
+class Pipeline(object):
+    '''
+    >>> pipeline = Pipeline(workers=4, backlog=8)
+    >>> pipeline.submit([unpack, convert], '/tmp/file.tar.gz',
+    ...                 lambda path, err: LOG.info('%s %s' % (path, err)))
+    >>> pipeline.wait_idle()
+    True
+    '''
+
+    def __init__(self, workers=None, backlog=None, start_method=None):
+        self.workers = workers or cpu_count()
+        self.backlog = backlog or 2 * self.workers
+        self.start_method = start_method
+        self.pool = None
+        self.slots = threading.BoundedSemaphore(self.backlog)
+        self.cond = threading.Condition()
+        self.pending = 0
+
+    @staticmethod
+    def check(stages):
+        '''raises TypeError unless stages can be sent to another process'''
+        try:
+            pickle.dumps(list(stages))
+        except Exception as err:
+            raise TypeError('stages must be picklable: %s' % err)
+
+    def _pool(self):
+        with self.cond:
+            if self.pool is None:
+                import multiprocessing
+                if self.start_method is not None:
+                    context = multiprocessing.get_context(self.start_method)
+                    self.pool = context.Pool(self.workers)
+                else:
+                    self.pool = multiprocessing.Pool(self.workers)
+            return self.pool
+
+    def submit(self, stages, path, callback):
+        '''
+        runs stages on path in the pool, then calls callback(path, err)
+        with the final path or the error that stopped them.  Blocks while
+        backlog jobs are already in the pool.
+        '''
+        self.slots.acquire()
+        with self.cond:
+            self.pending += 1
+        started = time.time()
+
+        def landed(outcome):
+            final_path, err = outcome
+            LOG.debug('processed %s in %.2fs' % (path, time.time() - started))
+            try:
+                callback(final_path, err)
+            except Exception as cb_err:
+                LOG.error(str(cb_err), exc_info=True)
+            finally:
+                self.slots.release()
+                with self.cond:
+                    self.pending -= 1
+                    self.cond.notify_all()
+
+        kwargs = {'callback': landed}
+        if sys.version_info[0] >= 3:
+            # the pool could not send the job to a process
+            kwargs['error_callback'] = lambda err: landed((None, err))
+        try:
+            self._pool().apply_async(run_stages, (list(stages), path),
+                                     **kwargs)
+        except Exception:
+            self.slots.release()
+            with self.cond:
+                self.pending -= 1
+                self.cond.notify_all()
+            raise
+
+    def busy(self):
+        with self.cond:
+            return self.pending > 0
+
+    def wait_idle(self, timeout=None):
+        '''
+        blocks until every submitted job has been processed, returning
+        False if that takes longer than timeout seconds
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.pending:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.cond.wait(remaining)
+        return True
+
+    def close(self):
+        '''waits for the submitted jobs and shuts the processes down'''
+        with self.cond:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -0,0 +1,148 @@
+'''
+Throttled progress reporting for downloads.
+
+A ProgressTracker counts the bytes of one download and hands a Progress event
+to its callback at most once per interval seconds (or per byte_interval
+bytes), so reporting costs one clock read per chunk rather than a callback.
+A ProgressMonitor aggregates the trackers of every download a manager runs.
+'''
+
+import collections
+import threading
+import time
+
+class Progress(collections.namedtuple(
+        'Progress', 'src done total rate smoothed_rate eta')):
+    '''
+    Snapshot of a download, or of all downloads when src is None.  rate is
+    the bytes/s over the last reporting interval, smoothed_rate an
+    exponentially weighted average of it, and eta the seconds left at
+    smoothed_rate (None when the total size or rate is unknown).
+    '''
+    __slots__ = ()
+
+
+def eta(done, total, rate):
+    '''seconds left to transfer total - done bytes at rate'''
+    if total is None or rate <= 0:
+        return None
+    return max(total - done, 0) / float(rate)
+
+
+class ProgressTracker(object):
+    '''
+    Counts the bytes of one download and emits throttled Progress events
+
+    >>> tracker = ProgressTracker('http://example.com/file.zip', 1000, print)
+    >>> tracker.update(500)
+    >>> tracker.finish()
+    Progress(src='http://example.com/file.zip', done=500, total=1000, ...)
+    '''
+    smoothing = 0.3
+
+    def __init__(self, src, total=None, callback=None, interval=0.5,
+                 byte_interval=None, done=0):
+        self.src = src
+        self.total = total
+        self.callback = callback
+        self.interval = interval
+        self.byte_interval = byte_interval
+        self.lock = threading.Lock()
+        self.done = done
+        self.last_done = done
+        self.last_time = time.time()
+        self.rate = 0.0
+        self.smoothed_rate = None
+
+    def update(self, nbytes):
+        '''adds nbytes, emitting an event if an interval has passed'''
+        with self.lock:
+            self.done += nbytes
+            now = time.time()
+            if now - self.last_time < self.interval and \
+               (self.byte_interval is None or
+                    self.done - self.last_done < self.byte_interval):
+                return
+            event = self._sample(now)
+        if self.callback:
+            self.callback(event)
+
+    def rewind(self, done):
+        '''restarts the count at done, e.g. when a resume starts over'''
+        with self.lock:
+            self.done = done
+            self.last_done = done
+
+    def finish(self):
+        '''emits a final event regardless of the interval'''
+        with self.lock:
+            event = self._sample(time.time())
+        if self.callback:
+            self.callback(event)
+        return event
+
+    def snapshot(self):
+        with self.lock:
+            return self._event()
+
+    def _sample(self, now):
+        elapsed = now - self.last_time
+        if elapsed > 0:
+            self.rate = (self.done - self.last_done) / elapsed
+            if self.smoothed_rate is None:
+                self.smoothed_rate = self.rate
+            else:
+                self.smoothed_rate += \
+                    self.smoothing * (self.rate - self.smoothed_rate)
+        self.last_time = now
+        self.last_done = self.done
+        return self._event()
+
+    def _event(self):
+        smoothed_rate = self.smoothed_rate or 0.0
+        return Progress(self.src, self.done, self.total, self.rate,
+                        smoothed_rate, eta(self.done, self.total,
+                                           smoothed_rate))
+
+
+class ProgressMonitor(object):
+    '''aggregates the trackers of every download run by a manager'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.trackers = set()
+        self.finished = 0
+        self.finished_bytes = 0
+
+    def add(self, tracker):
+        with self.lock:
+            self.trackers.add(tracker)
+
+    def remove(self, tracker):
+        '''moves a finished tracker's bytes into the completed totals'''
+        with self.lock:
+            if tracker in self.trackers:
+                self.trackers.discard(tracker)
+                self.finished += 1
+                self.finished_bytes += tracker.done
+
+    def active(self):
+        '''returns a Progress event per running download'''
+        with self.lock:
+            trackers = list(self.trackers)
+        return [tracker.snapshot() for tracker in trackers]
+
+    def snapshot(self):
+        '''returns a Progress event summed over all downloads'''
+        with self.lock:
+            trackers = list(self.trackers)
+            finished_bytes = self.finished_bytes
+        events = [tracker.snapshot() for tracker in trackers]
+        done = finished_bytes + sum(event.done for event in events)
+        total = None
+        if all(event.total is not None for event in events):
+            total = finished_bytes + sum(event.total for event in events)
+        rate = sum(event.rate for event in events)
+        smoothed_rate = sum(event.smoothed_rate for event in events)
+        return Progress(None, done, total, rate, smoothed_rate,
+                        eta(done, total, smoothed_rate))
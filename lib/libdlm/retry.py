@@ -0,0 +1,179 @@
+'''
+Retry policy and per-host circuit breakers.
+
+A RetryPolicy decides which errors are worth another attempt (network
+errors, timeouts and transient HTTP statuses) and how long to wait before
+it: exponential backoff from base_delay capped at max_delay, with full
+jitter so clients that failed together do not retry together.  A
+Retry-After header on a 429 or 503 is honoured when it asks for longer.
+
+CircuitBreakers track consecutive transient failures per host.  After
+threshold of them a host's circuit opens and its queued jobs are parked
+rather than handed to workers.  Once reset_timeout seconds have passed a
+single trial job is let through; its success closes the circuit and its
+failure parks the host for another reset_timeout.
+
+Protocol error classes are named as 'module.Class' and only looked up once
+their module has been imported, so importing this module does not pull in
+urllib, httplib or ftplib: an error of a module nobody imported cannot have
+been raised.
+'''
+
+import random
+import socket
+import sys
+import threading
+import time
+
+RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+RETRY_ERRORS = (socket.error, EOFError, 'httplib.HTTPException',
+                'http.client.HTTPException', 'ftplib.error_temp')
+HTTP_ERRORS = ('urllib2.HTTPError', 'urllib.error.HTTPError')
+URL_ERRORS = ('urllib2.URLError', 'urllib.error.URLError')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def loaded(classes):
+    '''
+    the exception classes of classes, resolving 'module.Class' names of
+    modules that have been imported and skipping the rest
+    '''
+    found = []
+    for cls in classes:
+        if not isinstance(cls, str):
+            found.append(cls)
+            continue
+        module_name, _, name = cls.rpartition('.')
+        module = sys.modules.get(module_name)
+        if module is not None and hasattr(module, name):
+            found.append(getattr(module, name))
+    return tuple(found)
+
+
+def retry_after(err):
+    '''seconds asked for by an HTTPError's Retry-After header, or None'''
+    headers = getattr(err, 'headers', None) or getattr(err, 'hdrs', None)
+    try:
+        return max(0.0, float(headers.get('Retry-After')))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class RetryPolicy(object):
+    '''
+    >>> policy = RetryPolicy(retries=5, base_delay=0.5, max_delay=30.0)
+    >>> policy.retryable(socket.timeout())
+    True
+    >>> policy.delay(3)  # somewhere in [0, 4.0)
+    2.71...
+    '''
+
+    def __init__(self, retries=5, base_delay=0.5, max_delay=30.0,
+                 statuses=RETRY_STATUSES, errors=RETRY_ERRORS):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.statuses = tuple(statuses)
+        self.errors = tuple(errors)
+
+    def retryable(self, err):
+        '''True for errors that another attempt may get past'''
+        if isinstance(err, loaded(HTTP_ERRORS)):
+            return err.code in self.statuses
+        if isinstance(err, loaded(URL_ERRORS)):
+            # connection refused, DNS failure, timeout while connecting
+            return True
+        if getattr(err, 'filename', None) is not None:
+            # a local file error, not the network
+            return False
+        return isinstance(err, loaded(self.errors))
+
+    def delay(self, attempt, err=None):
+        '''seconds to wait before retry number attempt (counting from 1)'''
+        ceiling = min(self.max_delay,
+                      self.base_delay * (2 ** max(0, attempt - 1)))
+        wait = random.uniform(0, ceiling)
+        asked = retry_after(err)
+        if asked is not None:
+            wait = max(wait, min(asked, self.max_delay))
+        return wait
+
+
+class CircuitBreakers(object):
+    '''
+    >>> breakers = CircuitBreakers(threshold=5, reset_timeout=30.0)
+    >>> breakers.failure('mirror.example.com')
+    >>> breakers.available('mirror.example.com')
+    True
+    '''
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        # host -> [state, consecutive failures, opened at, trial running]
+        self.hosts = {}
+        self.trips = 0
+
+    def state(self, host):
+        with self.lock:
+            return self._state(host, time.time())
+
+    def _state(self, host, now):
+        entry = self.hosts.get(host)
+        if entry is None:
+            return CLOSED
+        if entry[0] == OPEN and now - entry[2] >= self.reset_timeout:
+            entry[0] = HALF_OPEN
+        return entry[0]
+
+    def available(self, host):
+        '''True if a job for host may be started now'''
+        with self.lock:
+            state = self._state(host, time.time())
+            return state == CLOSED or \
+                (state == HALF_OPEN and not self.hosts[host][3])
+
+    def started(self, host):
+        '''records that a job for an available host was handed out'''
+        with self.lock:
+            if self._state(host, time.time()) == HALF_OPEN:
+                self.hosts[host][3] = True
+
+    def success(self, host):
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def failure(self, host):
+        '''records a transient failure, opening the circuit at threshold'''
+        with self.lock:
+            entry = self.hosts.setdefault(host, [CLOSED, 0, 0.0, False])
+            entry[1] += 1
+            if entry[0] == HALF_OPEN or entry[1] >= self.threshold:
+                if entry[0] != OPEN:
+                    self.trips += 1
+                entry[0] = OPEN
+                entry[2] = time.time()
+                entry[3] = False
+
+    def wait_time(self, hosts):
+        '''seconds until the first open circuit among hosts half-opens'''
+        now = time.time()
+        waits = []
+        with self.lock:
+            for host in hosts:
+                entry = self.hosts.get(host)
+                if entry is not None and self._state(host, now) == OPEN:
+                    waits.append(entry[2] + self.reset_timeout - now)
+        if not waits:
+            return None
+        return max(0.0, min(waits))
+
+    def open_hosts(self):
+        with self.lock:
+            now = time.time()
+            return sorted(host for host in self.hosts
+                          if self._state(host, now) != CLOSED)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# Imports #####################################################################
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from libdlm import AsyncDownloadManager, DownloadFile
+from libdlm.tests.local_server import LocalHTTPServer
+
+
+###############################################################################
+class AsyncManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = dict(('/file%d.bin' % idx, os.urandom(4096))
+                          for idx in range(200))
+        self.server = LocalHTTPServer(self.files)
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_concurrent(self):
+        '''Verify many concurrent downloads complete on one loop'''
+        async def main():
+            dlm = AsyncDownloadManager()
+            tasks = [dlm.append(self.server.url(path), self.tmpdir)
+                     for path in self.files]
+            self.assertTrue(dlm.is_busy())
+            results = await asyncio.gather(*tasks)
+            self.assertFalse(dlm.is_busy())
+            return results
+
+        results = asyncio.run(main())
+        self.assertTrue(all(isinstance(dlf, DownloadFile) and dlf.complete
+                            for dlf in results))
+        for dlf in results:
+            self.assertIs(dlf.result(0), dlf)
+            self.assertEqual(dlf.path, os.path.join(
+                self.tmpdir, dlf.src.rsplit('/', 1)[1]))
+        for path, data in self.files.items():
+            with open(os.path.join(self.tmpdir, path[1:]), 'rb') as hndl:
+                self.assertEqual(hndl.read(), data)
+
+    def test_error(self):
+        '''Verify failures raise from the awaitable and reach the callback'''
+        errors = []
+
+        async def main():
+            dlm = AsyncDownloadManager()
+            task = dlm.append(self.server.url('/missing.bin'), self.tmpdir,
+                              lambda url, err=None: errors.append(err))
+            with self.assertRaises(Exception):
+                await task
+
+        asyncio.run(main())
+        self.assertEqual(len(errors), 1)
+
+    def test_pause(self):
+        '''Verify paused managers hold downloads until resumed'''
+        async def main():
+            dlm = AsyncDownloadManager()
+            dlm.pause()
+            task = dlm.append(self.server.url('/file0.bin'), self.tmpdir)
+            await asyncio.sleep(.2)
+            self.assertFalse(task.done())
+            dlm.resume()
+            await dlm.join()
+            self.assertTrue(task.result().complete)
+
+        asyncio.run(main())
+
+    def test_proxy(self):
+        '''Verify plain http goes through the proxy unless bypassed'''
+        url = 'http://origin.invalid/proxied.bin'
+        self.server.files[url] = b'p' * 1024
+
+        async def main():
+            dlm = AsyncDownloadManager(
+                proxies={'http': self.server.url('')})
+            proxied = await dlm.append(url, self.tmpdir)
+            dlm = AsyncDownloadManager(proxies={'http': 'http://127.0.0.1:9',
+                                                'no': '127.0.0.1'})
+            direct = await dlm.append(self.server.url('/file0.bin'),
+                                      self.tmpdir)
+            return proxied, direct
+
+        proxied, direct = asyncio.run(main())
+        with open(proxied.path, 'rb') as hndl:
+            self.assertEqual(hndl.read(), b'p' * 1024)
+        with open(direct.path, 'rb') as hndl:
+            self.assertEqual(hndl.read(), self.files['/file0.bin'])
+
+
+###############################################################################
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
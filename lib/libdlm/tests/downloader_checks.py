@@ -0,0 +1,824 @@
+#!/usr/bin/env python
+
+# Imports #####################################################################
+import bz2
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import socket
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+from libdlm.checksum import ChecksumError, StreamHasher
+from libdlm.connection_pool import ConnectionPool
+from libdlm.decode import StreamDecoder, detect
+from libdlm.dns_cache import DNSCache
+from libdlm.file_downloader import ChunkReader, FileDownloader
+from libdlm.file_sink import FileSink
+from libdlm.ftp_pool import FTPPool
+from libdlm.mirrors import Mirror, MirrorSet
+from libdlm.progress import ProgressMonitor, ProgressTracker
+from libdlm.retry import CircuitBreakers, RetryPolicy
+from libdlm.throttle import Throttle, TokenBucket
+from libdlm.tests.local_server import LocalFTPServer, LocalHTTPServer
+try:
+    from urllib2 import HTTPError
+except ImportError:
+    from urllib.error import HTTPError
+
+
+DATA = bytes(bytearray(range(256))) * 4096  # 1 MiB of non-repeating blocks
+# incompressible, so cut offsets land inside the compressed stream
+NOISE = b''.join(hashlib.sha256(str(idx).encode()).digest()
+                 for idx in range(8192))
+
+
+###############################################################################
+class FileDownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = LocalHTTPServer({'/big.bin': DATA})
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def read_local(self, name='big.bin'):
+        with open(os.path.join(self.tmpdir, name), 'rb') as file_hndl:
+            return file_hndl.read()
+
+    def range_gets(self):
+        return [req for req in self.server.requests
+                if req[0] == 'GET' and req[2]]
+
+    def test_segmented_download(self):
+        '''Verify large files are fetched as parallel byte ranges'''
+        downloader = FileDownloader(self.server.url('/big.bin'), self.tmpdir,
+                                    max_segments=4,
+                                    min_segment_size=64 * 1024)
+        self.assertTrue(downloader.download())
+        self.assertEqual(self.read_local(), DATA)
+        self.assertEqual(downloader.cur, len(DATA))
+        self.assertEqual(len(self.range_gets()), 4)
+
+    def test_segmented_fallback(self):
+        '''Verify servers ignoring Range fall back to a single stream'''
+        self.server.ranges = False
+        downloader = FileDownloader(self.server.url('/big.bin'), self.tmpdir,
+                                    max_segments=4,
+                                    min_segment_size=64 * 1024)
+        self.assertTrue(downloader.download())
+        self.assertEqual(self.read_local(), DATA)
+
+    def test_small_file_single_stream(self):
+        '''Verify files below two segments are not split'''
+        downloader = FileDownloader(self.server.url('/big.bin'), self.tmpdir)
+        self.assertTrue(downloader.download())
+        self.assertEqual(self.read_local(), DATA)
+        self.assertEqual(self.range_gets(), [])
+
+    def test_done_ranges(self):
+        '''Verify journalled ranges are skipped while the file is unchanged'''
+        with open(os.path.join(self.tmpdir, 'big.bin'), 'wb') as file_hndl:
+            file_hndl.write(DATA[:512 * 1024])
+        ranges = []
+        downloader = FileDownloader(self.server.url('/big.bin'), self.tmpdir,
+                                    max_segments=4,
+                                    min_segment_size=64 * 1024,
+                                    done_ranges=[(0, 512 * 1024 - 1)],
+                                    validator='"%x"' % len(DATA),
+                                    on_range=lambda *rng: ranges.append(rng))
+        downloader.download()
+        self.assertEqual(self.read_local(), DATA)
+        self.assertEqual(min(req[2] for req in self.range_gets()),
+                         'bytes=524288-655359')
+        self.assertEqual(sum(end - start + 1 for start, end, _ in ranges),
+                         512 * 1024)
+
+    def test_stale_ranges(self):
+        '''Verify ranges recorded for another file version are ignored'''
+        downloader = FileDownloader(self.server.url('/big.bin'), self.tmpdir,
+                                    done_ranges=[(0, 1023)],
+                                    validator='"old"')
+        self.assertEqual(downloader.done_ranges, [])
+
+    def test_single_probe(self):
+        '''Verify a download costs one HEAD and one GET'''
+        downloader = FileDownloader(self.server.url('/big.bin'), self.tmpdir)
+        downloader.download()
+        self.assertEqual([req[0] for req in self.server.requests],
+                         ['HEAD', 'GET'])
+        self.assertEqual(downloader.get_url_file_size(), len(DATA))
+        self.assertTrue(downloader.accepts_ranges)
+        self.assertNotEqual(downloader.etag, None)
+
+    def test_resume(self):
+        '''Verify resume fetches only the missing tail, guarded by If-Range'''
+        with open(os.path.join(self.tmpdir, 'big.bin'), 'wb') as file_hndl:
+            file_hndl.write(DATA[:1000])
+        downloader = FileDownloader(self.server.url('/big.bin'), self.tmpdir)
+        downloader.resume()
+        self.assertEqual(self.read_local(), DATA)
+        self.assertEqual(self.range_gets()[0][2], 'bytes=1000-')
+
+
+    def test_ftp_download(self):
+        '''Verify ftp urls download through the local FTP server'''
+        server = LocalFTPServer({'/pub/big.bin': DATA})
+        try:
+            downloader = FileDownloader(server.url('/pub/big.bin'),
+                                        self.tmpdir)
+            self.assertTrue(downloader.download())
+        finally:
+            server.shutdown()
+        self.assertEqual(self.read_local(), DATA)
+
+
+###############################################################################
+class FTPTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = LocalFTPServer(dict(('/pub/%d.bin' % idx, DATA)
+                                          for idx in range(3)))
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def commands(self, name):
+        return [arg for cmd, arg in self.server.requests if cmd == name]
+
+    def read_local(self, name):
+        with open(os.path.join(self.tmpdir, name), 'rb') as file_hndl:
+            return file_hndl.read()
+
+    def test_session_reuse(self):
+        '''Verify files from one host share a logged in session'''
+        pool = FTPPool()
+        for idx in range(3):
+            downloader = FileDownloader(self.server.url('/pub/%d.bin' % idx),
+                                        self.tmpdir, ftp_pool=pool)
+            self.assertEqual(downloader.get_url_file_size(), len(DATA))
+            downloader.download()
+            self.assertEqual(self.read_local('%d.bin' % idx), DATA)
+        self.assertEqual(len(self.commands('USER')), 1)
+        self.assertEqual(self.commands('CWD'), ['/pub'])
+        self.assertEqual(pool.stats()['idle'], 1)
+        pool.clear()
+
+    def test_segments(self):
+        '''Verify large files are fetched as parallel REST offsets'''
+        pool = FTPPool()
+        downloader = FileDownloader(self.server.url('/pub/0.bin'),
+                                    self.tmpdir, ftp_pool=pool,
+                                    min_segment_size=64 * 1024)
+        self.assertTrue(downloader.download())
+        self.assertEqual(self.read_local('0.bin'), DATA)
+        self.assertEqual(len(self.commands('RETR')), 4)
+        self.assertEqual(sorted(int(arg) for arg in self.commands('REST')),
+                         [262144, 524288, 786432])
+        pool.clear()
+
+    def test_resume(self):
+        '''Verify resume restarts the transfer at the local size'''
+        with open(os.path.join(self.tmpdir, '1.bin'), 'wb') as file_hndl:
+            file_hndl.write(DATA[:1000])
+        downloader = FileDownloader(self.server.url('/pub/1.bin'),
+                                    self.tmpdir)
+        downloader.resume()
+        self.assertEqual(self.read_local('1.bin'), DATA)
+        self.assertEqual(self.commands('REST'), ['1000'])
+        downloader.ftp_pool.clear()
+
+
+###############################################################################
+class MirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.servers = [LocalHTTPServer({'/big.bin': DATA})
+                        for _ in range(3)]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def urls(self):
+        return [server.url('/big.bin') for server in self.servers]
+
+    def gets(self, server):
+        return [req for req in server.requests if req[0] == 'GET']
+
+    def download(self, **kwargs):
+        urls = self.urls()
+        downloader = FileDownloader(urls[0], self.tmpdir, mirrors=urls[1:],
+                                    min_segment_size=16 * 1024,
+                                    max_segments=4, **kwargs)
+        self.assertTrue(downloader.download())
+        with open(os.path.join(self.tmpdir, 'big.bin'), 'rb') as file_hndl:
+            self.assertEqual(file_hndl.read(), DATA)
+        return downloader
+
+    def test_pick(self):
+        '''Verify pieces go to the fastest mirror with room to spare'''
+        fast, slow = Mirror('fast', rtt=0.2), Mirror('slow', rtt=0.01)
+        mirrors = MirrorSet([fast, slow])
+        # unmeasured, the nearest goes first
+        self.assertIs(mirrors.pick(), slow)
+        mirrors.done(slow, 1000, 1.0)
+        fast.rate = 10000.0
+        self.assertIs(mirrors.pick(), fast)
+        self.assertIs(mirrors.pick(), fast)
+        fast.active = 20
+        self.assertIs(mirrors.pick(), slow)
+
+    def test_last_mirror_kept(self):
+        '''Verify transient errors never drop the only mirror left'''
+        first, last = Mirror('first'), Mirror('last')
+        mirrors = MirrorSet([first, last], max_errors=1)
+        mirrors.failed(mirrors.pick(), socket.error())
+        mirrors.failed(mirrors.pick(), socket.error())
+        self.assertEqual(mirrors.live(), [last])
+        mirrors.failed(mirrors.pick(), ValueError(), fatal=True)
+        self.assertEqual(mirrors.live(), [])
+        self.assertIsNone(mirrors.pick())
+
+    def test_spread(self):
+        '''Verify a file is fetched from every mirror, most from the fast'''
+        self.servers[2].delay = 0.2
+        downloader = self.download()
+        for server in self.servers:
+            self.assertTrue(self.gets(server))
+        fetched = [mirror.fetched for mirror in downloader.sources.mirrors]
+        self.assertEqual(sum(fetched), len(DATA))
+        self.assertLess(fetched[2], fetched[0] + fetched[1])
+
+    def test_bad_mirrors(self):
+        '''Verify mirrors that lack the file or stall are dropped'''
+        del self.servers[1].files['/big.bin']
+        self.servers[2].delay = 2
+        downloader = self.download(stall_timeout=0.3)
+        self.assertEqual([mirror.url for mirror in downloader.sources.live()],
+                         [downloader.url])
+        self.assertFalse(self.gets(self.servers[1]))
+
+    def test_primary_down(self):
+        '''Verify an unreachable url is replaced by its first mirror'''
+        urls = self.urls()
+        self.servers[0].shutdown()
+        self.servers[0] = LocalHTTPServer()
+        downloader = FileDownloader(urls[0], self.tmpdir, mirrors=urls[1:],
+                                    max_segments=1)
+        self.assertEqual(str(downloader.url), urls[1])
+        downloader.download()
+        with open(os.path.join(self.tmpdir, 'big.bin'), 'rb') as file_hndl:
+            self.assertEqual(file_hndl.read(), DATA)
+
+    def test_primary_missing(self):
+        '''Verify a url answering with an error status is replaced'''
+        del self.servers[0].files['/big.bin']
+        urls = self.urls()
+        downloader = FileDownloader(urls[0], self.tmpdir, mirrors=urls[1:],
+                                    max_segments=1)
+        self.assertEqual(str(downloader.url), urls[1])
+        self.assertEqual(downloader.url_file_size, len(DATA))
+        downloader.download()
+        with open(os.path.join(self.tmpdir, 'big.bin'), 'rb') as file_hndl:
+            self.assertEqual(file_hndl.read(), DATA)
+        self.assertFalse(self.gets(self.servers[0]))
+
+
+###############################################################################
+def gzipped(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as file_hndl:
+        file_hndl.write(data)
+    return buf.getvalue()
+
+
+def tarball(members, mode='w:bz2'):
+    '''returns a compressed tar of {name: data}'''
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for name, data in sorted(members.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+###############################################################################
+class DecodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = LocalHTTPServer({'/data.bin.gz': gzipped(NOISE)})
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def read_local(self, name):
+        with open(os.path.join(self.tmpdir, name), 'rb') as file_hndl:
+            return file_hndl.read()
+
+    def test_detect(self):
+        '''Verify codecs and decoded names are taken from the suffix'''
+        self.assertEqual(detect('a.tar.gz'), ('gz', 'a.tar'))
+        self.assertEqual(detect('a.TGZ'), ('gz', 'a.tar'))
+        self.assertEqual(detect('a.csv.bz2'), ('bz2', 'a.csv'))
+        self.assertEqual(detect('a.tar'), ('', 'a.tar'))
+        self.assertEqual(detect('a.zip'), (None, 'a.zip'))
+
+    def test_gunzip(self):
+        '''Verify only the decompressed file reaches the disk'''
+        downloader = FileDownloader(self.server.url('/data.bin.gz'),
+                                    self.tmpdir, decode=True,
+                                    checksum='size:%d' % len(gzipped(NOISE)))
+        downloader.download()
+        self.assertEqual(self.read_local('data.bin'), NOISE)
+        self.assertEqual(os.listdir(self.tmpdir), ['data.bin'])
+
+    def test_concatenated(self):
+        '''Verify files made of several compressed streams decode whole'''
+        self.server.files['/two.bz2'] = \
+            bz2.compress(NOISE[:1000]) + bz2.compress(NOISE[1000:])
+        FileDownloader(self.server.url('/two.bz2'), self.tmpdir,
+                       decode=True).download()
+        self.assertEqual(self.read_local('two'), NOISE)
+
+    def test_resume_compressed_offset(self):
+        '''Verify a dropped stream resumes from the compressed offset'''
+        self.server.cuts['/data.bin.gz'] = 10000
+        downloader = FileDownloader(
+            self.server.url('/data.bin.gz'), self.tmpdir, decode='gz',
+            retry_policy=RetryPolicy(retries=2, base_delay=0.01))
+        downloader.download()
+        self.assertEqual(self.read_local('data.bin'), NOISE)
+        ranges = [req[2] for req in self.server.requests if req[0] == 'GET']
+        self.assertEqual(ranges, [None, 'bytes=10000-'])
+
+    def test_truncated(self):
+        '''Verify a stream that ends early is an error'''
+        decoder = StreamDecoder('gz', os.path.join(self.tmpdir, 'part'))
+        decoder.write_at(0, gzipped(NOISE)[:5000])
+        self.assertRaises(ValueError, decoder.finish)
+
+    def test_extract(self):
+        '''Verify tar archives are unpacked as they stream in'''
+        members = {'top.txt': b'top', 'sub/inner.bin': NOISE}
+        self.server.files['/archive.tar.bz2'] = tarball(members)
+        downloader = FileDownloader(self.server.url('/archive.tar.bz2'),
+                                    self.tmpdir, decode=True, extract=True)
+        downloader.download()
+        self.assertEqual(downloader.local_file_name, self.tmpdir)
+        for name, data in members.items():
+            self.assertEqual(self.read_local(name), data)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, 'archive.tar.bz2')))
+
+    def test_unsafe_member(self):
+        '''Verify members escaping the destination are refused'''
+        self.server.files['/evil.tar'] = tarball({'../evil': b'x'}, 'w')
+        downloader = FileDownloader(self.server.url('/evil.tar'),
+                                    self.tmpdir, decode=True, extract=True)
+        self.assertRaises(ValueError, downloader.download)
+        self.assertFalse(os.path.exists(
+            os.path.join(os.path.dirname(self.tmpdir), 'evil')))
+
+
+###############################################################################
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = LocalHTTPServer({'/big.bin': DATA})
+        self.policy = RetryPolicy(retries=3, base_delay=0.01, max_delay=0.05)
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_retryable(self):
+        '''Verify only transient errors are retried'''
+        self.assertTrue(self.policy.retryable(socket.timeout()))
+        self.assertTrue(self.policy.retryable(
+            HTTPError('http://a/', 503, 'busy', {}, None)))
+        self.assertFalse(self.policy.retryable(
+            HTTPError('http://a/', 404, 'missing', {}, None)))
+        self.assertFalse(self.policy.retryable(
+            IOError(28, 'No space left on device', '/tmp/file')))
+        self.assertFalse(self.policy.retryable(ValueError('changed')))
+
+    def test_delay(self):
+        '''Verify delays back off exponentially with jitter up to the cap'''
+        policy = RetryPolicy(base_delay=1.0, max_delay=4.0)
+        for attempt, ceiling in ((1, 1.0), (2, 2.0), (3, 4.0), (9, 4.0)):
+            delays = [policy.delay(attempt) for _ in range(50)]
+            self.assertTrue(0 <= min(delays) and max(delays) <= ceiling)
+            self.assertNotEqual(len(set(delays)), 1)
+        err = HTTPError('http://a/', 429, 'slow down', {'Retry-After': '3'},
+                        None)
+        self.assertTrue(policy.delay(1, err) >= 3.0)
+
+    def test_breaker(self):
+        '''Verify a circuit opens, lets one trial through, then closes'''
+        breakers = CircuitBreakers(threshold=2, reset_timeout=0.05)
+        breakers.failure('a')
+        self.assertTrue(breakers.available('a'))
+        breakers.failure('a')
+        self.assertFalse(breakers.available('a'))
+        self.assertEqual(breakers.open_hosts(), ['a'])
+        self.assertTrue(0 < breakers.wait_time(['a', 'b']) <= 0.05)
+        time.sleep(0.06)
+        self.assertTrue(breakers.available('a'))
+        breakers.started('a')
+        self.assertFalse(breakers.available('a'))
+        breakers.failure('a')
+        self.assertEqual(breakers.state('a'), 'open')
+        time.sleep(0.06)
+        breakers.started('a')
+        breakers.success('a')
+        self.assertEqual(breakers.state('a'), 'closed')
+        self.assertEqual(breakers.trips, 2)
+
+    def test_transient_failure(self):
+        '''Verify a download gets past a few 503s'''
+        self.server.failures['/big.bin'] = 2
+        downloader = FileDownloader(self.server.url('/big.bin'), self.tmpdir,
+                                    retry_policy=self.policy)
+        self.assertTrue(downloader.download())
+        with open(os.path.join(self.tmpdir, 'big.bin'), 'rb') as file_hndl:
+            self.assertEqual(file_hndl.read(), DATA)
+        self.assertEqual(downloader.curretry, 2)
+
+    def test_probe_failure(self):
+        '''Verify a probe that fails transiently is retried'''
+        self.server.drops['/big.bin'] = 2
+        downloader = FileDownloader(self.server.url('/big.bin'), self.tmpdir,
+                                    retry_policy=self.policy)
+        self.assertEqual(downloader.url_file_size, len(DATA))
+        self.assertTrue(downloader.download())
+        heads = [req for req in self.server.requests if req[0] == 'HEAD']
+        self.assertEqual(len(heads), 3)
+
+    def test_segment_failure(self):
+        '''Verify a failing segment is retried without restarting the rest'''
+        self.server.failures['/big.bin'] = 1
+        downloader = FileDownloader(self.server.url('/big.bin'), self.tmpdir,
+                                    max_segments=4,
+                                    min_segment_size=64 * 1024,
+                                    retry_policy=self.policy)
+        self.assertTrue(downloader.download())
+        with open(os.path.join(self.tmpdir, 'big.bin'), 'rb') as file_hndl:
+            self.assertEqual(file_hndl.read(), DATA)
+
+    def test_permanent_failure(self):
+        '''Verify errors that cannot clear up are not retried'''
+        self.server.failures['/big.bin'] = 10
+        downloader = FileDownloader(self.server.url('/big.bin'), self.tmpdir,
+                                    retry_policy=self.policy)
+        self.assertRaises(HTTPError, downloader.download)
+        gets = [req for req in self.server.requests if req[0] == 'GET']
+        self.assertEqual(len(gets), 4)
+
+
+###############################################################################
+class ChunkReaderTest(unittest.TestCase):
+
+    def test_adaptive_growth(self):
+        '''Verify fast reads grow the chunk size up to the bound'''
+        reader = ChunkReader(1024, 16 * 1024)
+        stream = io.BytesIO(DATA)
+        total = 0
+        while True:
+            chunk = reader.read(stream)
+            if not chunk:
+                break
+            self.assertEqual(chunk.tobytes(), DATA[total:total + len(chunk)])
+            total += len(chunk)
+        self.assertEqual(total, len(DATA))
+        self.assertEqual(reader.size, 16 * 1024)
+
+    def test_limit(self):
+        '''Verify reads never exceed the requested limit'''
+        reader = ChunkReader(1024, 16 * 1024)
+        self.assertEqual(len(reader.read(io.BytesIO(DATA), 100)), 100)
+
+    def test_exact_count(self):
+        '''Verify progress counts the bytes actually received'''
+        server = LocalHTTPServer({'/odd.bin': DATA[:12345]})
+        tmpdir = tempfile.mkdtemp()
+        try:
+            downloader = FileDownloader(server.url('/odd.bin'), tmpdir)
+            downloader.download()
+            self.assertEqual(downloader.cur, 12345)
+        finally:
+            server.shutdown()
+            shutil.rmtree(tmpdir)
+
+
+###############################################################################
+class ChecksumTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = LocalHTTPServer({'/big.bin': DATA})
+        self.sha256 = 'sha256:%s' % hashlib.sha256(DATA).hexdigest()
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def download(self, checksum, **kwargs):
+        return FileDownloader(self.server.url('/big.bin'), self.tmpdir,
+                              checksum=checksum, **kwargs).download()
+
+    def test_out_of_order(self):
+        '''Verify chunks written out of order are hashed in file order'''
+        path = os.path.join(self.tmpdir, 'out.bin')
+        with open(path, 'wb') as file_hndl:
+            file_hndl.write(DATA)
+        hasher = StreamHasher(self.sha256)
+        half = len(DATA) // 2
+        hasher.update(half, DATA[half:], path)
+        self.assertEqual(hasher.pos, 0)
+        hasher.update(0, DATA[:half], path)
+        self.assertEqual(hasher.pos, len(DATA))
+        hasher.verify(path)
+
+    def test_segmented(self):
+        '''Verify a segmented download is checked without a second pass'''
+        self.assertTrue(self.download(self.sha256, max_segments=4,
+                                      min_segment_size=64 * 1024))
+
+    def test_single_stream(self):
+        '''Verify single stream downloads check digests and sizes'''
+        self.assertTrue(self.download('md5:%s' % hashlib.md5(DATA).hexdigest(),
+                                      max_segments=1))
+        self.assertTrue(self.download(len(DATA), max_segments=1))
+
+    def test_mismatch(self):
+        '''Verify a wrong digest raises ChecksumError'''
+        self.assertRaises(ChecksumError, self.download, 'sha1:%s' % ('0' * 40))
+        self.assertRaises(ValueError, self.download, 'crc32:1234')
+
+
+###############################################################################
+class FileSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'out.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_preallocate(self):
+        '''Verify the file is sized up front and filled out of order'''
+        sink = FileSink(self.path, len(DATA))
+        self.assertEqual(os.path.getsize(self.path), len(DATA))
+        half = len(DATA) // 2
+        sink.write_at(half, DATA[half:])
+        sink.write_at(0, memoryview(DATA)[:half])
+        sink.close()
+        with open(self.path, 'rb') as file_hndl:
+            self.assertEqual(file_hndl.read(), DATA)
+
+    def test_keep(self):
+        '''Verify keep preserves written ranges and truncates overlong files'''
+        with open(self.path, 'wb') as file_hndl:
+            file_hndl.write(b'abcdef')
+        sink = FileSink(self.path, 4, keep=True)
+        sink.write_at(2, b'X')
+        sink.close()
+        with open(self.path, 'rb') as file_hndl:
+            self.assertEqual(file_hndl.read(), b'abXd')
+
+
+###############################################################################
+class ProgressTest(unittest.TestCase):
+
+    def test_throttled(self):
+        '''Verify events are only emitted once per interval'''
+        events = []
+        tracker = ProgressTracker('src', 1000, events.append, interval=60)
+        for _ in range(10):
+            tracker.update(100)
+        self.assertEqual(events, [])
+        event = tracker.finish()
+        self.assertEqual(events, [event])
+        self.assertEqual((event.done, event.total), (1000, 1000))
+
+    def test_byte_interval(self):
+        '''Verify byte_interval emits an event per chunk of bytes'''
+        events = []
+        tracker = ProgressTracker('src', 1000, events.append, interval=60,
+                                  byte_interval=250)
+        for _ in range(10):
+            tracker.update(100)
+        self.assertEqual([event.done for event in events], [300, 600, 900])
+
+    def test_download_events(self):
+        '''Verify downloads report progress and feed the monitor'''
+        server = LocalHTTPServer({'/big.bin': DATA})
+        tmpdir = tempfile.mkdtemp()
+        events = []
+        monitor = ProgressMonitor()
+        try:
+            downloader = FileDownloader(server.url('/big.bin'), tmpdir,
+                                        max_segments=4,
+                                        min_segment_size=64 * 1024,
+                                        progress_bytes=64 * 1024,
+                                        monitor=monitor)
+            downloader.download(callback=events.append)
+        finally:
+            server.shutdown()
+            shutil.rmtree(tmpdir)
+        self.assertTrue(len(events) > 1)
+        self.assertEqual(events[-1].done, len(DATA))
+        self.assertEqual(events[-1].eta, 0)
+        aggregate = monitor.snapshot()
+        self.assertEqual((aggregate.done, aggregate.total),
+                         (len(DATA), len(DATA)))
+
+
+###############################################################################
+class ThrottleTest(unittest.TestCase):
+
+    def test_bucket_rate(self):
+        '''Verify a shared bucket holds throughput to its rate'''
+        bucket = TokenBucket(4 * 1024 * 1024)
+        start = time.time()
+        for _ in range(32):
+            bucket.consume(64 * 1024)
+        elapsed = time.time() - start
+        self.assertTrue(0.45 < elapsed < 0.6, elapsed)
+
+    def test_runtime_change(self):
+        '''Verify removing a limit takes effect immediately'''
+        bucket = TokenBucket(1024)
+        bucket.set_rate(None)
+        start = time.time()
+        bucket.consume(1024 * 1024)
+        self.assertLess(time.time() - start, 0.1)
+
+    def test_host_limit(self):
+        '''Verify per-host limits apply to downloads from that host'''
+        server = LocalHTTPServer({'/big.bin': DATA})
+        tmpdir = tempfile.mkdtemp()
+        throttle = Throttle(host_rates={'127.0.0.1': 2 * 1024 * 1024})
+        try:
+            downloader = FileDownloader(server.url('/big.bin'), tmpdir,
+                                        max_segments=4,
+                                        min_segment_size=64 * 1024,
+                                        throttle=throttle)
+            start = time.time()
+            downloader.download()
+            elapsed = time.time() - start
+        finally:
+            server.shutdown()
+            shutil.rmtree(tmpdir)
+        self.assertTrue(0.45 < elapsed < 0.7, elapsed)
+        self.assertEqual(throttle.max_chunk('127.0.0.1'),
+                         2 * 1024 * 1024 // 10)
+        self.assertEqual(throttle.max_chunk('other'), None)
+
+
+###############################################################################
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalHTTPServer({'/small.bin': b'x' * 1024})
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def test_reuse(self):
+        '''Verify sequential requests to one host share a connection'''
+        pool = ConnectionPool(size=2)
+        url = self.server.url('/small.bin')
+        for _ in range(3):
+            self.assertEqual(pool.request(url).read(), b'x' * 1024)
+        stats = pool.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['idle'], 1)
+
+    def test_idle_timeout(self):
+        '''Verify connections idle past the timeout are not reused'''
+        pool = ConnectionPool(idle_timeout=-1)
+        for _ in range(2):
+            pool.request(self.server.url('/small.bin')).read()
+        self.assertEqual(pool.stats()['hits'], 0)
+        self.assertEqual(pool.stats()['discarded'], 1)
+
+    def test_unread_body_discarded(self):
+        '''Verify a connection with an unread body is never reused'''
+        pool = ConnectionPool()
+        pool.request(self.server.url('/small.bin')).close()
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    def test_http_error(self):
+        '''Verify error statuses raise HTTPError and keep the connection'''
+        pool = ConnectionPool()
+        url = self.server.url('/missing.bin')
+        self.assertRaises(Exception, pool.request, url)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def test_redirect_auth(self):
+        '''Verify credentials follow redirects within their origin only'''
+        other = LocalHTTPServer({'/small.bin': b'y' * 1024})
+        self.server.redirects['/same.bin'] = self.server.url('/small.bin')
+        self.server.redirects['/other.bin'] = other.url('/small.bin')
+        pool = ConnectionPool()
+        try:
+            for path in ('/same.bin', '/other.bin'):
+                pool.request(self.server.url(path), auth=('user', 'pass'))
+        finally:
+            other.shutdown()
+        sent = [(path, 'authorization' in headers)
+                for path, headers in self.server.headers + other.headers]
+        self.assertEqual(sent, [('/same.bin', True), ('/small.bin', True),
+                                ('/other.bin', True), ('/small.bin', False)])
+
+    def test_proxy(self):
+        '''Verify plain http goes through the proxy unless bypassed'''
+        url = 'http://origin.invalid/small.bin'
+        self.server.files[url] = b'p' * 1024
+        pool = ConnectionPool(proxies={'http': self.server.url('')})
+        self.assertEqual(pool.request(url).read(), b'p' * 1024)
+        pool = ConnectionPool(proxies={'http': 'http://127.0.0.1:9',
+                                       'no': '127.0.0.1'})
+        response = pool.request(self.server.url('/small.bin'))
+        self.assertEqual(response.read(), b'x' * 1024)
+
+
+###############################################################################
+class DNSCacheTest(unittest.TestCase):
+
+    def test_shared_lookup(self):
+        '''Verify new connections of every pool reuse one lookup'''
+        http = LocalHTTPServer({'/small.bin': b'x' * 1024})
+        ftp = LocalFTPServer({'/small.bin': b'y' * 1024})
+        resolver = DNSCache()
+        try:
+            for _ in range(2):
+                pool = ConnectionPool(resolver=resolver)
+                url = 'http://localhost:%d/small.bin' % http.server_address[1]
+                self.assertEqual(pool.request(url).read(), b'x' * 1024)
+            ftp_pool = FTPPool(resolver=resolver)
+            response = ftp_pool.retrieve('localhost', ftp.server_address[1],
+                                         None, None, '/small.bin')
+            self.assertEqual(response.read(), b'y' * 1024)
+            ftp_pool.clear()
+        finally:
+            http.shutdown()
+            ftp.shutdown()
+        stats = resolver.stats()
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['entries'], 2)
+
+    def test_negative(self):
+        '''Verify failed lookups are cached for negative_ttl'''
+        resolver = DNSCache(negative_ttl=60)
+        for _ in range(2):
+            self.assertRaises(socket.gaierror, resolver.resolve,
+                              'nonexistent.invalid', 80)
+        self.assertEqual(resolver.stats()['misses'], 1)
+        self.assertEqual(resolver.stats()['negative_hits'], 1)
+
+    def test_expiry(self):
+        '''Verify lookups older than the ttl are made again'''
+        resolver = DNSCache(ttl=0.05)
+        resolver.resolve('localhost', 80)
+        time.sleep(0.1)
+        resolver.resolve('localhost', 80)
+        self.assertEqual(resolver.stats()['misses'], 2)
+
+    def test_concurrent_miss(self):
+        '''Verify threads missing on one name share a single lookup'''
+        resolver = DNSCache()
+        threads = [threading.Thread(target=resolver.resolve,
+                                    args=('localhost', 80))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = resolver.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 9)
+
+
+###############################################################################
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+'''
+Small threaded HTTP and FTP servers used by the tests and benchmarks so
+downloads can be exercised without touching the internet.  Files are served
+from memory.  The HTTP server honours single byte range requests unless ranges
+are disabled, can redirect paths elsewhere, records the headers of every
+request, can hang up on the first requests of a path without answering, can
+answer the first GETs of a path with 503s and can cut the
+first GET of a path short, and can hold every body back to play a slow or
+stalled mirror; the FTP server supports passive mode RETR with REST offsets.
+'''
+
+# Imports #####################################################################
+import posixpath
+import re
+import socket
+import threading
+import time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+
+
+RANGE_RE = re.compile(r'bytes=(\d+)-(\d*)')
+
+
+###############################################################################
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    '''serves self.server.files with optional support for Range requests'''
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes, don't let Nagle hold the
+    # body back for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send_body(self, head_only):
+        path = self.path.split('?')[0]
+        self.server.requests.append((self.command, path,
+                                     self.headers.get('Range')))
+        # python 2 lower-cases header names, do the same everywhere
+        self.server.headers.append((path, dict(
+            (key.lower(), value) for key, value in self.headers.items())))
+        if self.server.drops.get(path):
+            self.server.drops[path] -= 1
+            self.close_connection = True
+            return
+        location = self.server.redirects.get(path)
+        if location is not None:
+            self.send_response(302)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = self.server.files.get(path)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if not head_only and self.server.failures.get(path):
+            self.server.failures[path] -= 1
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = 0, len(data) - 1
+        match = RANGE_RE.match(self.headers.get('Range') or '')
+        if match and self.server.ranges:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, len(data)))
+        else:
+            self.send_response(200)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', '"%x"' % len(data))
+        self.end_headers()
+        if head_only:
+            return
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        cut = self.server.cuts.pop(path, None)
+        if cut is not None:
+            # drop the connection part way through the body
+            self.wfile.write(data[start:start + cut])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:end + 1])
+
+    def do_GET(self):
+        self._send_body(False)
+
+    def do_HEAD(self):
+        self._send_body(True)
+
+
+###############################################################################
+class LocalHTTPServer(ThreadingMixIn, HTTPServer):
+    '''
+    In-memory HTTP server running on a background thread
+
+    >>> server = LocalHTTPServer({'/file.bin': b'data'})
+    >>> server.url('/file.bin')
+    'http://127.0.0.1:.../file.bin'
+    >>> server.shutdown()
+    '''
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, files=None, ranges=True):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), RangeRequestHandler)
+        self.files = files or {}
+        self.ranges = ranges
+        self.requests = []
+        # (path, headers with lower-cased names) of each request
+        self.headers = []
+        # path -> url it is redirected to with a 302
+        self.redirects = {}
+        # path -> number of requests still to be hung up on unanswered
+        self.drops = {}
+        # path -> number of GETs still to be refused with a 503
+        self.failures = {}
+        # path -> bytes of the next GET's body sent before hanging up
+        self.cuts = {}
+        # seconds each GET body is held back
+        self.delay = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def shutdown(self):
+        HTTPServer.shutdown(self)
+        self.server_close()
+
+
+###############################################################################
+class FTPRequestHandler(StreamRequestHandler):
+    '''
+    serves self.server.files over a minimal FTP control connection: any
+    login is accepted and only passive (PASV/EPSV) data connections are used
+    '''
+    disable_nagle_algorithm = True
+
+    def reply(self, line):
+        self.wfile.write(('%s\r\n' % line).encode('latin-1'))
+
+    def handle(self):
+        self.cwd = '/'
+        self.rest = 0
+        self.data_sock = None
+        self.reply('220 libdlm test server')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            cmd, _, arg = line.decode('latin-1').strip().partition(' ')
+            cmd = cmd.upper()
+            self.server.requests.append((cmd, arg))
+            handler = getattr(self, 'ftp_%s' % cmd, None)
+            if handler is None:
+                self.reply('502 %s not implemented' % cmd)
+            elif handler(arg) is False:
+                break
+        if self.data_sock is not None:
+            self.data_sock.close()
+
+    def _path(self, arg):
+        return posixpath.normpath(posixpath.join(self.cwd, arg))
+
+    def ftp_USER(self, arg):
+        self.reply('331 password please')
+
+    def ftp_PASS(self, arg):
+        self.reply('230 logged in')
+
+    def ftp_SYST(self, arg):
+        self.reply('215 UNIX Type: L8')
+
+    def ftp_TYPE(self, arg):
+        self.reply('200 type set to %s' % arg)
+
+    def ftp_NOOP(self, arg):
+        self.reply('200 ok')
+
+    def ftp_PWD(self, arg):
+        self.reply('257 "%s"' % self.cwd)
+
+    def ftp_CWD(self, arg):
+        path = self._path(arg)
+        prefix = path.rstrip('/') + '/'
+        if any(name.startswith(prefix) for name in self.server.files):
+            self.cwd = path
+            self.reply('250 ok')
+        else:
+            self.reply('550 no such directory')
+
+    def ftp_SIZE(self, arg):
+        data = self.server.files.get(self._path(arg))
+        if data is None:
+            self.reply('550 no such file')
+        else:
+            self.reply('213 %d' % len(data))
+
+    def ftp_REST(self, arg):
+        self.rest = int(arg)
+        self.reply('350 restarting at %d' % self.rest)
+
+    def _listen(self):
+        if self.data_sock is not None:
+            self.data_sock.close()
+        self.data_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.data_sock.bind(('127.0.0.1', 0))
+        self.data_sock.listen(1)
+        self.data_sock.settimeout(10)
+        return self.data_sock.getsockname()[1]
+
+    def ftp_PASV(self, arg):
+        port = self._listen()
+        self.reply('227 Entering Passive Mode (127,0,0,1,%d,%d)' %
+                   (port >> 8, port & 0xff))
+
+    def ftp_EPSV(self, arg):
+        self.reply('229 Entering Extended Passive Mode (|||%d|)' %
+                   self._listen())
+
+    def ftp_RETR(self, arg):
+        data = self.server.files.get(self._path(arg))
+        rest, self.rest = self.rest, 0
+        if data is None:
+            self.reply('550 no such file')
+            return
+        if self.data_sock is None:
+            self.reply('425 use PASV first')
+            return
+        self.reply('150 sending %d bytes' % (len(data) - rest))
+        try:
+            conn, _ = self.data_sock.accept()
+            try:
+                conn.sendall(data[rest:])
+            finally:
+                conn.close()
+        except (socket.error, socket.timeout):
+            self.reply('426 transfer aborted')
+            return
+        finally:
+            self.data_sock.close()
+            self.data_sock = None
+        self.reply('226 transfer complete')
+
+    def ftp_QUIT(self, arg):
+        self.reply('221 bye')
+        return False
+
+
+###############################################################################
+class LocalFTPServer(ThreadingMixIn, TCPServer):
+    '''
+    In-memory FTP server running on a background thread
+
+    >>> server = LocalFTPServer({'/pub/file.bin': b'data'})
+    >>> server.url('/pub/file.bin')
+    'ftp://127.0.0.1:.../pub/file.bin'
+    >>> server.shutdown()
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, files=None):
+        TCPServer.__init__(self, ('127.0.0.1', 0), FTPRequestHandler)
+        self.files = files or {}
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'ftp://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def shutdown(self):
+        TCPServer.shutdown(self)
+        self.server_close()
@@ -0,0 +1,627 @@
+#!/usr/bin/env python
+
+# Imports #####################################################################
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from libdlm import (CancelledError, DownloadFile, DownloadManager, JobQueue,
+                    Settings, States, TimeoutError)
+from libdlm.autoscale import ScalingPolicy
+from libdlm.cache import ContentCache
+from libdlm.checksum import ChecksumError
+from libdlm.journal import Journal
+from libdlm.pipeline import Pipeline
+from libdlm.retry import CircuitBreakers
+from libdlm.tests.local_server import LocalHTTPServer
+
+
+def double(path):
+    '''pipeline stage writing the file twice over into <path>.2'''
+    with open(path, 'rb') as file_hndl:
+        data = file_hndl.read()
+    with open(path + '.2', 'wb') as file_hndl:
+        file_hndl.write(data * 2)
+    return path + '.2'
+
+
+def explode(path):
+    raise ValueError('cannot process %s' % path)
+
+
+def slow(path):
+    time.sleep(0.2)
+    return path
+
+
+class Countdown(object):
+    '''job callback recording each outcome, set once count have arrived'''
+
+    def __init__(self, count):
+        self.count = count
+        self.errors = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def __call__(self, url, err=None):
+        with self.lock:
+            self.errors.append(err)
+            if len(self.errors) >= self.count:
+                self.done.set()
+
+    def wait(self, timeout):
+        return self.done.wait(timeout)
+
+
+###############################################################################
+class ManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = LocalHTTPServer({'/small.bin': b'x' * 1024})
+        self.dlm = DownloadManager(Settings({'thread_count': 2}))
+
+    def tearDown(self):
+        self.dlm.stop()
+        self.server.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_dispatch_latency(self):
+        '''Verify a newly appended job starts without a polling delay'''
+        done = threading.Event()
+        start = time.time()
+        self.dlm.append(self.server.url('/small.bin'), self.tmpdir,
+                        lambda url, err=None: done.set())
+        self.assertTrue(done.wait(5))
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_pause_resume(self):
+        '''Verify paused workers leave the queue alone until resumed'''
+        done = threading.Event()
+        # workers only start with the first job, bring them up to pause them
+        self.dlm.start()
+        self.dlm.pause()
+        time.sleep(.1)
+        self.assertEqual(len(self.dlm.threads), 2)
+        self.assertTrue(all(thread.state == States.PAUSED
+                            for thread in self.dlm.threads))
+        self.dlm.append(self.server.url('/small.bin'), self.tmpdir,
+                        lambda url, err=None: done.set())
+        self.assertFalse(done.wait(.3))
+        self.assertTrue(self.dlm.is_busy())
+
+        self.dlm.resume()
+        self.assertTrue(done.wait(5))
+
+    def test_futures(self):
+        '''Verify append() handles resolve as each download lands'''
+        self.dlm.pause()
+        dirs = [tempfile.mkdtemp(dir=self.tmpdir) for _ in range(2)]
+        jobs = [self.dlm.append(self.server.url('/small.bin'), dst)
+                for dst in dirs]
+        missing = self.dlm.append(self.server.url('/missing.bin'),
+                                  self.tmpdir)
+        self.assertRaises(TimeoutError, jobs[0].result, 0.1)
+        self.assertFalse(self.dlm.wait_all(0.1))
+        landed = []
+        jobs[0].add_done_callback(landed.append)
+
+        self.dlm.resume()
+        done = list(self.dlm.as_completed(jobs + [missing], timeout=5))
+        self.assertEqual(sorted(map(id, done)),
+                         sorted(map(id, jobs + [missing])))
+        self.assertTrue(self.dlm.wait_all(5))
+        self.assertEqual(landed, [jobs[0]])
+        for dlf in jobs:
+            self.assertTrue(dlf.result().complete)
+            self.assertEqual(os.path.getsize(dlf.path), 1024)
+        self.assertEqual(missing.exception().code, 404)
+        self.assertRaises(Exception, missing.result)
+        missing.add_done_callback(landed.append)
+        self.assertEqual(landed, [jobs[0], missing])
+
+    def test_progress(self):
+        '''Verify per-download events and the aggregate progress view'''
+        done = threading.Event()
+        events = []
+        self.dlm.append(self.server.url('/small.bin'), self.tmpdir,
+                        lambda url, err=None: done.set(),
+                        progress_cb=events.append)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(events[-1].done, 1024)
+        self.assertEqual(self.dlm.progress().done, 1024)
+
+    def test_checksum_refetch(self):
+        '''Verify a checksum mismatch is fetched again, then reported'''
+        done = threading.Event()
+        errors = []
+
+        def callback(url, err=None):
+            errors.append(err)
+            done.set()
+
+        self.dlm.append(self.server.url('/small.bin'), self.tmpdir, callback,
+                        checksum='sha256:%s' % ('0' * 64))
+        self.assertTrue(done.wait(5))
+        self.assertTrue(isinstance(errors[0], ChecksumError))
+        gets = [req for req in self.server.requests if req[0] == 'GET']
+        self.assertEqual(len(gets), 2)
+
+    def test_coalesce(self):
+        '''Verify concurrent jobs for one url share a single transfer'''
+        done = Countdown(3)
+        self.dlm.pause()
+        dirs = [tempfile.mkdtemp(dir=self.tmpdir) for _ in range(3)]
+        for dst in dirs:
+            self.dlm.append(self.server.url('/small.bin'), dst, done)
+        self.dlm.resume()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(done.errors, [None] * 3)
+        self.assertTrue(all(os.path.getsize(os.path.join(dst, 'small.bin'))
+                            == 1024 for dst in dirs))
+        gets = [req for req in self.server.requests if req[0] == 'GET']
+        self.assertEqual(len(gets), 1)
+
+    def test_stats(self):
+        '''Verify downloads feed the metrics snapshot and exposition'''
+        done = threading.Event()
+        self.dlm.append(self.server.url('/small.bin'), self.tmpdir,
+                        lambda url, err=None: done.set())
+        self.assertTrue(done.wait(5))
+        time.sleep(.1)
+        stats = self.dlm.stats()
+        self.assertEqual(stats['counters']['downloads_completed'], 1)
+        self.assertEqual(stats['counters']['bytes_downloaded'], 1024)
+        self.assertEqual(stats['summaries']['ttfb_seconds']['count'], 1)
+        self.assertEqual(stats['summaries']['queue_wait_seconds']['count'], 1)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(sum(stats['workers'].values()), 2)
+
+        text = self.dlm.prometheus()
+        self.assertTrue('libdlm_downloads_completed_total 1.0\n' in text)
+        self.assertTrue('libdlm_workers{state="RUNNING"} 2.0\n' in text)
+
+    def test_extend(self):
+        '''Verify extend() pulls lazily from a generator of jobs'''
+        pulled = []
+        done = Countdown(30)
+
+        def manifest():
+            for idx in range(30):
+                pulled.append(idx)
+                if idx == 7:
+                    yield {'src': 'not a url', 'bogus': True}
+                yield (self.server.url('/small.bin?%d' % idx),
+                       os.path.join(self.tmpdir, str(idx)))
+
+        for idx in range(30):
+            os.mkdir(os.path.join(self.tmpdir, str(idx)))
+        self.dlm.pause()
+        time.sleep(.1)
+        self.dlm.extend(manifest(), cb=done)
+        self.assertEqual(pulled, [])
+        self.assertTrue(self.dlm.is_busy())
+
+        self.dlm.resume()
+        self.assertTrue(done.wait(10))
+        self.assertEqual(len(pulled), 30)
+        start = time.time()
+        while self.dlm.is_busy() and time.time() - start < 5:
+            time.sleep(.05)
+        self.assertEqual(len(self.dlm.queue.feeds), 0)
+
+    def test_compact_job(self):
+        '''Verify jobs are slotted records without a per-instance dict'''
+        dlf = DownloadFile('http://host/file', '.')
+        self.assertFalse(hasattr(dlf, '__dict__'))
+        self.assertRaises(AttributeError, setattr, dlf, 'unknown', 1)
+
+    def test_stop(self):
+        '''Verify idle workers stop promptly'''
+        start = time.time()
+        self.dlm.stop()
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(all(thread.state == States.STOPPED
+                            for thread in self.dlm.threads))
+
+    def test_stop_cancels_queued(self):
+        '''Verify jobs still queued at stop resolve as cancelled'''
+        errors = []
+        self.dlm.pause()
+        jobs = [self.dlm.append(self.server.url('/small.bin'), self.tmpdir,
+                                lambda url, err=None: errors.append(err))
+                for _ in range(2)]
+        self.dlm.extend([(self.server.url('/small.bin'), self.tmpdir)])
+        self.dlm.stop()
+        for dlf in jobs:
+            self.assertTrue(dlf.done())
+            self.assertRaises(CancelledError, dlf.result, 0)
+        self.assertEqual(len(errors), 2)
+        self.assertFalse(self.dlm.is_busy())
+
+
+###############################################################################
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_repeat_served_locally(self):
+        '''Verify a repeated url is served from the cache'''
+        server = LocalHTTPServer({'/small.bin': b'x' * 1024})
+        dlm = DownloadManager(Settings({'thread_count': 1,
+                                        'cache_path': self.cache_dir}))
+        try:
+            for name in ('first', 'second'):
+                done = threading.Event()
+                dst = os.path.join(self.tmpdir, name)
+                os.mkdir(dst)
+                dlf = dlm.append(server.url('/small.bin'), dst,
+                                 lambda url, err=None: done.set())
+                self.assertTrue(done.wait(5))
+                self.assertTrue(dlf.complete)
+        finally:
+            dlm.stop()
+            server.shutdown()
+        gets = [req for req in server.requests if req[0] == 'GET']
+        self.assertEqual(len(gets), 1)
+        self.assertEqual(os.path.getsize(dlf.path), 1024)
+
+    def test_lru_eviction(self):
+        '''Verify the least recently used objects are evicted first'''
+        cache = ContentCache(self.cache_dir, max_size=2048)
+        paths = []
+        for idx in range(3):
+            paths.append(os.path.join(self.tmpdir, 'file%d' % idx))
+            with open(paths[-1], 'wb') as file_hndl:
+                file_hndl.write(bytes(bytearray([idx])) * 1024)
+        cache.add('http://host/0', paths[0], validator='"0"')
+        cache.add('http://host/1', paths[1], validator='"1"')
+        self.assertTrue(cache.fetch('http://host/0', self.tmpdir,
+                                    validator='"0"'))
+        cache.add('http://host/2', paths[2], validator='"2"')
+        self.assertEqual(cache.size(), 2048)
+        self.assertEqual(cache.lookup('http://host/1'), None)
+        reopened = ContentCache(self.cache_dir, max_size=2048)
+        self.assertTrue(reopened.lookup('http://host/0') is not None)
+
+    def test_changed_source_refetched(self):
+        '''Verify a url is fetched again once the server's copy changes'''
+        server = LocalHTTPServer({'/small.bin': b'x' * 1024})
+        dlm = DownloadManager(Settings({'thread_count': 1,
+                                        'cache_path': self.cache_dir,
+                                        'coalesce': False}))
+        for name in ('first', 'second'):
+            os.mkdir(os.path.join(self.tmpdir, name))
+        try:
+            # the second copy is served by hard link, then overwritten
+            for name, data in (('first', b'x' * 1024),
+                               ('second', b'x' * 1024),
+                               ('second', b'y' * 2048)):
+                server.files['/small.bin'] = data
+                dst = os.path.join(self.tmpdir, name)
+                done = threading.Event()
+                dlf = dlm.append(server.url('/small.bin'), dst,
+                                 lambda url, err=None: done.set())
+                self.assertTrue(done.wait(5))
+                self.assertTrue(dlf.complete)
+                with open(dlf.path, 'rb') as file_hndl:
+                    self.assertEqual(file_hndl.read(), data)
+        finally:
+            dlm.stop()
+            server.shutdown()
+        gets = [req for req in server.requests if req[0] == 'GET']
+        self.assertEqual(len(gets), 2)
+        # the probe that revalidated the entry also served the new download
+        heads = [req for req in server.requests if req[0] == 'HEAD']
+        self.assertEqual(len(heads), 3)
+        # the new download did not write through the served hard link
+        old = 'sha256:%s' % hashlib.sha256(b'x' * 1024).hexdigest()
+        path = dlm.cache.fetch(None, self.tmpdir, old)
+        with open(path, 'rb') as file_hndl:
+            self.assertEqual(file_hndl.read(), b'x' * 1024)
+
+    def test_corrupt_object_dropped(self):
+        '''Verify an object changed since it was stored is a miss'''
+        cache = ContentCache(self.cache_dir, max_size=2048)
+        path = os.path.join(self.tmpdir, 'file')
+        with open(path, 'wb') as file_hndl:
+            file_hndl.write(b'x' * 1024)
+        cache.add('http://host/file', path, validator='"1"')
+        digest = cache.lookup('http://host/file')['digest']
+        with open(cache._object_path(digest), 'r+b') as file_hndl:
+            file_hndl.write(b'y')
+        dst = os.path.join(self.tmpdir, 'dst')
+        os.mkdir(dst)
+        self.assertEqual(cache.fetch(None, dst, digest), None)
+        self.assertEqual(cache.lookup('http://host/file'), None)
+
+
+###############################################################################
+class AutoscaleTest(unittest.TestCase):
+
+    def test_policy(self):
+        '''Verify growth under load stops at a throughput plateau'''
+        policy = ScalingPolicy(1, 16, idle_ticks=2)
+        self.assertEqual(policy.decide(2, 50, 2, 1e6), 4)
+        self.assertEqual(policy.decide(4, 50, 4, 2e6), 8)
+        self.assertEqual(policy.decide(8, 50, 8, 2e6), 8)
+        self.assertEqual(policy.decide(8, 50, 8, 2e6), 8)
+        self.assertEqual(policy.decide(8, 0, 2, 0), 8)
+        self.assertEqual(policy.decide(8, 0, 2, 0), 5)
+
+    def test_resize(self):
+        '''Verify the pool can be grown and shrunk while running'''
+        dlm = DownloadManager(Settings({'thread_count': 2}))
+        try:
+            dlm.resize(5)
+            self.assertEqual(len(dlm.threads), 5)
+            self.assertTrue(all(thread.is_alive() for thread in dlm.threads))
+            dlm.resize(1)
+            self.assertEqual(len(dlm.threads), 1)
+            for thread in dlm.retired:
+                thread.join(1)
+                self.assertFalse(thread.is_alive())
+        finally:
+            dlm.stop()
+
+    def test_autoscale(self):
+        '''Verify a backlog grows the pool and an idle pool shrinks'''
+        tmpdir = tempfile.mkdtemp()
+        server = LocalHTTPServer(dict(('/%d.bin' % idx, b'x' * 4096)
+                                      for idx in range(40)))
+        dlm = DownloadManager(Settings({'thread_count': 1, 'min_threads': 1,
+                                        'max_threads': 8,
+                                        'autoscale_interval': 0.05,
+                                        'download_rate_limit': 40960}))
+        done = Countdown(40)
+        try:
+            for idx in range(40):
+                dlm.append(server.url('/%d.bin' % idx), tmpdir, done)
+            peak = 1
+            start = time.time()
+            while not done.wait(.05) and time.time() - start < 60:
+                peak = max(peak, len(dlm.threads))
+            self.assertTrue(done.wait(0))
+            self.assertTrue(peak > 1)
+            start = time.time()
+            while len(dlm.threads) > 1 and time.time() - start < 5:
+                time.sleep(.05)
+            self.assertEqual(len(dlm.threads), 1)
+        finally:
+            dlm.stop()
+            server.shutdown()
+            shutil.rmtree(tmpdir)
+
+
+###############################################################################
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = LocalHTTPServer({'/small.bin': b'x' * 1024})
+        self.dlm = DownloadManager(Settings({'thread_count': 2,
+                                             'process_workers': 2}))
+
+    def tearDown(self):
+        self.dlm.stop()
+        self.server.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_stages(self):
+        '''Verify stages run on the download before cb and the handle'''
+        called = []
+        dlf = self.dlm.append(self.server.url('/small.bin'), self.tmpdir,
+                              lambda url, err=None: called.append(err),
+                              stages=[double, double])
+        self.assertEqual(dlf.result(10).path,
+                         os.path.join(self.tmpdir, 'small.bin.2.2'))
+        self.assertEqual(os.path.getsize(dlf.path), 4096)
+        self.assertEqual(called, [None])
+        self.assertTrue(self.dlm.wait_all(5))
+
+    def test_stage_error(self):
+        '''Verify a failing stage is reported to cb and the handle'''
+        dst = tempfile.mkdtemp(dir=self.tmpdir)
+        dlf = self.dlm.append(self.server.url('/small.bin'), dst,
+                              stages=[explode])
+        self.assertTrue(isinstance(dlf.exception(10), ValueError))
+        self.assertRaises(TypeError, self.dlm.append,
+                          self.server.url('/small.bin'), dst,
+                          stages=[lambda path: path])
+
+    def test_backpressure(self):
+        '''Verify submitting blocks while the backlog is full'''
+        pipeline = Pipeline(workers=1, backlog=1)
+        done = []
+        try:
+            start = time.time()
+            for _ in range(3):
+                pipeline.submit([slow], 'file',
+                                lambda path, err: done.append(time.time()))
+            # each submit after the first waited for a free slot
+            self.assertTrue(time.time() - start >= 0.2)
+            self.assertTrue(pipeline.wait_idle(5))
+            self.assertEqual(len(done), 3)
+        finally:
+            pipeline.close()
+
+
+###############################################################################
+class JobQueueTest(unittest.TestCase):
+
+    def test_fifo(self):
+        '''Verify jobs come out in order when no host is capped'''
+        queue = JobQueue()
+        jobs = [DownloadFile('http://%s/file' % host, '.')
+                for host in ('a', 'b', 'a', 'c')]
+        for dlf in jobs:
+            queue.put(dlf)
+        self.assertEqual([queue.get(lambda: False) for _ in jobs], jobs)
+
+    def test_host_limit(self):
+        '''Verify a capped host is skipped in favour of runnable work'''
+        queue = JobQueue(max_per_host=1)
+        a1, a2, b1 = [DownloadFile(src, '.') for src in
+                      ('http://a/1', 'http://a/2', 'http://b/1')]
+        for dlf in (a1, a2, b1):
+            queue.put(dlf)
+        self.assertTrue(queue.get(lambda: False) is a1)
+        self.assertTrue(queue.get(lambda: False) is b1)
+        self.assertEqual(len(queue), 1)
+
+        queue.done(a1)
+        self.assertTrue(queue.get(lambda: False) is a2)
+        self.assertEqual(queue.in_flight, {'a': 1, 'b': 1})
+
+    def test_set_limit(self):
+        '''Verify limits can be raised for one host at runtime'''
+        queue = JobQueue(max_per_host=1)
+        for idx in range(3):
+            queue.put(DownloadFile('http://a/%d' % idx, '.'))
+        queue.get(lambda: False)
+        queue.set_limit('a', 3)
+        queue.get(lambda: False)
+        queue.get(lambda: False)
+        self.assertEqual(queue.in_flight, {'a': 3})
+
+    def test_feed_past_capped_host(self):
+        '''Verify jobs for a capped host do not hide others in a feed'''
+        def get_async(queue):
+            got, stopped = [], []
+            worker = threading.Thread(
+                target=lambda: got.append(queue.get(lambda: stopped)))
+            worker.start()
+            worker.join(2)
+            stopped.append(True)
+            queue.wakeup()
+            worker.join()
+            return got[0]
+
+        queue = JobQueue(max_per_host=1, prefetch=2)
+        jobs = [DownloadFile('http://a/%d' % idx, '.') for idx in range(3)]
+        jobs.append(DownloadFile('http://b/0', '.'))
+        queue.feed(lambda: jobs.pop(0) if jobs else None)
+        self.assertEqual(queue.get(lambda: False).src, 'http://a/0')
+        # a/1 and a/2 fill the prefetch window, b/0 is still pulled
+        self.assertEqual(get_async(queue).src, 'http://b/0')
+        self.assertEqual(len(queue), 2)
+
+        # but no further than twice the window
+        queue = JobQueue(max_per_host=1, prefetch=2)
+        jobs = [DownloadFile('http://a/%d' % idx, '.') for idx in range(6)]
+        jobs.append(DownloadFile('http://b/0', '.'))
+        queue.feed(lambda: jobs.pop(0) if jobs else None)
+        queue.get(lambda: False)
+        self.assertEqual(get_async(queue), None)
+        self.assertEqual(len(queue), 4)
+
+    def test_open_circuit(self):
+        '''Verify jobs for a host with an open circuit are parked'''
+        breakers = CircuitBreakers(threshold=1, reset_timeout=0.1)
+        queue = JobQueue(breakers=breakers)
+        a1, b1 = DownloadFile('http://a/1', '.'), DownloadFile('http://b/1', '.')
+        queue.put(a1)
+        queue.put(b1)
+        breakers.failure('a')
+        self.assertTrue(queue.get(lambda: False) is b1)
+        start = time.time()
+        self.assertTrue(queue.get(lambda: False) is a1)
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(breakers.state('a'), 'half-open')
+
+
+###############################################################################
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'dlm.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_replay(self):
+        '''Verify finished jobs are dropped and ranges survive a reopen'''
+        journal = Journal(self.path)
+        first = journal.queued('http://host/a', '.')
+        second = journal.queued('http://host/b', '.', 'user', 'pass')
+        journal.range_done(second, 0, 99, '"v1"')
+        journal.finished(first)
+        journal.file.write('{"op": "range", "id"')  # torn write
+        journal.close()
+
+        pending = Journal(self.path).pending()
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pending[0]['id'], second)
+        self.assertEqual(pending[0]['username'], 'user')
+        self.assertEqual(pending[0]['ranges'], [[0, 99]])
+        self.assertEqual(pending[0]['validator'], '"v1"')
+
+    def test_validator_change(self):
+        '''Verify stale validators and resets discard written ranges'''
+        journal = Journal(self.path)
+        job_id = journal.queued('http://host/a', '.')
+        journal.range_done(job_id, 0, 99, '"v1"')
+        journal.range_done(job_id, 0, 49, '"v2"')
+        self.assertEqual(journal.pending()[0]['ranges'], [[0, 49]])
+        journal.reset(job_id)
+        journal.close()
+        self.assertEqual(Journal(self.path).pending()[0]['ranges'], [])
+
+    def test_recover(self):
+        '''Verify a restarted manager finishes the journalled work'''
+        server = LocalHTTPServer({'/small.bin': b'x' * 1024})
+        journal = Journal(self.path)
+        journal.queued(server.url('/small.bin'), self.tmpdir)
+        journal.close()
+        try:
+            dlm = DownloadManager(Settings({'thread_count': 1,
+                                            'journal_path': self.path}))
+            self.assertEqual(len(dlm.recovered), 1)
+            start = time.time()
+            while dlm.is_busy() and time.time() - start < 5:
+                time.sleep(.05)
+            dlm.stop()
+        finally:
+            server.shutdown()
+        self.assertTrue(dlm.recovered[0].complete)
+        self.assertEqual(Journal(self.path).pending(), [])
+
+    def test_recover_stream(self):
+        '''Verify a recovered single stream resumes from its partial file'''
+        data = b''.join(bytes(bytearray([idx])) * 4 for idx in range(256))
+        server = LocalHTTPServer({'/small.bin': data})
+        with open(os.path.join(self.tmpdir, 'small.bin'), 'wb') as file_hndl:
+            file_hndl.write(data[:300])
+        journal = Journal(self.path)
+        job_id = journal.queued(server.url('/small.bin'), self.tmpdir)
+        journal.streaming(job_id, '"%x"' % len(data))
+        journal.close()
+        self.assertTrue(Journal(self.path).pending()[0]['stream'])
+        try:
+            dlm = DownloadManager(Settings({'thread_count': 1,
+                                            'journal_path': self.path}))
+            start = time.time()
+            while dlm.is_busy() and time.time() - start < 5:
+                time.sleep(.05)
+            dlm.stop()
+        finally:
+            server.shutdown()
+        self.assertTrue(dlm.recovered[0].complete)
+        gets = [req for req in server.requests if req[0] == 'GET']
+        self.assertEqual(gets, [('GET', '/small.bin', 'bytes=300-')])
+        with open(dlm.recovered[0].path, 'rb') as file_hndl:
+            self.assertEqual(file_hndl.read(), data)
+
+
+###############################################################################
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
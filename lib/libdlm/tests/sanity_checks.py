@@ -2,11 +2,17 @@
 
 # Imports #####################################################################
 # from os import path, remove
+import subprocess
+import sys
 import unittest
 from libdlm import DownloadFile, DownloadManager, Settings
 from time import sleep
 import logging
 
+# modules a manager only needs once it has something to download
+PROTOCOL_MODULES = ('asyncio', 'cgi', 'ftplib', 'furl', 'http.client',
+                    'multiprocessing', 'urllib.request')
+
 
 ###############################################################################
 class SanityTest(unittest.TestCase):
@@ -19,8 +25,11 @@ class SanityTest(unittest.TestCase):
 
         for settings in settings_list:
             dlm = DownloadManager(settings)
+            self.assertEqual(dlm.threads, [])
+            dlm.start()
             self.assertEqual(dlm.marco(), "polo")
             self.assertEqual(len(dlm.threads), settings.thread_count)
+            dlm.stop()
 
         dlm1 = DownloadManager(settings=settings_list[2], borg=True)
         dlm2 = DownloadManager(borg=True)
@@ -39,6 +48,22 @@ class SanityTest(unittest.TestCase):
         dlm = DownloadManager(borg=True)
         self.assertNotEqual(dlm.logger_name, "dlmtest")
 
+    def test_lazy_startup(self):
+        '''Verify import and construction load no protocol modules'''
+        script = ('import logging, sys, threading, libdlm\n'
+                  'dlm = libdlm.DownloadManager()\n'
+                  'print(threading.active_count())\n'
+                  'print(len(logging.getLogger("libdlm").handlers))\n'
+                  'print(" ".join(sorted(sys.modules)))\n')
+        output = subprocess.check_output([sys.executable, '-c', script])
+        threads, handlers, modules = output.decode().splitlines()
+        self.assertEqual(threads, '1')
+        # only the NullHandler
+        self.assertEqual(handlers, '1')
+        loaded = set(modules.split())
+        self.assertEqual([name for name in PROTOCOL_MODULES
+                          if name in loaded], [])
+
     def test_dl(self):
         '''Verify successful downloads'''
         dlm = DownloadManager()
@@ -0,0 +1,105 @@
+'''
+Bandwidth limiting with token buckets.
+
+A TokenBucket refills at rate bytes per second.  Consumers take tokens after
+reading data and, when the bucket is in debt, sleep until it would be paid
+off, so the long run throughput converges on rate however many threads share
+the bucket.  A Throttle combines a global bucket, per-host buckets and an
+optional per-download bucket.  All rates can be changed while downloads run;
+a rate of None means unlimited.
+'''
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    '''
+    >>> bucket = TokenBucket(1024 * 1024)  # 1 MiB/s
+    >>> bucket.consume(512 * 1024)         # sleeps ~0.5s from empty
+    >>> bucket.set_rate(None)              # unlimited from now on
+    '''
+
+    def __init__(self, rate=None, burst=0.1):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0.0
+        self.stamp = time.time()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.time())
+            self.rate = rate
+            self.tokens = min(self.tokens, 0.0)
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.rate * self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, nbytes):
+        '''takes nbytes of tokens and returns the seconds to wait for them'''
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            self._refill(time.time())
+            self.tokens -= nbytes
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def consume(self, nbytes):
+        '''takes nbytes of tokens, sleeping while the bucket is in debt'''
+        wait = self.reserve(nbytes)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Throttle(object):
+    '''global and per-host token buckets shared by a manager's downloads'''
+
+    def __init__(self, rate=None, host_rates=None):
+        self.lock = threading.Lock()
+        self.bucket = TokenBucket(rate)
+        self.hosts = {}
+        for host, host_rate in (host_rates or {}).items():
+            self.set_host_rate(host, host_rate)
+
+    def set_rate(self, rate):
+        '''changes the limit on the total bandwidth'''
+        self.bucket.set_rate(rate)
+
+    def set_host_rate(self, host, rate):
+        '''changes the limit on the bandwidth used against one host'''
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = TokenBucket(rate)
+                return
+        self.hosts[host].set_rate(rate)
+
+    def buckets(self, host, bucket=None):
+        '''returns the limited buckets that apply to a download'''
+        buckets = [self.bucket, self.hosts.get(host), bucket]
+        return [item for item in buckets if item is not None and item.rate]
+
+    def max_chunk(self, host, bucket=None):
+        '''
+        a read size worth about a tenth of a second at the tightest limit,
+        or None when unlimited, so throttled reads stay smooth
+        '''
+        rates = [item.rate for item in self.buckets(host, bucket)]
+        if not rates:
+            return None
+        return max(1, int(min(rates) / 10))
+
+    def reserve(self, host, nbytes, bucket=None):
+        '''takes nbytes from every applicable bucket, returns the wait'''
+        waits = [item.reserve(nbytes) for item in self.buckets(host, bucket)]
+        return max(waits or [0.0])
+
+    def consume(self, host, nbytes, bucket=None):
+        wait = self.reserve(host, nbytes, bucket)
+        if wait > 0:
+            time.sleep(wait)
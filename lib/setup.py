@@ -27,6 +27,7 @@ if __name__ == '__main__':
         url="https://github.com/JasonAUnrein/libdlm",
         download_url="https://github.com/JasonAUnrein/libdlm/blob/master/release/libdlm-{0}.tar.gz".format(__version__),
         install_requires=["furl", "unittest2"],
+        python_requires=">=2.7, !=3.0.*, !=3.1.*",
         packages=find_packages(),
         package_data={"libdlm": ['.*']},
         zip_safe=True,
@@ -39,7 +40,6 @@ if __name__ == '__main__':
             'License :: OSI Approved :: GNU General Public License v2 or later (GPLv2+)',
             'Programming Language :: Python',
             'Programming Language :: Python :: 2',
-            'Programming Language :: Python :: 2.6',
             'Programming Language :: Python :: 2.7',
             'Programming Language :: Python :: 3',
             'Programming Language :: Python :: 3.2',